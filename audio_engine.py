@@ -0,0 +1,252 @@
+import ctypes
+import ctypes.util
+import glob
+import os
+import struct
+import subprocess
+import threading
+
+import metrics
+
+# Play frequently-used sounds (chiefly the clock chimes) from decoded
+# PCM held in memory, writing it straight to the ALSA output device,
+# so they start within milliseconds instead of waiting for a player
+# process to start and decode the file.
+
+# The sounds are decoded once, in the background, by ogg123 writing a
+# WAV stream.  Playback uses libasound directly if it can be loaded,
+# and otherwise a long-lived aplay process per sample format.
+
+CHUNK_SECONDS = 0.05
+ALSA_LATENCY = 100000           # microseconds
+
+class PcmSound(object):
+
+    pass
+
+    def __init__(self, filename, channels, rate, sample_width, frames):
+        self.filename = filename
+        self.channels = channels
+        self.rate = rate
+        self.sample_width = sample_width
+        self.frames = frames
+
+    def frame_size(self):
+        return self.channels * self.sample_width
+
+    def duration(self):
+        """Return the length of the sound in seconds."""
+        return len(self.frames) / (self.frame_size() * self.rate)
+
+def parse_wav(filename, data):
+    """Make a PcmSound from the contents of a WAV file.
+    The length in the data chunk header is ignored, as a streaming
+    decoder can't fill it in."""
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        raise ValueError("%s did not decode to WAV data" % filename)
+    offset = 12
+    fmt = None
+    while offset + 8 <= len(data):
+        chunk_id, chunk_size = struct.unpack_from('<4sI', data, offset)
+        offset += 8
+        if chunk_id == b'fmt ':
+            fmt = struct.unpack_from('<HHIIHH', data, offset)
+        elif chunk_id == b'data':
+            if fmt is None:
+                break
+            _tag, channels, rate, _byte_rate, _align, bits = fmt
+            sample_width = bits // 8
+            frames = data[offset:]
+            frames = frames[:len(frames) - len(frames) % (channels * sample_width)]
+            return PcmSound(filename, channels, rate, sample_width, frames)
+        offset += chunk_size + (chunk_size & 1)
+    raise ValueError("%s has no usable WAV data" % filename)
+
+def decode(filename):
+    """Decode a sound file into a PcmSound."""
+    if filename.endswith(".wav"):
+        with open(filename, 'rb') as wavstream:
+            return parse_wav(filename, wavstream.read())
+    return parse_wav(filename,
+                     subprocess.run(["ogg123", "-q", "-d", "wav", "-f", "-", filename],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL,
+                                    check=True).stdout)
+
+ALSA_FORMATS = {1: 1, 2: 2, 3: 32, 4: 10} # U8, S16_LE, S24_3LE, S32_LE
+APLAY_FORMATS = {1: "U8", 2: "S16_LE", 3: "S24_3LE", 4: "S32_LE"}
+
+class AlsaOutput(object):
+
+    """An ALSA PCM device, opened through libasound."""
+
+    pass
+
+    def __init__(self, libasound, device, sound):
+        self.libasound = libasound
+        self.frame_size = sound.frame_size()
+        if sound.sample_width not in ALSA_FORMATS:
+            raise OSError("%s has an unsupported sample width, %d" % (sound.filename, sound.sample_width))
+        self.pcm = ctypes.c_void_p()
+        if libasound.snd_pcm_open(ctypes.byref(self.pcm), device.encode(), 0, 0) < 0:
+            raise OSError("could not open ALSA device %s" % device)
+        if libasound.snd_pcm_set_params(self.pcm, ALSA_FORMATS[sound.sample_width], 3, # RW_INTERLEAVED
+                                        sound.channels, sound.rate, 1, ALSA_LATENCY) < 0:
+            libasound.snd_pcm_close(self.pcm)
+            raise OSError("could not set ALSA parameters for %s" % sound.filename)
+
+    def write(self, chunk):
+        frames = len(chunk) // self.frame_size
+        while frames > 0:
+            written = self.libasound.snd_pcm_writei(self.pcm, chunk, frames)
+            if written < 0:
+                # an underrun, typically after a pause:
+                if self.libasound.snd_pcm_recover(self.pcm, written, 1) < 0:
+                    raise OSError("ALSA write failed")
+                continue
+            chunk = chunk[written * self.frame_size:]
+            frames -= written
+
+    def close(self, drain=True):
+        if drain:
+            self.libasound.snd_pcm_drain(self.pcm)
+        self.libasound.snd_pcm_close(self.pcm)
+
+class AplayOutput(object):
+
+    """A long-lived aplay process, kept for reuse by sounds of the same format."""
+
+    pass
+
+    def __init__(self, device, sound):
+        self.process = metrics.popen(["aplay", "-q", "-D", device, "-t", "raw",
+                                      "-f", APLAY_FORMATS[sound.sample_width],
+                                      "-c", str(sound.channels),
+                                      "-r", str(sound.rate),
+                                      "-"],
+                                     stdin=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL)
+
+    def write(self, chunk):
+        self.process.stdin.write(chunk)
+        self.process.stdin.flush()
+
+    def close(self, drain=True):
+        pass
+
+class PcmPlayback(object):
+
+    """Playback of a cached sound, in the style of audio_queue.ProcessPlayback."""
+
+    pass
+
+    def __init__(self, engine, sound, offset=0):
+        self.engine = engine
+        self.sound = sound
+        self.offset = offset
+        self.running = threading.Event()
+        self.running.set()
+        self.done = False
+
+    def start(self, on_exit):
+        threading.Thread(target=self.run, args=(on_exit,), daemon=True).start()
+
+    def run(self, on_exit):
+        output = None
+        played = False
+        try:
+            output = self.engine.output(self.sound)
+            chunk_size = self.sound.frame_size() * int(self.sound.rate * CHUNK_SECONDS)
+            frames = memoryview(self.sound.frames)
+            skip = self.sound.frame_size() * int(self.sound.rate * self.offset)
+            for start in range(skip, len(frames), chunk_size):
+                self.running.wait()
+                if self.done:
+                    break
+                output.write(bytes(frames[start:start + chunk_size]))
+            played = not self.done
+        except Exception as e:
+            self.engine.log("could not play %s: %s", self.sound.filename, e)
+        finally:
+            try:
+                if output is not None:
+                    # only waiting for the end of the sound if it all went out:
+                    self.engine.release(output, played)
+            except Exception as e:
+                self.engine.log("could not close the output for %s: %s", self.sound.filename, e)
+            # the queue must always hear that this has finished, or it waits for ever:
+            self.done = True
+            on_exit()
+
+    def finished(self):
+        return self.done
+
+    def pause(self):
+        self.running.clear()
+
+    def resume(self):
+        self.running.set()
+
+    def stop(self):
+        self.done = True
+        self.running.set()
+
+class AudioEngine(object):
+
+    pass
+
+    def __init__(self, device="default", log=None):
+        self.device = device
+        self.log = log or (lambda message, *message_data: None)
+        self.sounds = {}
+        self.aplays = {}
+        self.on_preloaded = None    # called, on the preload thread, when a preload has finished
+        library = ctypes.util.find_library('asound')
+        self.libasound = ctypes.CDLL(library) if library else None
+        if self.libasound:
+            self.libasound.snd_pcm_writei.restype = ctypes.c_long
+            self.libasound.snd_pcm_writei.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_ulong]
+            self.libasound.snd_pcm_recover.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+
+    def load(self, filename):
+        """Decode a sound file into the cache."""
+        try:
+            self.sounds[os.path.realpath(filename)] = decode(filename)
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            self.log("could not decode %s: %s", filename, e)
+
+    def preload(self, patterns):
+        """Decode the sound files matching some glob patterns, on a background thread."""
+        filenames = [filename
+                     for pattern in patterns
+                     for filename in sorted(glob.glob(os.path.expandvars(os.path.expanduser(pattern))))]
+        def load_all():
+            for filename in filenames:
+                self.load(filename)
+            self.log("audio engine has %d sounds decoded", len(self.sounds))
+            if self.on_preloaded:
+                self.on_preloaded()
+        threading.Thread(target=load_all, daemon=True).start()
+
+    def cached(self, filename):
+        """Return the decoded sound for a file, if it is in the cache."""
+        return self.sounds.get(os.path.realpath(filename))
+
+    def playback(self, filename, offset=0):
+        """Return a playback of a cached sound, starting OFFSET seconds in,
+        or None if it isn't cached."""
+        sound = self.cached(filename)
+        return sound and PcmPlayback(self, sound, offset)
+
+    def output(self, sound):
+        """Get an output for a sound."""
+        if self.libasound:
+            return AlsaOutput(self.libasound, self.device, sound)
+        key = (sound.channels, sound.rate, sound.sample_width)
+        aplay = self.aplays.get(key)
+        if aplay is None or aplay.process.poll() is not None:
+            aplay = self.aplays[key] = AplayOutput(self.device, sound)
+        return aplay
+
+    def release(self, output, drain):
+        output.close(drain)
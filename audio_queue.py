@@ -0,0 +1,177 @@
+import heapq
+import itertools
+import signal
+import subprocess
+import threading
+
+import metrics
+
+# Prioritised queue of sounds for the noticeboard speaker.
+
+# Chimes and speech pre-empt music: the music player is paused while
+# they play, and resumed when they have finished.  Nothing ever waits
+# for a player to finish; each player has a thread that waits for its
+# process to exit, and calls the queue's notify function, which the
+# event loop uses to get the queue updated in its own thread.
+
+CHIME = 0
+SPEECH = 1
+MUSIC = 2
+
+PRIORITY_NAMES = {CHIME: 'chime', SPEECH: 'speech', MUSIC: 'music'}
+
+class ProcessPlayback(object):
+
+    """A sound played by one or more external programs, run in sequence,
+    for example a lilypond conversion followed by playing the MIDI file."""
+
+    pass
+
+    def __init__(self, *commands, log=None):
+        self.commands = list(commands)
+        self.log = log or (lambda message, *message_data: None)
+        self.process = None
+        self.done = False
+
+    def start(self, on_exit):
+        """Start the first program, calling ON_EXIT (from another thread) when they have all finished."""
+        threading.Thread(target=self.run, args=(on_exit,), daemon=True).start()
+
+    def run(self, on_exit):
+        try:
+            for command in self.commands:
+                if self.done:
+                    break
+                self.process = metrics.popen(command,
+                                             stdout=subprocess.DEVNULL,
+                                             stderr=subprocess.DEVNULL)
+                self.process.wait()
+        except Exception as e:
+            self.log("could not run %s: %s", command, e)
+        finally:
+            # the queue must always hear that this has finished, or it waits for ever:
+            self.done = True
+            on_exit()
+
+    def finished(self):
+        return self.done
+
+    def pause(self):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGSTOP)
+
+    def resume(self):
+        if self.process and self.process.poll() is None:
+            self.process.send_signal(signal.SIGCONT)
+
+    def stop(self):
+        self.done = True
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            self.process.send_signal(signal.SIGCONT) # in case it was paused
+
+class QueueEntry(object):
+
+    pass
+
+    def __init__(self, priority, sequence, description, playback, on_done):
+        self.priority = priority
+        self.sequence = sequence
+        self.description = description
+        self.playback = playback
+        self.on_done = on_done
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+    def __str__(self):
+        return "%s: %s" % (PRIORITY_NAMES.get(self.priority, self.priority), self.description)
+
+class PlaybackQueue(object):
+
+    pass
+
+    def __init__(self, on_start=None, on_finish=None, notify=None):
+        self.waiting = []        # heap of QueueEntry
+        self.paused = []         # stack of pre-empted entries
+        self.current = None
+        self.sequence = itertools.count()
+        self.on_start = on_start
+        self.on_finish = on_finish
+        self.notify = notify
+
+    def add(self, playback, priority=MUSIC, description="", on_done=None):
+        """Queue a playback.  ON_DONE is called with the entry and whether it completed."""
+        entry = QueueEntry(priority, next(self.sequence), description, playback, on_done)
+        heapq.heappush(self.waiting, entry)
+        self.update()
+        return entry
+
+    def busy(self):
+        """Return whether anything is playing, paused or waiting to play."""
+        return bool(self.current or self.paused or self.waiting)
+
+    def exited(self):
+        """Called from the thread of a playback whose programs have finished."""
+        if self.notify:
+            self.notify()
+
+    def finish(self, entry, completed):
+        if entry.on_done:
+            entry.on_done(entry, completed)
+        if self.on_finish:
+            self.on_finish(entry, completed)
+
+    def start(self, entry):
+        self.current = entry
+        entry.playback.start(self.exited)
+        if self.on_start:
+            self.on_start(entry)
+
+    def update(self):
+        """Move the queue on: notice finished playbacks, and start, pre-empt or resume others.
+        This must be called from the event loop's thread."""
+        if self.current and self.current.playback.finished():
+            finished, self.current = self.current, None
+            self.finish(finished, True)
+        if (self.current
+            and self.current.priority == MUSIC
+            and self.waiting
+            and self.waiting[0].priority < MUSIC):
+            self.current.playback.pause()
+            self.paused.append(self.current)
+            self.current = None
+        if self.current is None:
+            if self.waiting and (not self.paused
+                                 or self.waiting[0].priority < self.paused[-1].priority):
+                self.start(heapq.heappop(self.waiting))
+            elif self.paused:
+                self.current = self.paused.pop()
+                self.current.playback.resume()
+
+    def skip(self):
+        """Stop whatever is playing now, and move on to the next thing."""
+        if self.current:
+            skipped, self.current = self.current, None
+            skipped.playback.stop()
+            self.finish(skipped, False)
+        self.update()
+
+    def clear(self, priority=None):
+        """Drop the waiting and paused entries, optionally just those of one priority."""
+        dropped = [entry
+                   for entry in self.waiting + self.paused
+                   if priority is None or entry.priority == priority]
+        self.waiting = [entry for entry in self.waiting if entry not in dropped]
+        heapq.heapify(self.waiting)
+        self.paused = [entry for entry in self.paused if entry not in dropped]
+        for entry in dropped:
+            entry.playback.stop()
+            self.finish(entry, False)
+        self.update()
+
+    def describe(self):
+        """Return a list of descriptions of the playing, paused and waiting entries."""
+        return ((["playing %s" % self.current] if self.current else [])
+                + ["paused %s" % entry for entry in reversed(self.paused)]
+                + ["waiting %s" % entry for entry in sorted(self.waiting)])
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the noticeboard controller, run on the simulated
+# hardware, so they can be run on any Linux machine.
+
+# The controller is started in this process, on the simulated GPIO
+# and camera (see hardware_backend.py), and measured through its
+# command port and its pins:
+#   - command round-trip latency, one request at a time
+#   - throughput, with many requests pipelined on one connection
+#   - how far fades finish from when they were asked to
+#   - how long from the PIR going on until the lamps start to light
+# along with the controller's own step and loop lateness timings.
+
+# With --save the results are written to a JSON file, and with
+# --baseline they are compared with such a file, and the exit status
+# is 1 if any has got worse by more than the tolerance (and, for
+# times, by more than the slack, as sub-millisecond times vary a lot
+# from run to run), so it can be used as a regression gate.
+
+import os
+
+# this must be set before anything imports hardware_backend:
+os.environ.setdefault("NOTICEBOARD_HARDWARE", "sim")
+# and this noted before importing noticeboard changes directory:
+STARTING_DIRECTORY = os.getcwd()
+
+import argparse
+import json
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import lifehacking_config
+import metrics
+import noticeboard
+import pins
+import sim_gpio
+
+from lifehacking_config import config, update_config
+
+# name -> (description, whether bigger is better)
+RESULTS = {
+    'round_trip_p50': ("command round trip, median (s)", False),
+    'round_trip_p99': ("command round trip, 99th percentile (s)", False),
+    'commands_per_second': ("pipelined commands per second", True),
+    'fade_error_p50': ("fade end error, median (s)", False),
+    'fade_error_max': ("fade end error, worst (s)", False),
+    'pir_reaction_p50': ("PIR to lamp reaction, median (s)", False),
+    'pir_reaction_max': ("PIR to lamp reaction, worst (s)", False),
+    'step_p99': ("controller step, 99th percentile (s)", False),
+    'loop_lateness_p99': ("loop wakeup lateness, 99th percentile (s)", False),
+}
+
+def benchmark_settings(directory, port):
+    """Return the config changes for running the controller in the benchmark."""
+    return {
+        'noticeboard': {
+            'command_port': port,
+            'pir_log_file': os.path.join(directory, "pir"),
+            'log': {'file': os.path.join(directory, "noticeboard.log")},
+            'event_log': {'file': os.path.join(directory, "events.dat")},
+            'metrics': {'file': ""},
+            # a smaller picture than the real camera's, to leave the CPU
+            # time to the controller rather than to making frames:
+            'camera': {'directory': os.path.join(directory, "camera"),
+                       'main_size': "640x480"},
+            # the PIR actions straight away, so the reaction time is the controller's own:
+            'delays': {'shine': 0, 'quench': 0}},
+        'motion': {'detector': {'directory': os.path.join(directory, "motion")}}}
+
+class Client(object):
+
+    """A connection to the command port, using JSON requests."""
+
+    pass
+
+    def __init__(self, port):
+        self.socket = socket.create_connection(('localhost', port))
+        self.replies = self.socket.makefile('rb')
+        self.next_id = 0
+
+    def send(self, commands):
+        """Send several commands at once, returning the id of the last."""
+        requests = []
+        for command in commands:
+            self.next_id += 1
+            requests.append(json.dumps({'id': self.next_id, 'command': command}) + "\n")
+        self.socket.sendall("".join(requests).encode('utf-8'))
+        return self.next_id
+
+    def wait_for(self, request_id):
+        """Read replies until the one to REQUEST_ID, and return it."""
+        while line := self.replies.readline():
+            reply = json.loads(line)
+            if reply.get('id') == request_id:
+                return reply
+        raise ConnectionError("the controller closed the connection")
+
+    def request(self, command):
+        return self.wait_for(self.send([command]))
+
+    def close(self):
+        self.replies.close()
+        self.socket.close()
+
+class PinWatcher(object):
+
+    """Wait for a simulated output pin to satisfy a condition."""
+
+    pass
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.condition = None
+        self.reached = threading.Event()
+        self.when = None
+        sim_gpio.add_listener(self.changed)
+
+    def changed(self, channel, kind, value):
+        if channel == self.channel and self.condition and self.condition(value):
+            self.when = time.monotonic()
+            self.condition = None
+            self.reached.set()
+
+    def expect(self, condition):
+        self.when = None
+        self.reached.clear()
+        self.condition = condition
+
+    def wait(self, timeout):
+        """Return when the condition was met, or None if it wasn't in TIMEOUT seconds."""
+        self.reached.wait(timeout)
+        return self.when
+
+def lamp_duty():
+    return sim_gpio.pwm_duty(pins.PIN_LAMP_LEFT) or 0
+
+def from_start(filename):
+    """Return where a filename given on the command line refers to."""
+    return filename and os.path.join(STARTING_DIRECTORY, filename)
+
+def timing(name):
+    """Make a throwaway histogram for collecting the timings of one benchmark."""
+    return metrics.Histogram(name, name)
+
+def camera_check(client, directory, timeout=30):
+    """Check that the camera starts, with the benchmark's settings, by taking a photo."""
+    client.request("photo")
+    give_up = time.monotonic() + timeout
+    while time.monotonic() < give_up:
+        if os.path.isdir(directory) and any(name.endswith(".jpg") for name in os.listdir(directory)):
+            return
+        time.sleep(0.1)
+    raise RuntimeError("the camera didn't take a photo; its log is in %s" % os.path.dirname(directory))
+
+def round_trip(client, count):
+    times = timing("round trip")
+    for _ in range(count):
+        started = time.perf_counter()
+        client.request("date")
+        times.record(time.perf_counter() - started)
+    return {'round_trip_p50': times.percentile(0.5),
+            'round_trip_p99': times.percentile(0.99)}
+
+def throughput(client, count):
+    started = time.perf_counter()
+    client.wait_for(client.send(["date"] * count))
+    return {'commands_per_second': count / (time.perf_counter() - started)}
+
+def lamps_off(client, watcher):
+    if lamp_duty():
+        watcher.expect(lambda duty: duty == 0)
+        client.request("quench 0")
+        watcher.wait(5)
+
+def fade_accuracy(client, watcher, trials, duration):
+    errors = timing("fade error")
+    for _ in range(trials):
+        lamps_off(client, watcher)
+        watcher.expect(lambda duty: duty == 100)
+        started = time.monotonic()
+        client.request("shine %g" % duration)
+        if (reached := watcher.wait(duration + 5)) is None:
+            raise RuntimeError("the lamps didn't reach full brightness")
+        errors.record(abs(reached - started - duration))
+    lamps_off(client, watcher)
+    return {'fade_error_p50': errors.percentile(0.5),
+            'fade_error_max': errors.largest}
+
+def pir_reaction(client, watcher, trials):
+    reactions = timing("pir reaction")
+    for _ in range(trials):
+        sim_gpio.set_input(pins.PIN_PIR, 0)
+        lamps_off(client, watcher)
+        time.sleep(0.1)         # past the PIR pin's bounce time
+        watcher.expect(lambda duty: duty > 0)
+        started = time.monotonic()
+        sim_gpio.set_input(pins.PIN_PIR, 1)
+        if (reached := watcher.wait(5)) is None:
+            raise RuntimeError("the lamps didn't come on when the PIR went on")
+        reactions.record(reached - started)
+        time.sleep(0.1)
+    sim_gpio.set_input(pins.PIN_PIR, 0)
+    lamps_off(client, watcher)
+    return {'pir_reaction_p50': reactions.percentile(0.5),
+            'pir_reaction_max': reactions.largest}
+
+def controller_timings():
+    return {'step_p99': noticeboard.STEP_TIME.percentile(0.99),
+            'loop_lateness_p99': noticeboard.LATENESS.percentile(0.99)}
+
+def start_controller(port):
+    """Run the controller on a thread of its own.
+    Returns the thread, the pipe to its stdin, and a client connected to it."""
+    commands_read, commands_write = os.pipe()
+    sys.stdin = os.fdopen(commands_read)
+    sys.argv = sys.argv[:1]
+    noticeboard.manual_at_home = True   # so the PIR doesn't set off the intruder handling
+    controller = threading.Thread(target=noticeboard.main, daemon=True)
+    controller.start()
+    give_up = time.monotonic() + 60
+    while True:
+        try:
+            return controller, commands_write, Client(port)
+        except ConnectionRefusedError:
+            if time.monotonic() > give_up:
+                raise
+            time.sleep(0.1)
+
+def compare(results, baseline, tolerance, slack, measures=RESULTS):
+    """Return the descriptions of the results that are worse than the baseline.
+    Rates may be down by TOLERANCE, as a fraction; times may be up by
+    TOLERANCE and then SLACK seconds."""
+    worse = []
+    for name, (description, bigger_is_better) in measures.items():
+        if name not in results or name not in baseline:
+            continue
+        if (results[name] * (1 + tolerance) < baseline[name]
+            if bigger_is_better
+            else results[name] > baseline[name] * (1 + tolerance) + slack):
+            worse.append("%s: %.6g, against %.6g" % (description, results[name], baseline[name]))
+    return worse
+
+def report(results, measures, save=None, baseline=None, tolerance=0.5, slack=0.01):
+    """Show the results, and save them and compare them with a baseline if asked to.
+    Returns whether they are no worse than the baseline."""
+    for name, (description, bigger_is_better) in measures.items():
+        print("%-45s %s" % (description, ("%.1f" % results[name]
+                                          if bigger_is_better
+                                          else metrics.seconds(results[name]))))
+    if save:
+        with open(save, 'w') as outstream:
+            json.dump(results, outstream, indent=4)
+    if not baseline:
+        return True
+    with open(baseline) as instream:
+        worse = compare(results, json.load(instream), tolerance, slack, measures)
+    for line in worse:
+        print("worse than the baseline:", line)
+    return not worse
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=10199,
+                        help="""The command port for the controller being measured.""")
+    parser.add_argument("--count", type=int, default=500,
+                        help="""How many commands to time for the round trip.""")
+    parser.add_argument("--pipelined", type=int, default=5000,
+                        help="""How many commands to send for the throughput.""")
+    parser.add_argument("--trials", type=int, default=10,
+                        help="""How many fades and PIR triggers to time.""")
+    parser.add_argument("--fade", type=float, default=0.5,
+                        help="""The fade time to check, in seconds.""")
+    parser.add_argument("--save",
+                        help="""A file to write the results into, as JSON.""")
+    parser.add_argument("--baseline",
+                        help="""A file of earlier results, from --save, to compare with.""")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="""How much worse than the baseline a result may be, as a fraction.""")
+    parser.add_argument("--slack", type=float, default=0.01,
+                        help="""How many seconds a time may be over the baseline, besides the tolerance.""")
+    args = parser.parse_args()
+
+    lifehacking_config.load_config()
+    directory = tempfile.mkdtemp(prefix="noticeboard-benchmark-")
+    update_config(benchmark_settings(directory, args.port))
+    # the keyboard tray, moving between its limit switches:
+    sim_gpio.LinearActuator(pins.PIN_EXTEND, pins.PIN_RETRACT, pins.PIN_EXTENDED, pins.PIN_RETRACTED,
+                            config('noticeboard', 'tray', 'travel_time'))
+
+    controller, controller_stdin, client = start_controller(args.port)
+    watcher = PinWatcher(pins.PIN_LAMP_LEFT)
+    camera_check(client, config('noticeboard', 'camera', 'directory'))
+    results = {}
+    results.update(round_trip(client, args.count))
+    results.update(throughput(client, args.pipelined))
+    results.update(fade_accuracy(client, watcher, args.trials, args.fade))
+    results.update(pir_reaction(client, watcher, args.trials))
+    results.update(controller_timings())
+    client.close()
+    os.write(controller_stdin, b"quit\n")
+    controller.join(30)
+    shutil.rmtree(directory, ignore_errors=True)
+
+    if not report(results, RESULTS, from_start(args.save), from_start(args.baseline),
+                  args.tolerance, args.slack):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
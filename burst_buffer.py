@@ -0,0 +1,111 @@
+import datetime
+import os
+import queue
+import threading
+import time
+
+from collections import deque
+
+from camera import RETRY_LONGEST, RETRY_SHORTEST, yuv420_to_rgb
+from photo_pipeline import save_jpeg
+
+# Keeping the last few seconds of low-resolution frames in memory, so
+# that when the PIR detects someone who isn't expected, the frames
+# from before it went off can be saved along with those that follow.
+
+# Nothing is written to disk until there is a burst to save, and the
+# conversion and writing are done on a worker thread, so the capture
+# thread keeps to its frame rate.
+
+class BurstBuffer(object):
+
+    pass
+
+    def __init__(self, camera, directory, before=10, rate=2, quality=85, queue_length=256, log=None):
+        self.camera = camera
+        self.directory = directory
+        self.rate = rate
+        self.quality = quality
+        self.log = log or (lambda message, *message_data: None)
+        self.frames = deque(maxlen=int(before * rate))  # (time, YUV420 frame)
+        self.lock = threading.Lock()
+        self.burst_directory = None
+        self.until = 0
+        self.writes = queue.Queue(queue_length)
+        self.saved = 0
+        self.dropped = 0
+        self.bursts = 0
+        self.capturing = False  # whether frames are coming from the camera
+
+    def start(self):
+        self.capturing = True
+        threading.Thread(target=self.capture, daemon=True).start()
+        threading.Thread(target=self.write, daemon=True).start()
+
+    def set_before(self, before):
+        """Change how many seconds of frames are kept from before a trigger."""
+        with self.lock:
+            self.frames = deque(self.frames, maxlen=int(before * self.rate))
+
+    def capture(self):
+        """Capture frames at the buffer's rate, keeping them, or saving them during a burst."""
+        due = time.time()
+        retry = RETRY_SHORTEST
+        while True:
+            try:
+                frame = self.camera.capture_preview()
+                self.capturing = True
+                retry = RETRY_SHORTEST
+            except ImportError as e:
+                self.capturing = False
+                self.log("burst buffer stopped, no camera: %s", e)
+                return
+            except Exception as e:
+                self.capturing = False
+                self.log("burst buffer could not capture from camera, trying again in %g seconds: %s", retry, e)
+                time.sleep(retry)
+                retry = min(retry * 2, RETRY_LONGEST)
+                due = time.time()
+                continue
+            now = time.time()
+            with self.lock:
+                if now < self.until:
+                    self.save(now, frame)
+                else:
+                    self.frames.append((now, frame))
+            due = max(due + 1 / self.rate, now)
+            time.sleep(max(0, due - time.time()))
+
+    def trigger(self, duration):
+        """Save the buffered frames, and those captured for the next DURATION seconds.
+        Triggering again during a burst extends it."""
+        now = time.time()
+        if not self.capturing:
+            self.log("burst triggered while the buffer isn't capturing from the camera, so it may have no frames")
+        with self.lock:
+            if now >= self.until:
+                self.bursts += 1
+                self.burst_directory = os.path.join(self.directory,
+                                                    "burst-" + datetime.datetime.fromtimestamp(now).isoformat(timespec='seconds'))
+                for when, frame in self.frames:
+                    self.save(when, frame)
+                self.frames.clear()
+            self.until = now + duration
+
+    def save(self, when, frame):
+        try:
+            self.writes.put_nowait((self.burst_directory, when, frame))
+        except queue.Full:
+            self.dropped += 1
+
+    def write(self):
+        while True:
+            directory, when, frame = self.writes.get()
+            try:
+                os.makedirs(directory, exist_ok=True)
+                save_jpeg(yuv420_to_rgb(frame, self.camera.lores_size),
+                          os.path.join(directory, datetime.datetime.fromtimestamp(when).isoformat(timespec='milliseconds') + ".jpg"),
+                          self.quality)
+                self.saved += 1
+            except Exception as e:
+                self.log("could not save burst frame: %s", e)
@@ -0,0 +1,105 @@
+import re
+import threading
+
+from hardware_backend import camera_classes
+
+# The Pi camera, shared by everything in the controller that wants
+# frames from it.
+
+# The camera runs with two streams: a full-size one for photos, and a
+# low-resolution YUV one whose luminance plane serves as a cheap
+# greyscale image for comparing frames.  It is only started when
+# something first asks for a frame, as importing picamera2 (with numpy
+# and libcamera) and starting the camera take a while.
+
+# how long the camera's users wait before trying again after a failed
+# capture, doubling each time it fails again:
+RETRY_SHORTEST = 1
+RETRY_LONGEST = 60
+
+def parse_dimensions(size):
+    """Convert a size such as "640x480" to a (width, height) tuple."""
+    if isinstance(size, (list, tuple)):
+        return tuple(int(dimension) for dimension in size)
+    matched = re.match(r"\s*([0-9]+)\s*x\s*([0-9]+)\s*$", str(size).lower())
+    if not matched:
+        raise ValueError("Could not understand size %s" % size)
+    return int(matched.group(1)), int(matched.group(2))
+
+def yuv420_to_rgb(yuv, size):
+    """Convert a low-resolution YUV420 frame to an RGB array, using the BT.601 coefficients.
+    The U and V planes follow the Y plane, each packing two of their
+    half-width rows into each row of the array; this assumes the
+    stream's width needs no padding, as for the usual 320x240."""
+    import numpy
+    width, height = size
+    y = yuv[:height, :width].astype(numpy.float32)
+    u = yuv[height:height + height // 4].reshape(height // 2, width // 2).astype(numpy.float32) - 128
+    v = yuv[height + height // 4:height + height // 2].reshape(height // 2, width // 2).astype(numpy.float32) - 128
+    u = u.repeat(2, axis=0).repeat(2, axis=1)
+    v = v.repeat(2, axis=0).repeat(2, axis=1)
+    rgb = numpy.stack([y + 1.402 * v,
+                       y - 0.344136 * u - 0.714136 * v,
+                       y + 1.772 * u],
+                      axis=-1)
+    return rgb.clip(0, 255).astype(numpy.uint8)
+
+class Camera(object):
+
+    pass
+
+    def __init__(self, main_size=(1920, 1080), lores_size=(320, 240), log=None):
+        self.main_size = tuple(main_size)
+        self.lores_size = tuple(lores_size)
+        self.log = log or (lambda message, *message_data: None)
+        self.lock = threading.Lock()
+        self._picam = None
+
+    @property
+    def picam(self):
+        """The Picamera2 object, started on first use."""
+        with self.lock:
+            if self._picam is None:
+                Picamera2, _encoder, _output = camera_classes()
+                picam = Picamera2()
+                picam.configure(picam.create_video_configuration(
+                    # libcamera's BGR888 gives arrays in R, G, B order:
+                    main={'size': self.main_size, 'format': "BGR888"},
+                    lores={'size': self.lores_size, 'format': "YUV420"}))
+                picam.start()
+                self._picam = picam
+                self.log("camera started, %dx%d with %dx%d preview", *self.main_size, *self.lores_size)
+            return self._picam
+
+    def luminance(self, lores):
+        """Return the greyscale (Y) plane of a low-resolution YUV420 frame."""
+        width, height = self.lores_size
+        return lores[:height, :width]
+
+    def capture(self):
+        """Return the full-size frame and the greyscale preview of the next frame from the camera."""
+        (main, lores), _metadata = self.picam.capture_arrays(["main", "lores"])
+        return main, self.luminance(lores)
+
+    def capture_lores(self):
+        """Return the greyscale preview of the next frame from the camera."""
+        return self.luminance(self.picam.capture_array("lores"))
+
+    def capture_preview(self):
+        """Return the next low-resolution frame from the camera, as it comes (in YUV420)."""
+        return self.picam.capture_array("lores")
+
+    def start_recording(self, filename, bitrate):
+        """Start recording the full-size stream into FILENAME, with the hardware H.264 encoder."""
+        _camera, H264Encoder, FileOutput = camera_classes()
+        self.picam.start_encoder(H264Encoder(bitrate=bitrate), FileOutput(filename))
+
+    def stop_recording(self):
+        self.picam.stop_encoder()
+
+    def close(self):
+        with self.lock:
+            if self._picam is not None:
+                self._picam.stop()
+                self._picam.close()
+                self._picam = None
@@ -0,0 +1,126 @@
+import datetime
+import time
+
+# Clock chimes, scheduled on the controller's scheduler.
+
+# Each chime is started early by its length (less any ring-out after
+# the final strike), so that the final strike lands on the quarter.
+# When the event runs late, the chime is started part-way in, to
+# catch up with the wall clock; when it runs early (for example, the
+# clock has been stepped), it is put back on the scheduler.  A chime
+# planned before its sound's length was known is played from the
+# start it was planned for, or, if the sound turns out to be shorter
+# than the lead it was given, put back to start later.
+
+TOLERANCE = 0.02                # seconds early that we'll put up with
+LOOKAHEAD_DAYS = 8
+
+class ChimeScheduler(object):
+
+    pass
+
+    def __init__(self,
+                 scheduler,
+                 play,
+                 duration_of,
+                 chiming_times,
+                 hour_template,
+                 quarter_files,
+                 tail=0.0,
+                 fallback_leads=None,
+                 log=None):
+        """PLAY is called with a filename and an offset in seconds into the sound.
+        DURATION_OF returns the length of a sound file in seconds, or None if
+        it doesn't know it yet, in which case FALLBACK_LEADS gives how long
+        before its quarter each quarter's chime should start."""
+        self.scheduler = scheduler
+        self.play = play
+        self.duration_of = duration_of
+        self.chiming_times = chiming_times
+        self.hour_template = hour_template
+        self.quarter_files = quarter_files
+        self.tail = tail
+        self.fallback_leads = fallback_leads or [25, 10, 15, 20]
+        self.log = log or (lambda message, *message_data: None)
+        self.event = None
+
+    def reconfigure(self, **settings):
+        """Change some of the settings given to the constructor, and replan the next chime."""
+        for name, value in settings.items():
+            setattr(self, name, value)
+        self.plan()
+
+    def chiming_interval(self, day):
+        """Return the chiming times for a date, as minutes after midnight."""
+        return self.chiming_times.get(day.strftime("%A"), self.chiming_times.get('Default'))
+
+    def sound_for(self, when):
+        """Return the chime file for a quarter."""
+        quarter = when.minute // 15
+        return (self.hour_template % ((when.hour - 1) % 12 + 1)
+                if quarter == 0
+                else self.quarter_files[quarter - 1])
+
+    def lead(self, when):
+        """Return how long before the quarter its chime should start."""
+        duration = self.duration_of(self.sound_for(when))
+        return (max(0, duration - self.tail)
+                if duration
+                else self.fallback_leads[when.minute // 15])
+
+    def next_quarter(self, after):
+        """Return the next quarter after a time whose chime starts after that time."""
+        when = (after.replace(second=0, microsecond=0)
+                + datetime.timedelta(minutes=15 - after.minute % 15))
+        limit = after + datetime.timedelta(days=LOOKAHEAD_DAYS)
+        while when < limit:
+            interval = self.chiming_interval(when.date())
+            minute = when.hour * 60 + when.minute
+            if (interval
+                and interval[0] <= minute <= interval[1]
+                and when.timestamp() - self.lead(when) > after.timestamp()):
+                return when
+            when += datetime.timedelta(minutes=15)
+        return None
+
+    def plan(self, after=None):
+        """Put the next chime on the scheduler, replacing any already planned."""
+        self.cancel()
+        when = self.next_quarter(after or datetime.datetime.now())
+        if when:
+            self.enter(when, self.sound_for(when), self.lead(when))
+
+    def enter(self, when, filename, lead):
+        self.event = self.scheduler.enterabs(when.timestamp() - lead, 1,
+                                             self.strike,
+                                             (when, filename, lead))
+
+    def cancel(self):
+        if self.event:
+            try:
+                self.scheduler.cancel(self.event)
+            except ValueError:
+                pass            # it has already run
+            self.event = None
+
+    def strike(self, when, filename, lead):
+        """Start the chime for the quarter WHEN, lined up with the wall clock.
+        LEAD is how long before the quarter it was planned to start."""
+        self.event = None
+        late = time.time() - (when.timestamp() - lead)
+        if late < -TOLERANCE:
+            # the clock has been changed:
+            self.enter(when, filename, lead)
+            return
+        if (shorter := self.lead(when)) < lead - TOLERANCE:
+            # the sound's length has become known since, and it is shorter than allowed for:
+            self.enter(when, filename, shorter)
+            return
+        late = max(0, late)
+        if late < lead:
+            self.play(filename, late)
+            if late > TOLERANCE:
+                self.log("chime for %s started %.3fs late, skipping in to catch up", when, late)
+        else:
+            self.log("missed chime for %s", when)
+        self.plan(when)
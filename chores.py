@@ -7,9 +7,7 @@ import subprocess
 import sys
 
 from lifehacking_config import config
-import motion_monitor.managed_directory
 import backup_and_archive
-import motion_monitor.motion_monitor
 
 MY_PROJECTS = os.path.dirname(sys.path[0])
 
@@ -38,15 +36,10 @@ def get_args():
     return vars(parser.parse_args())
 
 def nightly_chores():
-    """Do some nightly tasks."""
+    """Do some nightly tasks.
+    The camera clips are kept within their limits continuously by the
+    noticeboard controller's retention engine, so they aren't trimmed here."""
     backup_and_archive.nightly_archive()
-    clips_directory = motion_monitor.motion_monitor.get_clips_directory()
-    removed = motion_monitor.managed_directory.trim_directory(clips_directory,
-                                                              config('motion', 'retain'))
-    keeping = motion_monitor.managed_directory.keep_days_in_directory(clips_directory,
-                                                                      config('motion', 'days'))
-    print('(message "Removed %d files to keep clips directory down to %s and %d because older than %d days")'
-          % (len(removed), config('motion', 'retain'), keeping['deleted'], config('motion', 'days')))
 
 def weekly_chores():
     """Do some weekly tasks."""
@@ -0,0 +1,74 @@
+import os
+import re
+import threading
+import time
+
+# Keep the camera clips directory within its size and age limits
+# continuously, deleting the oldest clips as new ones arrive, using
+# the ClipTracker's records rather than rescanning the directory.
+
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+def parse_size(size):
+    """Convert a size such as "8Gb" or 500000 to a number of bytes."""
+    if isinstance(size, (int, float)):
+        return int(size)
+    matched = re.match(r"\s*([0-9.]+)\s*([kmgt]?)b?\s*$", size.lower())
+    if not matched:
+        raise ValueError("Could not understand size %s" % size)
+    return int(float(matched.group(1)) * SIZE_UNITS[matched.group(2)])
+
+class RetentionEngine(object):
+
+    pass
+
+    def __init__(self, tracker, max_bytes, max_days, log=None):
+        self.tracker = tracker
+        self.max_bytes = parse_size(max_bytes)
+        self.max_days = max_days
+        self.log = log or (lambda message, *message_data: None)
+        self.deleted = 0
+        self.wanted = threading.Event()
+        tracker.listeners.append(self.clip_added)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def clip_added(self, _path, _created, _size):
+        if self.tracker.total_bytes > self.max_bytes:
+            self.wanted.set()
+
+    def set_limits(self, max_bytes=None, max_days=None):
+        """Change the limits, and apply the new ones straight away."""
+        if max_bytes is not None:
+            self.max_bytes = parse_size(max_bytes)
+        if max_days is not None:
+            self.max_days = max_days
+        self.wanted.set()
+
+    def run(self):
+        while True:
+            self.wanted.wait(self.enforce())
+            self.wanted.clear()
+
+    def enforce(self):
+        """Delete the oldest clips until the directory is within its limits.
+        Returns how long until the oldest remaining clip passes the age limit."""
+        while True:
+            oldest = self.tracker.oldest()
+            if oldest is None:
+                return None
+            created, path = oldest
+            expiry = created + self.max_days * 86400
+            if self.tracker.total_bytes <= self.max_bytes and expiry > time.time():
+                return expiry - time.time()
+            try:
+                os.remove(path)
+                self.deleted += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.log("could not remove clip %s: %s", path, e)
+                return 60
+            # don't wait for inotify to tell the tracker:
+            self.tracker.remove(path)
@@ -0,0 +1,150 @@
+import heapq
+import os
+import threading
+import time
+
+import inotify
+
+# Statistics of the camera clips directory, kept up to date from
+# inotify events rather than by rescanning the directory, so that
+# reporting on it costs nothing.
+
+WATCH_MASK = (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO
+              | inotify.IN_DELETE | inotify.IN_MOVED_FROM
+              | inotify.IN_CREATE | inotify.IN_DELETE_SELF)
+
+RESCAN_INTERVAL = 600           # seconds, for when inotify isn't available
+
+class ClipTracker(object):
+
+    pass
+
+    def __init__(self, directory, log=None):
+        self.directory = directory
+        self.log = log or (lambda message, *message_data: None)
+        self.lock = threading.RLock()
+        self.files = {}         # path -> (created, size)
+        self.oldest_heap = []   # (created, path), with stale entries skipped lazily
+        self.newest_clip = None # (created, path)
+        self.total_bytes = 0
+        self.watches = {}       # watch descriptor -> directory
+        self.listeners = []     # called with (path, created, size) for each new clip
+        self.inotify = None
+
+    def start(self):
+        """Scan the directory and follow changes to it, on a background thread."""
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        try:
+            self.inotify = inotify.Inotify()
+        except OSError as e:
+            self.log("no inotify (%s), rescanning clips every %d seconds", e, RESCAN_INTERVAL)
+        while True:
+            self.scan(self.directory)
+            if self.inotify is None:
+                time.sleep(RESCAN_INTERVAL)
+                with self.lock:
+                    self.forget_all()
+                continue
+            while True:
+                events = self.inotify.read()
+                if any(mask & inotify.IN_Q_OVERFLOW for _wd, mask, _cookie, _name in events):
+                    self.log("inotify queue overflowed, rescanning clips")
+                    with self.lock:
+                        for wd in self.watches:
+                            self.inotify.rm_watch(wd)
+                        self.watches = {}
+                        self.forget_all()
+                    break
+                for event in events:
+                    self.handle_event(*event)
+
+    def forget_all(self):
+        self.files = {}
+        self.oldest_heap = []
+        self.newest_clip = None
+        self.total_bytes = 0
+
+    def scan(self, directory):
+        """Record the clips in a directory and its subdirectories, watching them for changes."""
+        if self.inotify:
+            try:
+                self.watches[self.inotify.add_watch(directory, WATCH_MASK)] = directory
+            except OSError as e:
+                self.log("could not watch %s: %s", directory, e)
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                self.scan(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                self.add(entry.path)
+
+    def handle_event(self, wd, mask, _cookie, name):
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        if mask & (inotify.IN_DELETE_SELF | inotify.IN_IGNORED):
+            del self.watches[wd]
+            return
+        path = os.path.join(directory, name)
+        if mask & inotify.IN_ISDIR:
+            if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                self.scan(path)
+            elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                with self.lock:
+                    for clip in [clip for clip in self.files if clip.startswith(path + os.sep)]:
+                        self.remove(clip)
+        elif mask & (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO):
+            self.add(path)
+        elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+            self.remove(path)
+
+    def add(self, path):
+        """Record a new or rewritten clip."""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        created, size = stat.st_mtime, stat.st_size
+        with self.lock:
+            if path in self.files:
+                self.total_bytes -= self.files[path][1]
+            self.files[path] = (created, size)
+            self.total_bytes += size
+            heapq.heappush(self.oldest_heap, (created, path))
+            if self.newest_clip is None or created >= self.newest_clip[0]:
+                self.newest_clip = (created, path)
+        for listener in self.listeners:
+            listener(path, created, size)
+
+    def remove(self, path):
+        """Forget a clip that has been deleted or moved away."""
+        with self.lock:
+            if path not in self.files:
+                return
+            _created, size = self.files.pop(path)
+            self.total_bytes -= size
+            if self.newest_clip and self.newest_clip[1] == path:
+                self.newest_clip = max(((created, clip) for clip, (created, _size) in self.files.items()),
+                                       default=None)
+
+    def oldest(self):
+        """Return the (created, path) of the oldest clip, or None."""
+        with self.lock:
+            while self.oldest_heap:
+                created, path = self.oldest_heap[0]
+                if self.files.get(path, (None,))[0] == created:
+                    return created, path
+                heapq.heappop(self.oldest_heap) # stale: deleted or rewritten since
+            return None
+
+    def newest(self):
+        """Return the (created, path) of the newest clip, or None."""
+        return self.newest_clip
+
+    def count(self):
+        return len(self.files)
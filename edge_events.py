@@ -0,0 +1,78 @@
+import collections
+import fcntl
+import os
+import time
+
+from hardware_backend import GPIO
+
+# Edge-triggered input for the noticeboard sensors.
+
+# RPi.GPIO calls the edge callbacks on its own thread, so the
+# callbacks only record the edge and write a byte into a pipe; the
+# main loop includes the read end of the pipe in its select() call,
+# and handles the edges in its own thread when it wakes up.  Anything
+# that can't wait for that, such as stopping a motor at a limit
+# switch, can be given as a hook to call straight from the callback.
+
+DEFAULT_BOUNCETIME = 50 # milliseconds
+
+class EdgeEvents(object):
+
+    pass
+
+    def __init__(self, watched_pins, bouncetime=DEFAULT_BOUNCETIME, hooks=None):
+        self.pending = collections.deque()
+        self.hooks = hooks or {}    # pin -> function called with the pin on the callback thread
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.watched_pins = []
+        for pin in watched_pins:
+            try:
+                GPIO.add_event_detect(pin, GPIO.BOTH,
+                                      callback=self.edge,
+                                      bouncetime=bouncetime)
+                self.watched_pins.append(pin)
+            except RuntimeError:
+                # some kernels refuse edge detection on some pins;
+                # the caller falls back to polling for those
+                pass
+
+    def fileno(self):
+        """Return the file descriptor to select on, so select() can take this object directly."""
+        return self.read_fd
+
+    def watching(self, pin):
+        """Return whether edges on a pin are being reported."""
+        return pin in self.watched_pins
+
+    def edge(self, pin):
+        """Record an edge.  This is called on the RPi.GPIO callback thread."""
+        if (hook := self.hooks.get(pin)):
+            hook(pin)
+        # the level now, as by the time the loop gets to it the pin may have changed again:
+        self.pending.append((pin, GPIO.input(pin), time.time()))
+        try:
+            os.write(self.write_fd, b'.')
+        except BlockingIOError:
+            pass                # the pipe is full, so the loop is going to wake anyway
+
+    def drain(self):
+        """Return the edges received since the last call, oldest first,
+        as tuples of the pin, its level just after the edge, and the time."""
+        try:
+            while os.read(self.read_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        edges = []
+        while self.pending:
+            edges.append(self.pending.popleft())
+        return edges
+
+    def close(self):
+        for pin in self.watched_pins:
+            GPIO.remove_event_detect(pin)
+        self.watched_pins = []
+        os.close(self.read_fd)
+        os.close(self.write_fd)
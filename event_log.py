@@ -0,0 +1,135 @@
+import mmap
+import os
+import struct
+import threading
+
+# A compact log of sensor and actuator events, kept in a fixed-size
+# file used as a ring, so that it never needs trimming and months of
+# events take a few megabytes.
+
+# The file is a header followed by fixed-size records of (timestamp,
+# sensor, value), and is memory-mapped, so recording an event is a
+# copy into memory and a query is a binary search on the timestamps.
+
+MAGIC = b'NBEV'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIQ8x')     # magic, version, record size, capacity, records written
+RECORD = struct.Struct('<dHxxf')        # timestamp, sensor, value
+
+SENSORS = ['pir', 'tray', 'power', 'speaker', 'lamp', 'temperature', 'fans', 'intruder', 'motion']
+SENSOR_IDS = {name: number for number, name in enumerate(SENSORS, 1)}
+SENSOR_NAMES = {number: name for name, number in SENSOR_IDS.items()}
+
+TRAY_STATES = ['unknown', 'extending', 'retracting', 'extended', 'retracted', 'stalled']
+
+# how to get the sensor and value from each kind of event on the EventBus:
+RECORDED_EVENTS = {
+    'pir': lambda event: ('pir', event['on']),
+    'tray': lambda event: ('tray', TRAY_STATES.index(event['status'])
+                           if event['status'] in TRAY_STATES
+                           else 0),
+    'power': lambda event: ('power', event['on']),
+    'speaker': lambda event: ('speaker', event['on']),
+    'lamp.reached': lambda event: ('lamp', event['brightness']),
+    'temperature': lambda event: ('temperature', event['celsius']),
+    'fans': lambda event: ('fans', event['on']),
+    'motion': lambda event: ('motion', event['on']),
+}
+
+def describe_value(sensor, value):
+    """Return a readable form of a recorded value."""
+    if sensor == 'tray':
+        return TRAY_STATES[int(value)] if 0 <= value < len(TRAY_STATES) else str(value)
+    if sensor in ('pir', 'power', 'speaker', 'fans', 'intruder', 'motion'):
+        return "on" if value else "off"
+    return "%g" % value
+
+class EventLog(object):
+
+    pass
+
+    def __init__(self, filename, capacity=262144):
+        self.filename = filename
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.mapped = None
+        self.written = 0
+
+    def open(self):
+        """Map the log file, making it afresh if it is missing or of a different shape."""
+        size = HEADER.size + self.capacity * RECORD.size
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fresh = os.fstat(fd).st_size != size
+            if not fresh:
+                magic, version, record_size, capacity, written = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+                fresh = (magic, version, record_size, capacity) != (MAGIC, VERSION, RECORD.size, self.capacity)
+            if fresh:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                written = 0
+            self.mapped = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.written = written
+        if fresh:
+            self.write_header()
+
+    def write_header(self):
+        HEADER.pack_into(self.mapped, 0, MAGIC, VERSION, RECORD.size, self.capacity, self.written)
+
+    def close(self):
+        if self.mapped:
+            self.mapped.flush()
+            self.mapped.close()
+            self.mapped = None
+
+    def record(self, sensor, value, when):
+        """Add an event to the log, overwriting the oldest one if the log is full."""
+        if self.mapped is None:
+            return
+        with self.lock:
+            RECORD.pack_into(self.mapped, HEADER.size + (self.written % self.capacity) * RECORD.size,
+                             when, SENSOR_IDS[sensor], float(value))
+            self.written += 1
+            self.write_header()
+
+    def record_event(self, event):
+        """Record an event from the EventBus, if it is one that we keep."""
+        converter = RECORDED_EVENTS.get(event['event'])
+        if converter:
+            sensor, value = converter(event)
+            self.record(sensor, value, event['time'])
+
+    def entry(self, index):
+        """Return the (timestamp, sensor name, value) of the INDEXth event ever written."""
+        when, sensor, value = RECORD.unpack_from(self.mapped,
+                                                 HEADER.size + (index % self.capacity) * RECORD.size)
+        return when, SENSOR_NAMES.get(sensor, str(sensor)), value
+
+    def count(self):
+        return min(self.written, self.capacity)
+
+    def query(self, start=None, end=None, sensors=None):
+        """Return the (timestamp, sensor name, value) of the events between two times, oldest first."""
+        if self.mapped is None:
+            return []
+        with self.lock:
+            first, last = self.written - self.count(), self.written
+            low, high = first, last
+            if start is not None:
+                while low < high:
+                    middle = (low + high) // 2
+                    if self.entry(middle)[0] < start:
+                        low = middle + 1
+                    else:
+                        high = middle
+            found = []
+            for index in range(low, last):
+                when, sensor, value = self.entry(index)
+                if end is not None and when > end:
+                    break
+                if sensors is None or sensor in sensors:
+                    found.append((when, sensor, value))
+            return found
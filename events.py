@@ -0,0 +1,46 @@
+import time
+
+# State-change events from the noticeboard hardware, for anything
+# that wants to follow them (such as clients on the command port)
+# rather than polling for them.
+
+# Topics are dotted names such as "pir", "tray", "lamp" and
+# "audio.start"; subscribing to a topic also gets the topics below it,
+# so "audio" gets both "audio.start" and "audio.stop".
+
+def topic_matches(topic, wanted):
+    return any(topic == prefix or topic.startswith(prefix + ".")
+               for prefix in wanted)
+
+class EventBus(object):
+
+    pass
+
+    def __init__(self, log=None):
+        self.subscribers = []   # (topics or None for all, callback)
+        self.log = log or (lambda message, *message_data: None)
+
+    def subscribe(self, callback, topics=None):
+        """Have CALLBACK called with each event on TOPICS (or on all topics).
+        Returns a token to unsubscribe with.  The callback may be called on
+        any thread that publishes events, so it should be quick."""
+        subscription = (list(topics) if topics else None, callback)
+        self.subscribers.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        if subscription in self.subscribers:
+            self.subscribers.remove(subscription)
+
+    def publish(self, topic, **data):
+        """Send an event to everything subscribed to its topic."""
+        if not self.subscribers:
+            return
+        event = {'event': topic, 'time': time.time(), **data}
+        for topics, callback in list(self.subscribers):
+            if topics is None or topic_matches(topic, topics):
+                # one failing subscriber mustn't stop the others, nor the publisher:
+                try:
+                    callback(event)
+                except Exception as e:
+                    self.log("subscriber %s failed on %s: %s", callback, topic, e)
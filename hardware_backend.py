@@ -0,0 +1,27 @@
+import os
+
+# Which hardware the controller drives: the Pi's own, or a simulation
+# of it, chosen by setting NOTICEBOARD_HARDWARE=sim in the environment.
+
+# Everything that uses the GPIO pins imports GPIO from here, rather
+# than importing RPi.GPIO itself, and the camera gets its classes
+# from camera_classes, so that the whole controller can be run, and
+# measured (see benchmark.py), on any Linux machine.
+
+SIMULATED = os.environ.get("NOTICEBOARD_HARDWARE") == "sim"
+
+if SIMULATED:
+    import sim_gpio as GPIO
+else:
+    import RPi.GPIO as GPIO
+
+def camera_classes():
+    """Return the Picamera2, H264Encoder and FileOutput classes.
+    They are imported on first use, as picamera2 takes a while to import."""
+    if SIMULATED:
+        from sim_camera import Picamera2, H264Encoder, FileOutput
+    else:
+        from picamera2 import Picamera2
+        from picamera2.encoders import H264Encoder
+        from picamera2.outputs import FileOutput
+    return Picamera2, H264Encoder, FileOutput
@@ -1,31 +1,99 @@
-import RPi.GPIO as GPIO
+import time
+
+from hardware_backend import GPIO
+
+# Brightness levels are on a perceived scale of 0 to 100, and a curve
+# maps them to the PWM duty cycle, so that a fade looks even to the
+# eye rather than rushing through the dim end.
+
+def linear_curve(level):
+    return level
+
+def gamma_curve(level, gamma=2.2):
+    return level ** gamma
+
+def perceptual_curve(level):
+    """The inverse of the CIE 1931 lightness function."""
+    lightness = level * 100
+    return (((lightness + 16) / 116) ** 3
+            if lightness > 8
+            else lightness / 903.3)
+
+CURVES = {
+    'linear': linear_curve,
+    'gamma': gamma_curve,
+    'perceptual': perceptual_curve,
+}
+
+def level_for(curve, output):
+    """Return the level that a curve maps to OUTPUT, by bisection, as
+    the curves all rise steadily from 0 to 1."""
+    low, high = 0.0, 1.0
+    for _ in range(32):
+        middle = (low + high) / 2
+        if curve(middle) < output:
+            low = middle
+        else:
+            high = middle
+    return (low + high) / 2
+
+DUTY_DECIMALS = 1               # finer changes of duty cycle aren't sent to the PWM
 
 class Lamp(object):
 
     pass
 
-    def __init__(self, pin):
+    def __init__(self, pin, curve='perceptual'):
         self.gpio = pin
+        self.curve = CURVES[curve]
+        self.fade_curve = None  # a curve given for the current fade only
         self.target = 0
         self.current = 0
+        self.duty = 0
+        self.fade_from = 0
+        self.fade_start = 0
+        self.fade_duration = 0
         self.pwm = GPIO.PWM(self.gpio, 1000)
         GPIO.setup(self.gpio, GPIO.OUT, initial=GPIO.LOW)
 
-    def set(self, brightness):
-        self.target = int(brightness)
-
-    def step(self):
-        if self.current < self.target:
-            if self.current == 0:
-                self.pwm.start(0)
-            self.current += 1
-            self.pwm.ChangeDutyCycle(self.current)
-        elif self.current > self.target:
-            self.current -= 1
-            if self.current == 0:
+    def set(self, brightness, duration=0, curve=None):
+        """Start fading towards BRIGHTNESS, taking DURATION seconds.
+        The fade starts from wherever the lamp is now, even if that's part
+        way through another fade.  CURVE, if given, is used for this
+        fade only, instead of the lamp's own curve."""
+        was_curve = self.fade_curve or self.curve
+        self.fade_curve = CURVES[curve] if curve else None
+        if (self.fade_curve or self.curve) is not was_curve and 0 < self.current < 100:
+            # start from the level on the new curve that gives the
+            # brightness the lamp is at, so it doesn't jump:
+            self.current = 100 * level_for(self.fade_curve or self.curve,
+                                           was_curve(self.current / 100))
+        self.fade_from = self.current
+        self.target = max(0, min(100, float(brightness)))
+        self.fade_start = time.monotonic()
+        self.fade_duration = duration
+
+    def step(self, now=None):
+        """Bring the lamp to the brightness it should have reached by now.
+        The PWM is only updated when the rounded duty cycle changes.
+        Returns whether the fade is still going on."""
+        if not self.changing():
+            return False
+        elapsed = (now or time.monotonic()) - self.fade_start
+        if elapsed >= self.fade_duration:
+            self.current = self.target
+        else:
+            self.current = self.fade_from + (self.target - self.fade_from) * elapsed / self.fade_duration
+        duty = round(100 * (self.fade_curve or self.curve)(self.current / 100), DUTY_DECIMALS)
+        if duty != self.duty:
+            if duty == 0:
                 self.pwm.stop()
+            elif self.duty == 0:
+                self.pwm.start(duty)
             else:
-                self.pwm.ChangeDutyCycle(self.current)
+                self.pwm.ChangeDutyCycle(duty)
+            self.duty = duty
+        return self.changing()
 
     def changing(self):
         return self.current != self.target
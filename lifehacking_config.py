@@ -1,12 +1,31 @@
 #!/usr/bin/python3
 
 import argparse
+import copy
+import functools
 import os
-import yaml
+import pickle
+import re
+import sys
+
+# yaml is imported only when the files have to be parsed, as the
+# cache of the merged configuration usually saves us from that.
 
 source_dir = os.path.dirname(os.path.realpath(__file__))
 
 CONFIGURATION = {}
+CONFIG_VERSION = 0
+SNAPSHOT = None
+
+# for reloading the configuration when its files change:
+LOAD_ARGUMENTS = None
+SOURCE_MTIMES = {}
+RUNTIME_UPDATES = []
+LISTENERS = []
+
+# the merged and expanded configuration, kept from one run to the next:
+CONFIG_CACHE = os.path.expanduser("~/.cache/lifehacking/config.pickle")
+VARIABLE_PATTERN = re.compile(r"\$\{?(\w+)")
 
 # based on https://stackoverflow.com/questions/3232943/update-value-of-a-nested-dictionary-of-varying-depth
 def rec_update(basedict, u):
@@ -28,6 +47,7 @@ def rec_update(basedict, u):
 def load_yaml_files(target_dict, yaml_files):
     """Load several YAML files, merging the data from them."""
     if yaml_files:
+        import yaml
         for yaml_file in yaml_files:
             if yaml_file is None:
                 continue
@@ -129,11 +149,34 @@ HARDCODED_DEFAULT_CONFIG = {
                        "17:30--23:30"],
             'Saturday': ["08:00--23:30"],
             'Sunday': ["08:00--23:30"]},
+        # dates or date ranges, such as "2026-12-24--2027-01-02", with
+        # their intervals or the name of a day to treat them as:
+        'occupancy_exceptions': {},
+        # learning when people are in from PIR activity:
+        'occupancy_learning': {
+            'enabled': False,
+            'file': "~/.cache/noticeboard/occupancy-activity.pickle",
+            'weeks': 4,         # how many weeks of activity to keep
+            'threshold': 3,     # in how many of them a minute must have had activity
+            'spread': 30},      # how many minutes each side of activity to count as occupied
     },
 
     'motion': {
         'retain': "8Gb",
         'days': 31,
+        # the controller's own motion detection, instead of the motion daemon:
+        'detector': {
+            'enabled': True,
+            'directory': "$HOME/motion-clips",
+            # [left, top, right, bottom] as fractions of the frame:
+            'watch': [],        # everywhere, if empty
+            'ignore': [],
+            'pixel_threshold': 25,      # out of 255
+            'changed_fraction': 0.02,   # of the watched pixels
+            'rate': 5,                  # frames per second examined
+            'after': 10,                # seconds to keep recording after motion stops
+            'longest': 300,             # seconds, before starting a new clip
+            'bitrate': 4000000},
     },
 
     'noticeboard': {
@@ -143,19 +186,77 @@ HARDCODED_DEFAULT_CONFIG = {
             'Sunday': "06:00--22:00",
         },
         'pir_log_file': "/var/log/pir",
+        'log': {
+            'file': "~/noticeboard.log",
+            'level': "info",    # or debug, warning, error
+            'json': False,      # write JSON lines instead of plain text
+            'rotate': "size",   # or daily
+            'max_bytes': 1048576,
+            'keep': 5,
+            'flush_interval': 5.0},
+        'event_log': {
+            'file': "~/noticeboard-events.dat",
+            'records': 262144},  # 16 bytes each
+        'metrics': {
+            # for node_exporter's textfile collector; empty to not write it:
+            'file': "/var/lib/prometheus/node-exporter/noticeboard.prom",
+            'interval': 60},
+        # recording inputs and commands, for replay.py; empty to not record:
+        'trace': {
+            'file': ""},
         'command_port': 10101,
+        'lamp_curve': "perceptual",
+        'audio': {
+            'device': "default",
+            'preload': ["$SYNCED/music/Cambridge-chimes-*.ogg"]},
+        'music': {
+            'directory': "~/Music",
+            'index': "~/.cache/noticeboard/music-index.pickle",
+            'refresh': 3600},
+        'chimes': {
+            'hour': "$SYNCED/music/Cambridge-chimes-hour-%02d.ogg",
+            'quarters': ["$SYNCED/music/Cambridge-chimes-first-quarter.ogg",
+                         "$SYNCED/music/Cambridge-chimes-second-quarter.ogg",
+                         "$SYNCED/music/Cambridge-chimes-third-quarter.ogg"],
+            # seconds of ring-out after the final strike of each chime:
+            'tail': 0.0},
+        'temperature': {
+            'interval': 60,     # seconds between readings
+            'fans_on': 35.0,    # degrees C
+            'fans_off': 30.0,
+            'history': 1440},   # how many readings to keep
         'camera': {
             'duration': 180,
-            'directory': "/var/spool/camera"},
+            'directory': "/var/spool/camera",
+            # sizes are strings, as lists in the config files add to the defaults:
+            'main_size': "1920x1080",
+            'lores_size': "320x240",
+            # photos are only kept if they differ from the last one kept:
+            'compare_size': "80x60",
+            'pixel_threshold': 25,      # out of 255
+            'changed_fraction': 0.01,
+            'jpeg_quality': 90,
+            # low-resolution frames kept in memory, to save from before the PIR goes off:
+            'burst': {
+                'enabled': True,
+                'before': 10,   # seconds
+                'rate': 2}},    # frames per second
         'delays': {
             'fast': 0.01,
             'slow': 1.0,
+            'lamp': 0.02,
+            'fade': 1.5,
+            'config_check': 5.0,
             'shine': 2,
             'quench': 10,
             'photo': 3,
             'extend': 4,
-            'retract': 15,
-            'step_max': 200},
+            'retract': 15},
+        'tray': {
+            'travel_time': 8.0, # seconds, usually taken from one end to the other
+            'ramp': 0.5,        # seconds to bring the motor up to full power
+            'stall_margin': 1.5,        # times the travel time, before giving up
+            'pwm_frequency': 100},
     },
 }
 
@@ -168,25 +269,138 @@ def recursive_expand(value):
                         if isinstance(value, list)
                         else value)))
 
+def variables_used(value):
+    """Return the names of the environment variables that expanding a value will use."""
+    if isinstance(value, str):
+        return set(VARIABLE_PATTERN.findall(value)) | ({'HOME'} if value.startswith('~') else set())
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, list):
+        return set().union(*[variables_used(v) for v in value])
+    return set()
+
+def read_cached_config(key):
+    """Return the cached configuration, if it was made from the same files and environment."""
+    try:
+        with open(CONFIG_CACHE, 'rb') as cache_stream:
+            cached = pickle.load(cache_stream)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+        return None
+    if (not isinstance(cached, dict)
+        or cached.get('key') != key
+        or any(os.environ.get(name) != value
+               for name, value in cached['environment'].items())):
+        return None
+    return cached['config']
+
+def write_cached_config(key, unexpanded, config):
+    try:
+        os.makedirs(os.path.dirname(CONFIG_CACHE), exist_ok=True)
+        with open(CONFIG_CACHE + ".new", 'wb') as cache_stream:
+            pickle.dump({'key': key,
+                         'environment': {name: os.environ.get(name)
+                                         for name in variables_used(unexpanded)},
+                         'config': config},
+                        cache_stream)
+        os.replace(CONFIG_CACHE + ".new", CONFIG_CACHE)
+    except OSError as e:
+        print("Could not cache configuration:", e, file=sys.stderr)
+
 def load_config(no_hardcoded_default=False,
                 no_main_config=False,
                 main_config_file=os.path.join(source_dir, "config.yaml"),
-                config_files=[]):
+                config_files=[],
+                use_cache=True):
+
+    global CONFIGURATION, LOAD_ARGUMENTS, SOURCE_MTIMES
+
+    LOAD_ARGUMENTS = (no_hardcoded_default, no_main_config, main_config_file, config_files)
+    SOURCE_MTIMES = source_mtimes()
+
+    # the hardcoded defaults are part of this file, so it is one of the sources:
+    key = (LOAD_ARGUMENTS, SOURCE_MTIMES, os.stat(__file__).st_mtime)
+    config = read_cached_config(key) if use_cache else None
 
-    global CONFIGURATION
+    if config is None:
+        config = {} if no_hardcoded_default else copy.deepcopy(HARDCODED_DEFAULT_CONFIG)
 
-    config = {} if no_hardcoded_default else HARDCODED_DEFAULT_CONFIG
+        if not no_main_config:
+            import yaml
+            with open(main_config_file) as yaml_stream:
+                rec_update(config, yaml.safe_load(yaml_stream))
 
-    if not no_main_config:
-        with open(main_config_file) as yaml_stream:
-            rec_update(config, yaml.safe_load(yaml_stream))
+        load_yaml_files(config, config_files)
 
-    load_yaml_files(config, config_files)
+        expanded = recursive_expand(config)
+        if use_cache:
+            write_cached_config(key, config, expanded)
+        config = expanded
 
-    CONFIGURATION = recursive_expand(config)
+    for update in RUNTIME_UPDATES:
+        rec_update(config, recursive_expand(update))
+
+    CONFIGURATION = config
+    changed()
 
     return CONFIGURATION
 
+def source_files():
+    """Return the files the configuration was loaded from."""
+    if LOAD_ARGUMENTS is None:
+        return []
+    _no_hardcoded_default, no_main_config, main_config_file, config_files = LOAD_ARGUMENTS
+    return (([] if no_main_config else [main_config_file])
+            + [config_file for config_file in (config_files or []) if config_file])
+
+def source_mtimes():
+    return {filename: (os.stat(filename).st_mtime if os.path.exists(filename) else None)
+            for filename in source_files()}
+
+def changed_keys(old, new, path=()):
+    """Return the key paths whose values differ between two configurations."""
+    if isinstance(old, dict) and isinstance(new, dict):
+        return [changed
+                for key in old.keys() | new.keys()
+                for changed in changed_keys(old.get(key), new.get(key), path + (key,))]
+    return [] if old == new else [path]
+
+def add_config_listener(callback, *keys):
+    """Have CALLBACK called with the list of changed key paths, whenever
+    the configuration under KEYS changes (given as for config())."""
+    if len(keys) == 1 and ':' in keys[0]:
+        keys = split_key(keys[0])
+    LISTENERS.append((tuple(keys), callback))
+
+def notify(old, new):
+    changes = changed_keys(old, new)
+    if not changes:
+        return changes
+    for keys, callback in LISTENERS:
+        relevant = [change
+                    for change in changes
+                    if change[:len(keys)] == keys or keys[:len(change)] == change]
+        if relevant:
+            callback(relevant)
+    return changes
+
+def reload_if_changed():
+    """Reload the configuration if any of its files have changed since it was loaded.
+    Settings changed through update_config are applied again on top of
+    the reloaded files.  Returns the key paths that changed."""
+    if LOAD_ARGUMENTS is None or source_mtimes() == SOURCE_MTIMES:
+        return []
+    import yaml
+    old = CONFIGURATION
+    try:
+        load_config(*LOAD_ARGUMENTS)
+    except (OSError, yaml.YAMLError) as e:
+        # this leaves the old configuration in place, and the new
+        # mtimes recorded, so we don't keep trying to read the file
+        # until it changes again:
+        print("Could not reload configuration, keeping the old one:", e, file=sys.stderr)
+        return []
+    return notify(old, CONFIGURATION)
+
 def lookup(config, *keys):
     for key in keys:
         if key not in config:
@@ -202,6 +416,10 @@ def override(config, keys, value):
             config[key] = {}
     config[keys[-1]] = value
 
+@functools.lru_cache(maxsize=256)
+def split_key(key):
+    return tuple(key.split(':'))
+
 def config(*keys):
     """Look up a configuration setting.
     A hierarchical specification may be given as multiple string arguments,
@@ -209,11 +427,97 @@ def config(*keys):
     if not CONFIGURATION:
         load_config()
     if len(keys) == 1 and ':' in keys[0]:
-        keys = keys[0].split(':')
+        keys = split_key(keys[0])
     return lookup(CONFIGURATION, *keys)
 
 def update_config(incoming):
-    rec_update(CONFIGURATION, incoming)
+    """Merge some settings into the configuration.
+    They are kept, to be applied again if the configuration is reloaded."""
+    if incoming:
+        old = copy.deepcopy(CONFIGURATION)
+        rec_update(CONFIGURATION, incoming)
+        RUNTIME_UPDATES.append(incoming)
+        changed()
+        notify(old, CONFIGURATION)
+
+def changed():
+    """Note that the configuration has changed, so that snapshots of it get remade."""
+    global CONFIG_VERSION
+    CONFIG_VERSION += 1
+
+class ConfigSnapshot(object):
+
+    """An immutable copy of part of the configuration, as it was at one version.
+    Sections and settings are available as attributes (with '_' in place of
+    '-' in their names), or through the typed accessors, which take keys in
+    the same ways as config()."""
+
+    pass
+
+    def __init__(self, settings, version):
+        frozen = {key: freeze(value, version) for key, value in settings.items()}
+        object.__setattr__(self, '_settings', frozen)
+        object.__setattr__(self, 'version', version)
+        for key, value in frozen.items():
+            name = str(key).replace('-', '_')
+            if not hasattr(ConfigSnapshot, name):
+                # ordinary instance attributes, for the sake of speed:
+                object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise TypeError("configuration snapshots are read-only; use update_config")
+
+    def __getitem__(self, key):
+        return self._settings[key]
+
+    def __contains__(self, key):
+        return key in self._settings
+
+    def keys(self):
+        return self._settings.keys()
+
+    def get(self, *keys):
+        """Look up a setting, returning None if it is not there."""
+        if len(keys) == 1 and ':' in keys[0]:
+            keys = split_key(keys[0])
+        value = self
+        for key in keys:
+            if not isinstance(value, ConfigSnapshot) or key not in value._settings:
+                return None
+            value = value._settings[key]
+        return value
+
+    def integer(self, *keys):
+        return int(self.get(*keys))
+
+    def number(self, *keys):
+        return float(self.get(*keys))
+
+    def flag(self, *keys):
+        value = self.get(*keys)
+        return value if isinstance(value, bool) else str(value).lower() in ('true', 'yes', 'on', '1')
+
+    def string(self, *keys):
+        value = self.get(*keys)
+        return None if value is None else str(value)
+
+def freeze(value, version):
+    return (ConfigSnapshot(value, version)
+            if isinstance(value, dict)
+            else (tuple(freeze(v, version) for v in value)
+                  if isinstance(value, list)
+                  else value))
+
+def compiled_config():
+    """Return a snapshot of the whole configuration.
+    This is cheap enough for hot loops, as the snapshot is only remade
+    after the configuration has changed."""
+    global SNAPSHOT
+    if not CONFIGURATION:
+        load_config()
+    if SNAPSHOT is None or SNAPSHOT.version != CONFIG_VERSION:
+        SNAPSHOT = ConfigSnapshot(CONFIGURATION, CONFIG_VERSION)
+    return SNAPSHOT
 
 def file_config(*keys):
     return os.path.expanduser(os.path.expandvars(config(*keys)))
@@ -229,6 +533,8 @@ def main():
     parser.add_argument("--config-file", "-c",
                         action='append')
     parser.add_argument("--show-all", "-a", action='store_true')
+    parser.add_argument("--no-cache", action='store_true',
+                        help="""Read the config files even if they haven't changed.""")
     parser.add_argument("--override", "-o", nargs=2, action='append',
                         help="""Override a value.  The parts of the key are colon-separated.""")
     parser.add_argument("keys", nargs='*')
@@ -237,7 +543,8 @@ def main():
     config = load_config(args.no_hardcoded_default,
                          args.no_main_config,
                          args.main_config_file,
-                         args.config_file)
+                         args.config_file,
+                         not args.no_cache)
 
     if args.override:
         for overrider in args.override:
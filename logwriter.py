@@ -0,0 +1,154 @@
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+
+# Logging for the controller, without putting file writes in its loop.
+
+# Messages at or above the current level go into a bounded queue,
+# unformatted, and a background thread formats and writes them in
+# batches, flushing once per batch rather than once per message, which
+# saves the SD card from a write for each line.  Messages below the
+# level are dropped before anything is done with them.  The log file
+# is rotated when it reaches a size, or each day.
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {number: name for name, number in LEVELS.items()}
+
+class LogWriter(object):
+
+    pass
+
+    def __init__(self, filename, level=INFO, json_lines=False,
+                 rotate='size', max_bytes=1024 * 1024, keep=5,
+                 flush_interval=5.0, queue_length=1024):
+        self.filename = filename
+        self.level = level
+        self.json_lines = json_lines
+        self.rotate = rotate
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.flush_interval = flush_interval
+        self.messages = queue.Queue(queue_length)
+        self.dropped = 0
+        self.stream = None
+        self.opened_on = None
+        self.writer = None
+
+    def start(self):
+        self.open()
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    def open(self):
+        if self.filename:
+            os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+            self.stream = open(self.filename, 'a')
+            self.opened_on = datetime.date.today()
+
+    def log(self, level, message, *message_data):
+        """Queue a message for writing, if it is at or above the current level."""
+        if level < self.level:
+            return
+        if self.writer is None:
+            print(self.format(time.time(), level, message, message_data))
+            return
+        try:
+            self.messages.put_nowait((time.time(), level, message, message_data))
+        except queue.Full:
+            self.dropped += 1
+
+    def format(self, when, level, message, message_data):
+        text = message % message_data if message_data else message
+        stamp = datetime.datetime.fromtimestamp(when).isoformat()
+        if self.json_lines:
+            return json.dumps({'time': stamp, 'level': LEVEL_NAMES.get(level, level), 'message': text})
+        return stamp + ": " + text
+
+    def run(self):
+        finished = False
+        while not finished:
+            batch = [self.messages.get()]
+            # let more messages gather, so they are written together,
+            # unless there's an error, which should get out at once:
+            deadline = time.monotonic() + self.flush_interval
+            while (batch[-1] is not None
+                   and batch[-1][1] < ERROR
+                   and (remaining := deadline - time.monotonic()) > 0):
+                try:
+                    batch.append(self.messages.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                finished = True
+                batch.pop()
+            try:
+                self.write(batch)
+            except Exception as e:
+                # the writer must keep going, or the queue fills and
+                # every later message is dropped:
+                print("Could not write log:", e)
+
+    def write(self, batch):
+        lines = []
+        for entry in batch:
+            try:
+                lines.append(self.format(*entry) + "\n")
+            except (TypeError, ValueError) as e:
+                lines.append("bad log message %r: %s\n" % (entry[2], e))
+        if self.dropped:
+            lines.append(self.format(time.time(), WARNING, "%d log messages dropped", (self.dropped,)) + "\n")
+            self.dropped = 0
+        if self.stream is None:
+            print("".join(lines), end="")
+            return
+        try:
+            self.stream.write("".join(lines))
+            self.stream.flush()
+            if self.due_for_rotation():
+                self.rotate_files()
+        except OSError as e:
+            print("Could not write log:", e)
+
+    def due_for_rotation(self):
+        if self.rotate == 'daily':
+            return datetime.date.today() != self.opened_on
+        return self.stream.tell() >= self.max_bytes
+
+    def rotate_files(self):
+        """Move the log to filename.1, and the older ones along, dropping the oldest."""
+        self.stream.close()
+        try:
+            for generation in range(self.keep - 1, 0, -1):
+                older = "%s.%d" % (self.filename, generation)
+                if os.path.exists(older):
+                    os.replace(older, "%s.%d" % (self.filename, generation + 1))
+            if self.keep:
+                os.replace(self.filename, self.filename + ".1")
+            else:
+                os.remove(self.filename)
+        finally:
+            # carry on in the same file if it couldn't be moved, or on
+            # stdout if it can't be opened at all:
+            try:
+                self.open()
+            except OSError as e:
+                self.stream = None
+                print("Could not reopen log:", e)
+
+    def close(self):
+        """Write any queued messages, and stop the writer."""
+        if self.writer:
+            self.messages.put(None)
+            self.writer.join()
+            self.writer = None
+        if self.stream:
+            self.stream.close()
+            self.stream = None
@@ -0,0 +1,156 @@
+import contextlib
+import math
+import os
+import subprocess
+import time
+
+# Counters and timing histograms for seeing how the controller is
+# doing, shown by the "metrics" command and written periodically as a
+# Prometheus text file for node_exporter's textfile collector.
+
+# The histograms are in the style of HdrHistogram: each power of two
+# is split into a fixed number of linear sub-buckets, so recording is
+# a little arithmetic and an increment, the memory is fixed, and the
+# percentiles are accurate to within the sub-bucket width (about 6%
+# with 16 sub-buckets) across the whole range from microseconds to
+# minutes.  Updates aren't locked; an occasional lost count from two
+# threads recording at once doesn't matter for this.
+
+SUB_BUCKETS = 16
+QUANTILES = [0.5, 0.9, 0.99]
+
+class Counter(object):
+
+    pass
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def report(self):
+        return "%s: %g" % (self.name, self.value)
+
+    def prometheus(self):
+        return ["# HELP %s %s" % (self.name, self.description),
+                "# TYPE %s counter" % self.name,
+                "%s %r" % (self.name, float(self.value))]
+
+class Histogram(object):
+
+    pass
+
+    def __init__(self, name, description, lowest=1e-6, highest=1000.0):
+        self.name = name
+        self.description = description
+        self.lowest = lowest
+        self.octaves = math.ceil(math.log2(highest / lowest))
+        self.buckets = [0] * (self.octaves * SUB_BUCKETS + 2)
+        self.count = 0
+        self.total = 0.0
+        self.largest = 0.0
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.largest:
+            self.largest = value
+        if value <= self.lowest:
+            index = 0
+        else:
+            mantissa, exponent = math.frexp(value / self.lowest)
+            index = min((exponent - 1) * SUB_BUCKETS + int((2 * mantissa - 1) * SUB_BUCKETS) + 1,
+                        len(self.buckets) - 1)
+        self.buckets[index] += 1
+
+    @contextlib.contextmanager
+    def time(self):
+        """Record how long the body of a with statement takes."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(time.perf_counter() - started)
+
+    def upper_bound(self, index):
+        if index == 0:
+            return self.lowest
+        if index == len(self.buckets) - 1:
+            return self.largest # the values beyond the highest
+        octave, sub_bucket = divmod(index - 1, SUB_BUCKETS)
+        return self.lowest * 2 ** octave * (1 + (sub_bucket + 1) / SUB_BUCKETS)
+
+    def percentile(self, fraction):
+        """Return the value below which FRACTION of the recorded values fall."""
+        if not self.count:
+            return 0.0
+        wanted = fraction * self.count
+        seen = 0
+        for index, in_bucket in enumerate(self.buckets):
+            seen += in_bucket
+            if seen >= wanted:
+                return min(self.upper_bound(index), self.largest)
+        return self.largest
+
+    def report(self):
+        if not self.count:
+            return "%s: none" % self.name
+        return "%s: %d, mean %s, %s, max %s" % (
+            self.name, self.count,
+            seconds(self.total / self.count),
+            ", ".join("p%g %s" % (quantile * 100, seconds(self.percentile(quantile)))
+                      for quantile in QUANTILES),
+            seconds(self.largest))
+
+    def prometheus(self):
+        return (["# HELP %s %s" % (self.name, self.description),
+                 "# TYPE %s summary" % self.name]
+                + ['%s{quantile="%g"} %r' % (self.name, quantile, self.percentile(quantile))
+                   for quantile in QUANTILES]
+                + ["%s_sum %r" % (self.name, self.total),
+                   "%s_count %d" % (self.name, self.count)])
+
+def seconds(value):
+    """Show a duration in convenient units."""
+    if value >= 1:
+        return "%.2fs" % value
+    if value >= 1e-3:
+        return "%.2fms" % (value * 1e3)
+    return "%.1fus" % (value * 1e6)
+
+METRICS = {}                    # name -> Counter or Histogram
+
+def counter(name, description):
+    """Return the counter called NAME, making it if need be."""
+    return METRICS.setdefault(name, Counter(name, description))
+
+def histogram(name, description, **limits):
+    """Return the histogram called NAME, making it if need be."""
+    return METRICS.setdefault(name, Histogram(name, description, **limits))
+
+def report():
+    return [METRICS[name].report() for name in sorted(METRICS)]
+
+def prometheus():
+    return "".join(line + "\n"
+                   for name in sorted(METRICS)
+                   for line in METRICS[name].prometheus())
+
+def write_textfile(filename):
+    """Write the metrics for the textfile collector, replacing the file atomically."""
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    temporary = filename + ".new"
+    with open(temporary, 'w') as outstream:
+        outstream.write(prometheus())
+    os.replace(temporary, filename)
+
+LAUNCH_TIME = histogram("noticeboard_subprocess_launch_seconds",
+                        "Time taken to start each subprocess.")
+
+def popen(*args, **kwargs):
+    """Start a subprocess with subprocess.Popen, recording how long that took."""
+    with LAUNCH_TIME.time():
+        return subprocess.Popen(*args, **kwargs)
@@ -0,0 +1,145 @@
+import datetime
+import os
+import threading
+import time
+
+from camera import RETRY_LONGEST, RETRY_SHORTEST
+from photo_pipeline import downscale
+
+# Detecting motion in the camera's view, and recording clips of it,
+# within the controller rather than with a separate motion daemon
+# competing for the camera.
+
+# Frames from the low-resolution stream are shrunk and compared with a
+# slowly-updated average of the recent ones.  Motion is when enough of
+# the pixels in the watched regions differ from the average.  Clips
+# are recorded from the full-size stream with the hardware H.264
+# encoder, from the first motion until a few seconds after the last.
+
+def region_mask(size, watch, ignore):
+    """Make a boolean mask of the pixels to look for motion in.
+    WATCH and IGNORE are lists of [left, top, right, bottom] as fractions
+    of the frame; with no WATCH regions, the whole frame is watched."""
+    import numpy
+    width, height = size
+    def box(region):
+        left, top, right, bottom = region
+        return (slice(int(top * height), max(int(top * height) + 1, int(bottom * height))),
+                slice(int(left * width), max(int(left * width) + 1, int(right * width))))
+    mask = numpy.zeros((height, width), dtype=bool)
+    for region in watch or [[0, 0, 1, 1]]:
+        mask[box(region)] = True
+    for region in ignore or []:
+        mask[box(region)] = False
+    return mask
+
+class MotionDetector(object):
+
+    pass
+
+    def __init__(self, camera, directory,
+                 watch=None, ignore=None,
+                 compare_size=(80, 60), pixel_threshold=25, changed_fraction=0.02,
+                 rate=5, adaptation=0.05, after=10, longest=300, bitrate=4000000,
+                 on_motion=None, log=None):
+        self.camera = camera
+        self.directory = directory
+        self.compare_size = tuple(compare_size)
+        self.pixel_threshold = pixel_threshold
+        self.changed_fraction = changed_fraction
+        self.rate = rate
+        self.adaptation = adaptation
+        self.after = after
+        self.longest = longest
+        self.bitrate = bitrate
+        self.on_motion = on_motion or (lambda moving: None)
+        self.log = log or (lambda message, *message_data: None)
+        self.set_regions(watch, ignore)
+        self.background = None
+        self.moving = False
+        self.last_motion = 0
+        self.recording = None   # (filename, started)
+        self.clips = 0
+
+    def set_regions(self, watch, ignore):
+        self.watch = watch
+        self.ignore = ignore
+        self.mask = None        # made from the regions when the first frame arrives
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        due = time.time()
+        retry = RETRY_SHORTEST
+        while True:
+            try:
+                self.examine(self.camera.capture_lores(), time.time())
+                retry = RETRY_SHORTEST
+            except ImportError as e:
+                self.log("motion detection stopped, no camera: %s", e)
+                return
+            except Exception as e:
+                # such as a libcamera timeout; the house mustn't go unwatched for the rest of the run:
+                self.log("motion detection failed, trying again in %g seconds: %s", retry, e)
+                try:
+                    self.stop_recording()
+                except Exception as e:
+                    self.log("could not stop recording: %s", e)
+                    self.recording = None
+                time.sleep(retry)
+                retry = min(retry * 2, RETRY_LONGEST)
+                due = time.time()
+                continue
+            due = max(due + 1 / self.rate, time.time())
+            time.sleep(max(0, due - time.time()))
+
+    def changed(self, frame):
+        """Return the fraction of the watched pixels that differ from the background,
+        and update the background."""
+        small = downscale(frame, self.compare_size)
+        if self.background is None or self.background.shape != small.shape:
+            self.background = small
+            self.mask = None
+            return 0.0
+        if self.mask is None:
+            self.mask = region_mask(self.compare_size, self.watch, self.ignore)
+        differing = (abs(small - self.background) > self.pixel_threshold) & self.mask
+        self.background += self.adaptation * (small - self.background)
+        return float(differing.sum()) / max(1, int(self.mask.sum()))
+
+    def examine(self, frame, now):
+        """Look for motion in a frame, starting or stopping recording as needed."""
+        if self.changed(frame) >= self.changed_fraction:
+            self.last_motion = now
+            if not self.moving:
+                self.moving = True
+                self.on_motion(True)
+            if self.recording is None:
+                self.start_recording(now)
+        elif self.moving and now - self.last_motion > self.after:
+            self.moving = False
+            self.on_motion(False)
+        if self.recording:
+            _filename, started = self.recording
+            if not self.moving or now - started > self.longest:
+                # a long clip is split, and carries on in a new one while motion continues:
+                self.stop_recording()
+                if self.moving:
+                    self.start_recording(now)
+
+    def start_recording(self, now):
+        when = datetime.datetime.fromtimestamp(now)
+        day_directory = os.path.join(self.directory, when.date().isoformat())
+        os.makedirs(day_directory, exist_ok=True)
+        filename = os.path.join(day_directory, when.strftime("%H-%M-%S") + ".h264")
+        self.camera.start_recording(filename, self.bitrate)
+        self.recording = (filename, now)
+        self.clips += 1
+        self.log("motion detected, recording %s", filename)
+
+    def stop_recording(self):
+        if self.recording:
+            self.camera.stop_recording()
+            self.log("finished recording %s", self.recording[0])
+            self.recording = None
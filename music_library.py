@@ -0,0 +1,176 @@
+import os
+import pickle
+import re
+import threading
+
+from collections import defaultdict
+
+# An index of the music files, kept on disk between runs.
+
+# The index records each directory's mtime, so a refresh only lists
+# the directories that have had files added, removed or renamed
+# since the index was made.  Lookups go through an inverted index of
+# the words in the track names, and a trigram index for substrings
+# and approximate matches.
+
+INDEX_VERSION = 1
+FUZZY_THRESHOLD = 0.3
+FUZZY_LIMIT = 10
+
+def track_name(filename):
+    """Make the name a track is looked up by, from its filename."""
+    base = os.path.splitext(filename)[0].lower().replace('_', ' ')
+    if (m := re.match("[0-9]+[._-](.+)", base)):
+        base = m.group(1)
+    return base
+
+def trigrams(text):
+    padded = "  " + text + " "
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+class MusicLibrary(object):
+
+    pass
+
+    def __init__(self, root, index_file=None, log=None):
+        self.root = root
+        self.index_file = index_file
+        self.log = log or (lambda message, *message_data: None)
+        self.directories = {}   # path -> (mtime, {name: path}, [subdirectories])
+        self.tracks = {}        # name -> path
+        self.words = {}         # word -> set of names
+        self.trigrams = {}      # trigram -> set of names
+        self.refreshing = threading.Lock()
+
+    def load(self):
+        """Load the index saved by a previous run, if there is one."""
+        if self.index_file and os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, 'rb') as instream:
+                    version, root, directories = pickle.load(instream)
+                if version == INDEX_VERSION and root == self.root:
+                    self.directories = directories
+                    self.build_indexes()
+            except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+                pass            # it will be remade by the next refresh
+
+    def save(self):
+        if self.index_file:
+            os.makedirs(os.path.dirname(self.index_file), exist_ok=True)
+            temporary = self.index_file + ".new"
+            with open(temporary, 'wb') as outstream:
+                pickle.dump((INDEX_VERSION, self.root, self.directories), outstream)
+            os.replace(temporary, self.index_file)
+
+    def scan_directory(self, directory, old, new):
+        """Bring the entry for a directory and those below it up to date,
+        reusing entries from OLD for directories that haven't changed.
+        Returns whether anything had changed."""
+        try:
+            mtime = os.stat(directory).st_mtime
+        except OSError:
+            return True
+        changed = False
+        if directory in old and old[directory][0] == mtime:
+            new[directory] = old[directory]
+        else:
+            tracks = {}
+            subdirectories = []
+            try:
+                entries = list(os.scandir(directory))
+            except OSError as e:
+                # such as an unreadable directory, or a USB stick half
+                # mounted; keep what we had, and try again next time:
+                self.log("could not list music directory %s: %s", directory, e)
+                if directory not in old:
+                    return False
+                entries = None
+            for entry in entries or []:
+                if entry.name.startswith('.'):
+                    continue
+                try:
+                    if entry.is_file() and entry.name.endswith('.ogg') and 'conflict' not in entry.name:
+                        tracks[track_name(entry.name)] = entry.path
+                    elif entry.is_dir():
+                        subdirectories.append(entry.path)
+                except OSError as e:
+                    self.log("could not look at %s: %s", entry.path, e)
+            if entries is None:
+                # marked as out of date, so the next refresh lists it again:
+                new[directory] = (None,) + old[directory][1:]
+            else:
+                new[directory] = (mtime, tracks, subdirectories)
+                changed = True
+        for subdirectory in new[directory][2]:
+            changed = self.scan_directory(subdirectory, old, new) or changed
+        return changed
+
+    def refresh(self):
+        """Bring the index up to date with the music directory, saving it if anything changed."""
+        with self.refreshing:
+            directories = {}
+            changed = self.scan_directory(self.root, self.directories, directories)
+            if changed or len(directories) != len(self.directories):
+                self.directories = directories
+                self.build_indexes()
+                try:
+                    self.save()
+                except OSError as e:
+                    self.log("could not save music index %s: %s", self.index_file, e)
+
+    def refresh_in_background(self):
+        threading.Thread(target=self.refresh, daemon=True).start()
+
+    def build_indexes(self):
+        tracks = {}
+        for _mtime, directory_tracks, _subdirectories in self.directories.values():
+            tracks.update(directory_tracks)
+        words = defaultdict(set)
+        grams = defaultdict(set)
+        for name in tracks:
+            for word in name.split():
+                words[word].add(name)
+            for gram in trigrams(name):
+                grams[gram].add(name)
+        # replace them all at once, for the sake of lookups on other threads:
+        self.tracks, self.words, self.trigrams = tracks, dict(words), dict(grams)
+
+    def matching_word(self, word):
+        """Return the names containing a string."""
+        if len(word) < 3:
+            # too short for the trigrams, so look through the words instead:
+            return {name
+                    for indexed_word, names in self.words.items()
+                    if word in indexed_word
+                    for name in names}
+        postings = sorted((self.trigrams.get(word[i:i+3], set()) for i in range(len(word) - 2)),
+                          key=len)
+        return {name for name in set.intersection(*postings) if word in name}
+
+    def fuzzy(self, text):
+        """Return the names most like some text, best first."""
+        wanted = trigrams(text)
+        scores = defaultdict(int)
+        for gram in wanted:
+            for name in self.trigrams.get(gram, ()):
+                scores[name] += 1
+        ranked = sorted(((count / len(wanted | trigrams(name)), name)
+                         for name, count in scores.items()),
+                        reverse=True)
+        return [name for score, name in ranked[:FUZZY_LIMIT] if score >= FUZZY_THRESHOLD]
+
+    def find(self, partial_name):
+        """Return the files of the tracks whose names contain all the words of PARTIAL_NAME.
+        If there are none, return those whose names are close to it."""
+        partial_name = partial_name.lower().replace('_', ' ')
+        if partial_name in self.tracks:
+            return [self.tracks[partial_name]]
+        words = partial_name.split()
+        if not words:
+            return []
+        names = None
+        for word in sorted(words, key=len, reverse=True):
+            names = self.matching_word(word) if names is None else names & self.matching_word(word)
+            if not names:
+                return [self.tracks[name] for name in self.fuzzy(partial_name)]
+        return [self.tracks[name] for name in sorted(names)]
@@ -12,37 +12,34 @@
 import os
 os.chdir("/tmp")
 
+import startup_profile
+
+import argparse
+import asyncio
 import contextlib
 import datetime
 import io
-import re
-import sched
-import select
-import socket
 import sys
 import time
 import traceback
 
+startup_profile.stage("standard library imports")
 from timetable_announcer import announce
+startup_profile.stage("importing timetable_announcer")
 from noticeboardhardware import NoticeBoardHardware
-from lifehacking_config import config, update_config
+startup_profile.stage("importing noticeboardhardware")
+from audio_queue import CHIME
+from chimes import ChimeScheduler
+from occupancy import Occupancy, convert_intervals
+from sensor_trace import TracedScheduler
+import protocol
+from lifehacking_config import config, compiled_config, add_config_listener, reload_if_changed
 import archive
+import metrics
+startup_profile.stage("other imports")
 
 camera = None
 
-def convert_interval(interval_string):
-    """Convert a string giving start and end times into a tuple of minutes after midnight.
-    For the input "07:30--09:15" the output would be (450, 555)."""
-    matched = re.match("([0-2][0-9]):([0-5][0-9])--([0-2][0-9]):([0-5][0-9])", interval_string)
-    return (((int(matched.group(1))*60 + int(matched.group(2))),
-             (int(matched.group(3))*60 + int(matched.group(4))))
-            if matched
-            else None)
-
-def convert_intervals(intervals):
-    """Convert a dictionary of intervals."""
-    return {k: convert_interval(v) for k, v in intervals.items()}
-
 manual_at_home = False
 manual_away = False
 
@@ -55,140 +52,432 @@ def expected_at_home():
         return True
     if manual_away:
         return False
-    when = datetime.datetime.now()
-    what_time = when.hour * 60 + when.minute
-    for interval in expected_at_home_times[['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'][when.weekday()]]:
-        if interval is None:
-            continue
-        if what_time >= interval[0] and what_time <= interval[1]:
-            return True
-    return False
+    return occupancy.expected()
 
 photographing_duration = None
-photographing = False
 
-def handle_possible_intruder():
+def handle_possible_intruder(controller):
     """Actions to be taken when the PIR detects someone when no-one is expected to be in the house."""
-    global photographing
     when = datetime.datetime.now()
-    photographing = when + photographing_duration
-    with open(config('noticeboard', 'pir_log_file'), 'w+') as logfile:
-        logfile.write(datetime.datetime.now().isoformat() + "\n")
+    # save the frames from just before, and keep saving them for a while:
+    controller.bursts.trigger(photographing_duration.total_seconds())
+    controller.event_log.record('intruder', 1, when.timestamp())
+    try:
+        with open(config('noticeboard', 'pir_log_file'), 'a') as logfile:
+            logfile.write(when.isoformat() + "\n")
+    except OSError as e:
+        print('(message "Could not write to PIR log: %s")' % e)
     # todo: send a remote notification e.g. email with the picture
 
+def occupancy_settings():
+    """Return the expected occupancy settings from the config, as keyword arguments for Occupancy."""
+    learning = config('house', 'occupancy_learning')
+    return {'timetable': config('house', 'expected_occupancy'),
+            'exceptions': config('house', 'occupancy_exceptions'),
+            'learning': learning['enabled'],
+            'activity_file': learning['file'],
+            'weeks': learning['weeks'],
+            'threshold': learning['threshold'],
+            'spread': learning['spread']}
+
+def set_pir_actions(controller):
+    """Set up the commands the PIR runs, with their delays from the config."""
+    controller.pir_on_actions.clear()
+    controller.pir_off_actions.clear()
+    for on_action in [
+            'shine',
+            # 'photo',
+            # 'extend',
+    ]:
+        controller.add_pir_on_action(config('noticeboard', 'delays', on_action), on_action)
+    for off_action in [
+            'quench',
+            # 'retract',
+    ]:
+        controller.add_pir_off_action(config('noticeboard', 'delays', off_action), off_action)
+
+def chime_settings():
+    """Return the chiming settings from the config, as keyword arguments for ChimeScheduler."""
+    return {'chiming_times': convert_intervals(config('noticeboard', 'chiming_times')),
+            'hour_template': config('noticeboard', 'chimes', 'hour'),
+            'quarter_files': config('noticeboard', 'chimes', 'quarters'),
+            'tail': config('noticeboard', 'chimes', 'tail')}
+
 def main():
     """Interface to the hardware of my noticeboard.
     This is meant for my noticeboard Emacs software to send commands to."""
-    global expected_at_home_times
-    expected_at_home_times = {day: [convert_interval(interval_string)
-                                    for interval_string in interval_string_list]
-                              for day, interval_string_list in config('house', 'expected_occupancy').items()}
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--startup-profile", action='store_true',
+                        help="""Report how long each stage of starting up took.""")
+    args = parser.parse_args()
+    global occupancy
+    occupancy = Occupancy(**occupancy_settings())
+    occupancy.load()
+    startup_profile.stage("loading config")
     print('(message "noticeboard hardware controller starting")')
     verbose = False
-    global photographing
     global photographing_duration
     photographing_duration = datetime.timedelta(0, config('noticeboard', 'camera', 'duration'))
 
-    scheduler = sched.scheduler(time.time, time.sleep)
+    scheduler = TracedScheduler(time.time, time.sleep)
     controller = NoticeBoardHardware(scheduler=scheduler,
-                                     expected_at_home_times=expected_at_home_times,
+                                     occupancy=occupancy,
                                      verbose=verbose)
+    startup_profile.stage("starting controller")
     announcer = announce.Announcer(scheduler=scheduler,
                                    announce=lambda contr, message, **kwargs: controller.do_say(message),
-                                   playsound=lambda contr, sound, **kwargs: controller.do_play(sound),
+                                   playsound=lambda contr, sound, **kwargs: controller.do_play(sound, priority=CHIME),
                                    chiming_times=convert_intervals(config('noticeboard', 'chiming_times')),
                                    chimes_dir=os.path.expandvars("$SYNCED/music/chimes"))
 
-    for on_action in [
-            'shine',
-            # 'photo',
-            # 'extend',
-    ]:
-        controller.add_pir_on_action(config('noticeboard', 'delays', on_action), on_action)
-    for off_action in [
-            'quench',
-            # 'retract',
-    ]:
-        controller.add_pir_off_action(config('noticeboard', 'delays', off_action), off_action)
+    set_pir_actions(controller)
 
-    previous_date = datetime.date.today()
-    previous_chores_date = datetime.date.today()
     announcer.reload_timetables(os.path.expandvars("$SYNCED/timetables"),
                                 convert_intervals(config('noticeboard', 'chiming_times')),
-                                previous_date)
-
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as incoming:
-        incoming.setblocking(0)
-        incoming.bind(('localhost', int(config('noticeboard', 'command_port'))))
-        incoming.listen()
-
-        print('(message "noticeboard hardware controller started")')
-        running = True
-        active = False
-        watch_on = [sys.stdin, incoming]
-        while running:
-            active = controller.step(active)
-            update_config (controller.config_updates)
-            controller.config_updates = {}
-            # if we're stepping through an activity, ignore commands for now:
-            if active:
-                time.sleep(config('noticeboard', 'delays', 'fast'))
-            else:
-                ready, _, _ = select.select(watch_on,
-                                            [],
-                                            [],
-                                            config('noticeboard', 'delays', 'slow'))
-                for channel in ready:
-                    if channel == incoming:
-                        conn, new_address = incoming.accept()
-                        print("new connection from", new_address)
-                        watch_on.append(conn)
-                    elif sys.stdin in ready:
-                        try:
-                            if controller.onecmd(sys.stdin.readline().strip()):
-                                running = False
-                        except Exception as e:
-                            print('(message "Exception in running command: %s")' % e)
-                            traceback.print_exception(e)
-                    else:
-                        data, address = channel.recvfrom(1024)
-                        if data:
-                            try:
-                                command = data.decode('utf-8')
-                            except UnicodeDecodeError as dce:
-                                print("Could not decode input from socket:", dce, data)
-                                continue
-                            try:
-                                with contextlib.redirect_stdout(io.StringIO()) as captured, contextlib.redirect_stderr(io.StringIO()) as capturederr:
-                                    if controller.onecmd(command):
-                                        # logout:
-                                        watch_on.remove(channel)
-                                        channel.shutdown(socket.SHUT_RDWR)
-                                output = captured.getvalue() + capturederr.getvalue()
-                                print("Captured output", output)
-                                if output:
-                                    channel.sendall(bytes(output, encoding='utf-8'))
-                            except Exception as e:
-                                print("Exception in running command from socket:", e)
-                                traceback.print_tb(e.__traceback__)
-                        else: # channel is closed
-                            watch_on.remove(channel)
-                today = datetime.date.today()
-                if previous_date != today:
-                    controller.start_chores()
-                    announcer.reload_timetables(os.path.expandvars("$SYNCED/timetables"),
-                                                convert_intervals(config('noticeboard', 'chiming_times')),
-                                                today)
-                    previous_date = today
-                if previous_chores_date != controller.chores_done_date:
-                    previous_chores_date = controller.chores_done_date
-                announcer.tick()
-
-        controller.onecmd("quiet")
-        controller.onecmd("quench")
-        controller.onecmd("off")
+                                datetime.date.today())
+    startup_profile.stage("loading timetables")
+
+    chimes = ChimeScheduler(scheduler,
+                            play=lambda sound, offset: controller.do_play(sound, begin=offset, priority=CHIME),
+                            duration_of=lambda sound: (decoded := controller.audio.cached(sound)) and decoded.duration(),
+                            log=controller.log,
+                            **chime_settings())
+    # plan again once the sounds are decoded, to start the chimes
+    # early by their real lengths rather than the fallback leads;
+    # through the scheduler, so it happens on the event loop's thread:
+    controller.audio.on_preloaded = lambda: scheduler.enter(0, 1, chimes.plan, ())
+    chimes.plan()
+    startup_profile.stage("planning chimes")
+
+    # follow changes to the config, whether from its files or from commands:
+    def chiming_changed(_changes):
+        chimes.reconfigure(**chime_settings())
+        announcer.reload_timetables(os.path.expandvars("$SYNCED/timetables"),
+                                    chimes.chiming_times,
+                                    datetime.date.today())
+    def camera_changed(_changes):
+        global photographing_duration
+        photographing_duration = datetime.timedelta(0, config('noticeboard', 'camera', 'duration'))
+    add_config_listener(lambda _changes: occupancy.reconfigure(**occupancy_settings()), 'house')
+    add_config_listener(chiming_changed, 'noticeboard', 'chiming_times')
+    add_config_listener(chiming_changed, 'noticeboard', 'chimes')
+    add_config_listener(lambda _changes: set_pir_actions(controller), 'noticeboard', 'delays')
+    add_config_listener(camera_changed, 'noticeboard', 'camera', 'duration')
+
+    controller.events.subscribe(lambda event: (event['on']
+                                               and not expected_at_home()
+                                               and handle_possible_intruder(controller)),
+                                ['pir'])
+
+    asyncio.run(run_controller(controller, announcer, args.startup_profile))
+
+    controller.onecmd("quiet")
+    controller.onecmd("quench")
+    controller.onecmd("off")
+    occupancy.save()
+    controller.event_log.close()
+    controller.trace.stop()
+    controller.logger.close()
 
     print('(message "noticeboard hardware controller stopped")')
 
+class Waker(object):
+
+    """Let event handlers cut short the sleeps of the periodic tasks,
+    for when something they've done needs a task to run early."""
+
+    pass
+
+    def __init__(self):
+        self.events = []
+
+    def event(self):
+        """Make an event for one task to nap on."""
+        event = asyncio.Event()
+        self.events.append(event)
+        return event
+
+    def wake(self):
+        for event in self.events:
+            event.set()
+
+STEP_TIME = metrics.histogram("noticeboard_step_seconds",
+                              "Time taken by each step of the controller.")
+ACTIVE_TIME = metrics.counter("noticeboard_active_seconds_total",
+                              "Time spent stepping at the fast rate.")
+LATENESS = metrics.histogram("noticeboard_loop_lateness_seconds",
+                             "How much later than asked for the tasks wake from their naps.")
+TICK_TIME = metrics.histogram("noticeboard_announcer_tick_seconds",
+                              "Time taken by each tick of the timetable announcer.")
+COMMAND_TIME = metrics.histogram("noticeboard_command_seconds",
+                                 "Time taken to run each command.")
+COMMANDS = metrics.counter("noticeboard_commands_total",
+                           "Commands run, from stdin and the socket.")
+COMMAND_FAILURES = metrics.counter("noticeboard_command_failures_total",
+                                   "Commands that raised an exception.")
+
+async def supervised(name, task):
+    """Run a task, starting it again if it fails, so that one bad
+    step doesn't stop it for the rest of the session."""
+    while True:
+        try:
+            await task()
+        except Exception as e:
+            print('(message "Exception in %s task: %s")' % (name, e))
+            traceback.print_exception(e)
+            await asyncio.sleep(1)  # rather than spinning, if it fails straight away
+
+async def nap(event, delay):
+    """Sleep for DELAY seconds, or until EVENT is set."""
+    due = time.monotonic() + delay if delay is not None else None
+    try:
+        await asyncio.wait_for(event.wait(), delay)
+    except asyncio.TimeoutError:
+        # a busy event loop shows up as waking late:
+        LATENESS.record(max(0.0, time.monotonic() - due))
+    event.clear()
+
+async def stepping(controller, woken):
+    """Step the active operations: fast while there's something going on, slowly otherwise."""
+    active = False
+    while True:
+        started = time.monotonic()
+        with STEP_TIME.time():
+            active = controller.step(active)
+        delays = compiled_config().noticeboard.delays
+        await nap(woken, delays.fast if active else delays.slow)
+        if active:
+            ACTIVE_TIME.inc(time.monotonic() - started)
+
+async def fading(controller, woken):
+    """Drive the lamp fades, running only while a fade is in progress."""
+    while True:
+        if controller.step_lamps():
+            await asyncio.sleep(compiled_config().noticeboard.delays.lamp)
+        else:
+            await nap(woken, None)
+
+async def scheduling(controller, announcer, waker):
+    """Run the scheduler events as they become due."""
+    woken = waker.event()
+    while True:
+        with TICK_TIME.time():
+            announcer.tick()
+        delay = controller.run_due_events(compiled_config().noticeboard.delays.slow)
+        # the events that came due, such as the PIR's actions, may
+        # have started something for the other tasks to do:
+        waker.wake()
+        woken.clear()
+        await nap(woken, delay)
+
+async def watching_config():
+    """Pick up changes to the config files, without restarting."""
+    while True:
+        await asyncio.sleep(compiled_config().noticeboard.delays.config_check)
+        if (changes := reload_if_changed()):
+            print('(message "config reloaded, with changes to %s")'
+                  % ", ".join(":".join(str(key) for key in change) for change in changes))
+
+async def writing_metrics():
+    """Write the metrics periodically, for node_exporter's textfile collector."""
+    failed = False
+    while True:
+        settings = compiled_config().noticeboard.metrics
+        await asyncio.sleep(settings.interval)
+        if not settings.file:
+            continue
+        try:
+            # off the event loop, so a slow SD card doesn't hold it up:
+            await asyncio.get_running_loop().run_in_executor(
+                None, metrics.write_textfile, os.path.expanduser(os.path.expandvars(settings.file)))
+            failed = False
+        except OSError as e:
+            if not failed:      # say so once, rather than every interval
+                print('(message "could not write metrics to %s: %s")' % (settings.file, e))
+            failed = True
+
+async def date_rollover(controller, announcer):
+    """Start the chores, update the occupancy, and reload the timetables each midnight."""
+    while True:
+        now = datetime.datetime.now()
+        tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1),
+                                             datetime.time())
+        await asyncio.sleep((tomorrow - now).total_seconds())
+        today = datetime.date.today()
+        if today < tomorrow.date():
+            continue            # woke early, e.g. the clock was adjusted
+        controller.start_chores()
+        controller.occupancy.learn()
+        controller.occupancy.save()
+        announcer.reload_timetables(os.path.expandvars("$SYNCED/timetables"),
+                                    convert_intervals(config('noticeboard', 'chiming_times')),
+                                    today)
+
+def run_command(controller, command, waker):
+    """Run a command, returning whether it ended the session."""
+    COMMANDS.inc()
+    try:
+        with COMMAND_TIME.time():
+            return controller.onecmd(controller.precmd(command))
+    except Exception:
+        COMMAND_FAILURES.inc()
+        raise
+    finally:
+        # the command may have started something that needs stepping
+        # or scheduling:
+        waker.wake()
+
+EVENT_QUEUE_LENGTH = 256
+
+class Subscription(object):
+
+    """The events a socket connection has subscribed to.
+    Events may be published on any thread, so they are handed to the
+    event loop, which queues them for the connection's sender task."""
+
+    pass
+
+    def __init__(self, bus, writer):
+        self.bus = bus
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(EVENT_QUEUE_LENGTH)
+        self.dropped = 0
+        self.token = None
+        self.sender = asyncio.create_task(self.send(writer))
+
+    def set_topics(self, topics):
+        self.bus.unsubscribe(self.token)
+        self.token = self.bus.subscribe(self.deliver, topics)
+
+    def deliver(self, event):
+        self.loop.call_soon_threadsafe(self.enqueue, event)
+
+    def enqueue(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1   # the client isn't keeping up
+
+    async def send(self, writer):
+        while True:
+            writer.write(protocol.format_event(await self.queue.get()))
+            await writer.drain()
+
+    def close(self):
+        self.bus.unsubscribe(self.token)
+        self.sender.cancel()
+
+async def serve_client(controller, waker, reader, writer):
+    """Take commands from a socket connection, and send their output back.
+    The commands are framed as described in protocol.py, so a client can
+    pipeline them on one connection."""
+    print("new connection from", writer.get_extra_info('peername'))
+    subscription = None
+    try:
+        while line := await reader.readline():
+            try:
+                request_id, command, structured = protocol.parse_request(line)
+            except protocol.RequestError as e:
+                print("Bad request from socket:", e, line)
+                writer.write(protocol.format_reply(None, "", str(e), line.startswith(b'{')))
+                continue
+            words = command.split()
+            if words and words[0] == 'subscribe':
+                subscription = subscription or Subscription(controller.events, writer)
+                subscription.set_topics(words[1:])
+                writer.write(protocol.format_reply(request_id,
+                                                   "subscribed to %s\n" % (" ".join(words[1:]) or "all events"),
+                                                   None, structured))
+                continue
+            if words and words[0] == 'unsubscribe':
+                if subscription:
+                    subscription.close()
+                    subscription = None
+                writer.write(protocol.format_reply(request_id, "unsubscribed\n", None, structured))
+                continue
+            failure = None
+            finished = False
+            with contextlib.redirect_stdout(io.StringIO()) as captured, contextlib.redirect_stderr(io.StringIO()) as capturederr:
+                try:
+                    finished = run_command(controller, command, waker)
+                except Exception as e:
+                    failure = e
+            output = captured.getvalue() + capturederr.getvalue()
+            error = None
+            if failure:
+                error = "Exception in running command: %s" % failure
+                print(error)
+                traceback.print_tb(failure.__traceback__)
+            if output or error or structured:
+                writer.write(protocol.format_reply(request_id, output, error, structured))
+                await writer.drain()
+            if finished:
+                # logout:
+                break
+    except (ConnectionError, asyncio.LimitOverrunError, ValueError) as e:
+        print("Connection lost:", e)
+    finally:
+        if subscription:
+            subscription.close()
+        writer.close()
+
+async def run_controller(controller, announcer, profile_startup=False):
+    """Run the controller's event loop until told to quit."""
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    waker = Waker()
+
+    def stdin_ready():
+        line = sys.stdin.readline()
+        if not line:
+            loop.remove_reader(sys.stdin)
+            return
+        try:
+            if run_command(controller, line.strip(), waker):
+                stopping.set()
+        except Exception as e:
+            print('(message "Exception in running command: %s")' % e)
+            traceback.print_exception(e)
+
+    def edges_ready():
+        controller.handle_edges()
+        waker.wake()
+
+    def player_changed():
+        controller.player.update()
+        waker.wake()
+
+    try:
+        loop.add_reader(sys.stdin, stdin_ready)
+    except PermissionError:
+        pass                    # stdin is a plain file such as /dev/null
+    loop.add_reader(controller.edges, edges_ready)
+    controller.player.notify = lambda: loop.call_soon_threadsafe(player_changed)
+
+    server = await asyncio.start_server(
+        lambda reader, writer: serve_client(controller, waker, reader, writer),
+        'localhost', int(config('noticeboard', 'command_port')))
+
+    stepping_woken, fading_woken = waker.event(), waker.event()
+    tasks = [asyncio.create_task(supervised(name, task))
+             for name, task in [
+                     ("stepping", lambda: stepping(controller, stepping_woken)),
+                     ("fading", lambda: fading(controller, fading_woken)),
+                     ("scheduling", lambda: scheduling(controller, announcer, waker)),
+                     ("config", watching_config),
+                     ("metrics", writing_metrics),
+                     ("date rollover", lambda: date_rollover(controller, announcer))]]
+
+    startup_profile.stage("starting command server")
+    print('(message "noticeboard hardware controller started")')
+    if profile_startup:
+        startup_profile.report()
+    async with server:
+        await stopping.wait()
+    for task in tasks:
+        task.cancel()
+    loop.remove_reader(sys.stdin)
+    loop.remove_reader(controller.edges)
+
 if __name__ == "__main__":
     main()
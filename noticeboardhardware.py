@@ -3,7 +3,6 @@ from pathlib import Path
 import cmd
 import datetime
 import os
-import re
 import sched
 import shlex
 import signal
@@ -13,13 +12,29 @@ import time
 
 from collections import defaultdict
 
-import RPi.GPIO as GPIO
-import picamera2
+from hardware_backend import GPIO
 
+import metrics
 import pins
-from lamp import Lamp
-
-from lifehacking_config import config
+from audio_engine import AudioEngine
+from audio_queue import PlaybackQueue, ProcessPlayback, CHIME, SPEECH, MUSIC, PRIORITY_NAMES
+from burst_buffer import BurstBuffer
+from camera import Camera, parse_dimensions
+from clip_retention import RetentionEngine
+from clip_tracker import ClipTracker
+from edge_events import EdgeEvents
+from event_log import EventLog, describe_value, SENSOR_IDS
+from events import EventBus
+from lamp import Lamp, CURVES
+from logwriter import LogWriter, LEVELS, LEVEL_NAMES, DEBUG, INFO, ERROR
+from motion_detector import MotionDetector
+from music_library import MusicLibrary
+from photo_pipeline import PhotoPipeline
+from sensor_trace import TraceRecorder
+from temperature import TemperatureSampler
+from tray import TrayMotor, ARRIVED
+
+from lifehacking_config import config, compiled_config, update_config, add_config_listener
 from motion_monitor import motion_monitor, managed_directory
 
 # General support for the noticeboard hardware
@@ -32,47 +47,28 @@ KIOSK_EMACS_PID_FILE = os.path.expanduser("~/.agenda-kiosk-emacs")
 COUNTDOWN_START = 3
 DIRECTORY_MAX_SIZE = 8 * 1024 * 1024 * 1024
 
-def oggplay(music_filename, begin=None, end=None):
-    return subprocess.Popen(["ogg123"]
-                            + (["-k", str(begin)] if begin else [])
-                            + (["-K", str(end)] if end else [])
-                            + [music_filename],
-                            stdout=subprocess.DEVNULL,
-                            stderr=subprocess.DEVNULL)
-
-DEFAULT_MUSIC_DIRECTORY = os.path.expanduser("~/Music")
-
-music_files = {
-}
-
-def get_music_files():
-    if not music_files:
-        def get_music_files_in_dir(directory):
-            for raw in os.listdir(directory):
-                if raw.startswith('.'):
-                    continue
-                name = os.path.join(directory, raw)
-                if os.path.isfile(name) and name.endswith('.ogg') and 'conflict' not in name:
-                    base = os.path.splitext(raw)[0].lower().replace('_', ' ')
-                    if (m := re.match("[0-9]+[._-](.+)", base)):
-                        base = m.group(1)
-                    music_files[base] = name
-                elif os.path.isdir(name):
-                    get_music_files_in_dir(name)
-        get_music_files_in_dir(DEFAULT_MUSIC_DIRECTORY)
-
-def filenames_for_music(partial_filename):
-    get_music_files()
-    partial_filename = partial_filename.lower().replace('_', ' ')
-    if partial_filename in music_files:
-        print("exact match for music", partial_filename, "which is", music_files[partial_filename])
-        return music_files[partial_filename]
-    else:
-        possibles = set(music_files.keys())
-        for word in partial_filename.split(' '):
-            possibles = {name for name in possibles if word in name}
-        print("music files matching", partial_filename, "are:", possibles)
-        return list(possibles) if possibles else None
+def oggplay(music_filename, begin=None, end=None, log=None):
+    return ProcessPlayback(["ogg123"]
+                           + (["-k", str(begin)] if begin else [])
+                           + (["-K", str(end)] if end else [])
+                           + [music_filename],
+                           log=log)
+
+GPIO_WRITE_TIME = metrics.histogram("noticeboard_gpio_write_seconds",
+                                    "Time taken by each GPIO output write.")
+
+def gpio_output(pin, value):
+    """Set an output pin, timing how long that takes."""
+    with GPIO_WRITE_TIME.time():
+        GPIO.output(pin, value)
+
+TIME_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+def time_from_string(when, now):
+    """Convert an ISO date and time, or an interval ago such as "6h", to a timestamp."""
+    if when[:-1].isdigit() and when[-1] in TIME_UNITS:
+        return now - int(when[:-1]) * TIME_UNITS[when[-1]]
+    return datetime.datetime.fromisoformat(when).timestamp()
 
 def signal_emacs(signal):
     if os.path.exists(KIOSK_EMACS_PID_FILE):
@@ -86,26 +82,36 @@ class NoticeBoardHardware(cmd.Cmd):
 
     def __init__(self,
                  scheduler,
-                 expected_at_home_times,
+                 occupancy,
                  speech_engine="espeak",
                  verbose=False):
         self.scheduler = scheduler or sched.scheduler(time.time, time.sleep)
-        self.expected_at_home_times = expected_at_home_times
+        self.occupancy = occupancy
         self.speech_engine = speech_engine
+        self.events = EventBus(log=self.log)
+        self.event_log = EventLog(config('noticeboard', 'event_log', 'file'),
+                                  config('noticeboard', 'event_log', 'records'))
+        try:
+            self.event_log.open()
+            self.events.subscribe(self.event_log.record_event)
+        except OSError as e:
+            print('(message "Could not open event log: %s")' % e)
         self.v12_is_on = False
+        self.speaker_is_on = False
+        self.lamps_fading = False
         self.brightness = 0
         self.quench_scheduled = False
-        self.keyboard_status = 'unknown'
-        self.moving_steps = 0
+        self.tray_reported = 'unknown'
 
         self.pir_already_on = False
         self.pir_on_for = 0
         self.pir_off_for = 0
         self.pir_on_actions = defaultdict(list)
         self.pir_off_actions = defaultdict(list)
+        self.pir_scheduled_actions = []
 
-        self.music_process = None
-        self.speech_process = None
+        self.player = PlaybackQueue(on_start=self.sound_started,
+                                    on_finish=self.sound_finished)
         self.speaker_off_countdown = COUNTDOWN_START
 
         self.chores_process = None
@@ -116,12 +122,45 @@ class NoticeBoardHardware(cmd.Cmd):
 
         self.temperature = None
 
-        self.config_updates = {}
-
         self.stdout = sys.stdout # needed for error messages by cmd
 
-        self.verbose = verbose
-        self.logstream = open(os.path.expanduser("~/noticeboard.log"), 'a')
+        self.logger = LogWriter(config('noticeboard', 'log', 'file'),
+                                DEBUG if verbose else LEVELS[config('noticeboard', 'log', 'level')],
+                                config('noticeboard', 'log', 'json'),
+                                config('noticeboard', 'log', 'rotate'),
+                                config('noticeboard', 'log', 'max_bytes'),
+                                config('noticeboard', 'log', 'keep'),
+                                config('noticeboard', 'log', 'flush_interval'))
+        self.logger.start()
+
+        # inputs, commands and scheduled events, for replay.py:
+        self.trace = TraceRecorder()
+        if hasattr(self.scheduler, 'recorder'):
+            self.scheduler.recorder = self.trace
+        self.trace_config_changed(None)
+
+        self.audio = AudioEngine(config('noticeboard', 'audio', 'device'), log=self.log)
+        self.audio.preload(config('noticeboard', 'audio', 'preload'))
+        self.music = MusicLibrary(config('noticeboard', 'music', 'directory'),
+                                  config('noticeboard', 'music', 'index'),
+                                  log=self.log)
+        self.music.load()
+        self.refresh_music()
+
+        if config('motion', 'detector', 'enabled'):
+            clips_dir = config('motion', 'detector', 'directory')
+            os.makedirs(clips_dir, exist_ok=True)
+        else:
+            clips_dir = motion_monitor.get_clips_directory()
+        self.clips = clips_dir and ClipTracker(clips_dir, log=self.log)
+        self.retention = None
+        if self.clips:
+            self.retention = RetentionEngine(self.clips,
+                                             config('motion', 'retain'),
+                                             config('motion', 'days'),
+                                             log=self.log)
+            self.clips.start()
+            self.retention.start()
 
         GPIO.setwarnings(False)
         GPIO.setmode(GPIO.BCM)
@@ -137,16 +176,133 @@ class NoticeBoardHardware(cmd.Cmd):
         # GPIO.setup(pins.PIN_PORCH_LAMP, GPIO.OUT, initial=GPIO.LOW)
         GPIO.setup(pins.PIN_LAMP_LEFT, GPIO.OUT, initial=GPIO.LOW)
         GPIO.setup(pins.PIN_LAMP_RIGHT, GPIO.OUT, initial=GPIO.LOW)
-        self._lamps = [Lamp(pins.PIN_LAMP_LEFT), Lamp(pins.PIN_LAMP_RIGHT)]
-        self.camera = picamera2.Picamera2()
-
-    def log(self, message, *message_data):
-        log_text = datetime.datetime.now().isoformat() + ": " + (message % message_data)
-        if self.logstream:
-            self.logstream.write(log_text + "\n")
-            self.logstream.flush()
-        else:
-            print(log_text)
+        GPIO.setup(pins.PIN_FANS, GPIO.OUT, initial=GPIO.LOW)
+        self.tray = TrayMotor(pins.PIN_EXTEND, pins.PIN_RETRACT, pins.PIN_EXTENDED, pins.PIN_RETRACTED,
+                              config('noticeboard', 'tray', 'travel_time'),
+                              config('noticeboard', 'tray', 'ramp'),
+                              config('noticeboard', 'tray', 'stall_margin'),
+                              config('noticeboard', 'tray', 'pwm_frequency'))
+        self._lamps = [Lamp(pins.PIN_LAMP_LEFT, config('noticeboard', 'lamp_curve')),
+                       Lamp(pins.PIN_LAMP_RIGHT, config('noticeboard', 'lamp_curve'))]
+
+        add_config_listener(self.lamp_config_changed, 'noticeboard', 'lamp_curve')
+        add_config_listener(self.audio_config_changed, 'noticeboard', 'audio', 'preload')
+        add_config_listener(self.clips_config_changed, 'motion')
+        add_config_listener(self.temperature_config_changed, 'noticeboard', 'temperature')
+        add_config_listener(self.camera_config_changed, 'noticeboard', 'camera')
+        add_config_listener(self.tray_config_changed, 'noticeboard', 'tray')
+        add_config_listener(self.log_config_changed, 'noticeboard', 'log', 'level')
+        add_config_listener(self.trace_config_changed, 'noticeboard', 'trace', 'file')
+
+        self.temperature_sampler = TemperatureSampler(config('noticeboard', 'temperature', 'interval'),
+                                                      config('noticeboard', 'temperature', 'fans_on'),
+                                                      config('noticeboard', 'temperature', 'fans_off'),
+                                                      config('noticeboard', 'temperature', 'history'),
+                                                      switch_fans=self.fans,
+                                                      on_sample=self.temperature_sampled,
+                                                      log=self.log)
+        self.temperature_sampler.start()
+        self.camera = Camera(parse_dimensions(config('noticeboard', 'camera', 'main_size')),
+                             parse_dimensions(config('noticeboard', 'camera', 'lores_size')),
+                             log=self.log)
+        self.photos = PhotoPipeline(self.camera,
+                                    config('noticeboard', 'camera', 'directory'),
+                                    parse_dimensions(config('noticeboard', 'camera', 'compare_size')),
+                                    config('noticeboard', 'camera', 'pixel_threshold'),
+                                    config('noticeboard', 'camera', 'changed_fraction'),
+                                    config('noticeboard', 'camera', 'jpeg_quality'),
+                                    log=self.log)
+        self.bursts = BurstBuffer(self.camera,
+                                  config('noticeboard', 'camera', 'directory'),
+                                  config('noticeboard', 'camera', 'burst', 'before'),
+                                  config('noticeboard', 'camera', 'burst', 'rate'),
+                                  log=self.log)
+        if config('noticeboard', 'camera', 'burst', 'enabled'):
+            self.bursts.start()
+        self.motion = MotionDetector(self.camera,
+                                     config('motion', 'detector', 'directory'),
+                                     on_motion=lambda moving: self.events.publish('motion', on=moving),
+                                     log=self.log,
+                                     **self.motion_settings())
+        if config('motion', 'detector', 'enabled'):
+            self.motion.start()
+        self.edges = EdgeEvents([pins.PIN_PIR, pins.PIN_RETRACTED, pins.PIN_EXTENDED],
+                                hooks={pins.PIN_RETRACTED: self.tray.limit_edge,
+                                       pins.PIN_EXTENDED: self.tray.limit_edge})
+
+    def lamp_config_changed(self, _changes):
+        for lamp in self._lamps:
+            lamp.curve = CURVES[config('noticeboard', 'lamp_curve')]
+
+    def audio_config_changed(self, _changes):
+        self.audio.preload(config('noticeboard', 'audio', 'preload'))
+
+    def clips_config_changed(self, _changes):
+        if self.retention:
+            self.retention.set_limits(config('motion', 'retain'), config('motion', 'days'))
+        settings = self.motion_settings()
+        self.motion.set_regions(settings.pop('watch'), settings.pop('ignore'))
+        for setting, value in settings.items():
+            setattr(self.motion, setting, value)
+
+    def motion_settings(self):
+        """Return the motion detection settings from the config, as keyword arguments for MotionDetector."""
+        detector = config('motion', 'detector')
+        return {'watch': detector['watch'],
+                'ignore': detector['ignore'],
+                'compare_size': parse_dimensions(config('noticeboard', 'camera', 'compare_size')),
+                'pixel_threshold': detector['pixel_threshold'],
+                'changed_fraction': detector['changed_fraction'],
+                'rate': detector['rate'],
+                'after': detector['after'],
+                'longest': detector['longest'],
+                'bitrate': detector['bitrate']}
+
+    def camera_config_changed(self, _changes):
+        self.photos.directory = config('noticeboard', 'camera', 'directory')
+        self.photos.compare_size = parse_dimensions(config('noticeboard', 'camera', 'compare_size'))
+        self.photos.pixel_threshold = config('noticeboard', 'camera', 'pixel_threshold')
+        self.photos.changed_fraction = config('noticeboard', 'camera', 'changed_fraction')
+        self.photos.quality = config('noticeboard', 'camera', 'jpeg_quality')
+        self.bursts.directory = config('noticeboard', 'camera', 'directory')
+        self.bursts.set_before(config('noticeboard', 'camera', 'burst', 'before'))
+
+    def log_config_changed(self, _changes):
+        self.logger.level = LEVELS[config('noticeboard', 'log', 'level')]
+
+    def trace_config_changed(self, _changes):
+        filename = config('noticeboard', 'trace', 'file')
+        if not filename:
+            self.trace.stop()
+        elif filename != self.trace.filename:
+            self.start_trace(filename)
+
+    def start_trace(self, filename):
+        try:
+            self.trace.start(os.path.expanduser(filename))
+            self.log("recording trace in %s", filename)
+        except OSError as e:
+            self.log("could not record trace in %s: %s", filename, e, level=ERROR)
+
+    def tray_config_changed(self, _changes):
+        for setting in ('travel_time', 'ramp', 'stall_margin'):
+            setattr(self.tray, setting, config('noticeboard', 'tray', setting))
+
+    def temperature_config_changed(self, _changes):
+        for setting in ('interval', 'fans_on', 'fans_off'):
+            setattr(self.temperature_sampler, setting, config('noticeboard', 'temperature', setting))
+
+    def precmd(self, line):
+        """Record each command given to the controller, but not those it runs itself."""
+        self.trace.command(line)
+        return line
+
+    def default(self, line):
+        """Report an unknown command as an error, so that it gets back to the client."""
+        raise ValueError("unknown command: %s" % line)
+
+    def log(self, message, *message_data, level=INFO):
+        self.logger.log(level, message, *message_data)
 
     def do_on(self, arg=None):
         """Switch the 12V power on."""
@@ -168,41 +324,75 @@ class NoticeBoardHardware(cmd.Cmd):
         return False
 
     def do_shine(self, arg=None):
-        """Switch the lamps on."""
-        self.lamps(100)
+        """Switch the lamps on.
+        An optional argument gives the fade time in seconds."""
+        self.lamps(100, float(arg) if arg else None)
         return False
 
     def do_quench(self, arg=None):
-        """Switch the lamps off."""
-        self.lamps(0)
+        """Switch the lamps off.
+        An optional argument gives the fade time in seconds."""
+        self.lamps(0, float(arg) if arg else None)
+        return False
+
+    def do_fade(self, arg):
+        """Fade the lamps to a brightness from 0 to 100.
+        Optional further arguments give the fade time in seconds, and
+        the curve (linear, gamma or perceptual)."""
+        argparts = arg.split()
+        if not argparts:
+            print('(message "fade needs a brightness")')
+            return False
+        if len(argparts) > 2 and argparts[2] not in CURVES:
+            print('(message "unknown curve %s, the curves are %s")' % (argparts[2], ", ".join(CURVES)))
+            return False
+        self.lamps(argparts[0],
+                   float(argparts[1]) if len(argparts) > 1 else None,
+                   argparts[2] if len(argparts) > 2 else None)
         return False
 
     def do_extend(self, arg):
         """Slide the keyboard drawer out."""
-        if self.keyboard_status == 'extended':
-            pass # print('(message "keyboard already extended")')
-        else:
-            if self.keyboard_status != 'extending':
-                self.moving_steps = 0
-            self.power(True)
-            self.keyboard_status = 'extending'
-            print('(message "starting to extend keyboard tray")')
-            GPIO.output(pins.PIN_RETRACT, GPIO.LOW)
-            GPIO.output(pins.PIN_EXTEND, GPIO.HIGH)
+        self.move_tray('extend')
         return False
 
     def do_retract(self, arg):
         """Slide the keyboard drawer back in."""
-        if self.keyboard_status == 'retracted':
-            pass # print('(message "keyboard already retracted")')
-        else:
-            if self.keyboard_status != 'retracting':
-                self.moving_steps = 0
-            self.power(True)
-            self.keyboard_status = 'retracting'
-            print('(message "starting to retract keyboard tray")')
-            GPIO.output(pins.PIN_EXTEND, GPIO.LOW)
-            GPIO.output(pins.PIN_RETRACT, GPIO.HIGH)
+        self.move_tray('retract')
+        return False
+
+    def move_tray(self, direction):
+        if self.tray.status == ARRIVED[direction]:
+            return
+        self.power(True)
+        if self.tray.move(direction):
+            print('(message "starting to %s keyboard tray")' % direction)
+        self.tray_changed()
+
+    @property
+    def keyboard_status(self):
+        return self.tray.status
+
+    def do_history(self, arg):
+        """Show the recorded sensor events.
+        The arguments may include sensor names to show only those, and
+        the start and end of the period to show, as ISO dates and times
+        or as times ago such as 30m, 6h or 2d (by default, the last day)."""
+        now = time.time()
+        sensors = [word for word in arg.split() if word in SENSOR_IDS]
+        times = [time_from_string(word, now) for word in arg.split() if word not in SENSOR_IDS]
+        start = times[0] if times else now - 86400
+        end = times[1] if len(times) > 1 else None
+        for when, sensor, value in self.event_log.query(start, end, sensors or None):
+            print(datetime.datetime.fromtimestamp(when).isoformat(timespec='seconds'),
+                  sensor, describe_value(sensor, value))
+        return False
+
+    def do_occupancy(self, arg):
+        """Show whether anyone is expected to be at home, and when that changes next."""
+        print('(message "Expected at home: %s")' % self.occupancy.expected())
+        if (change := self.occupancy.next_change()):
+            print('(message "Next change at: %s")' % change.isoformat())
         return False
 
     def do_report(self, arg):
@@ -213,30 +403,45 @@ class NoticeBoardHardware(cmd.Cmd):
         print('(message "12V power on: %s")' % self.v12_is_on)
         print('(message "PIR: %s")' % PIR_active)
         print('(message "Keyboard status: %s")' % self.keyboard_status)
-        print('(message "Music process: %s")' % self.music_process)
-        print('(message "Speech process: %s")' % self.speech_process)
+        for playing in self.player.describe():
+            print('(message "Sound: %s")' % playing)
         print('(message "Countdown to switching speaker off: %d")' % self.speaker_off_countdown)
+        print('(message "Decoded sounds: %d")' % len(self.audio.sounds))
         print('(message "Time on server: %s")' % datetime.datetime.now().isoformat())
-        clips_dir = motion_monitor.get_clips_directory()
-        if clips_dir and os.path.isdir(clips_dir):
-            print('(message "Camera clips: %d bytes")' % int(subprocess.run(["du", "-b", clips_dir], capture_output=True)
-                                                             .stdout
-                                                             .split(b'\t')[0]))
-            clips = sorted(managed_directory.get_files_details(clips_dir),
-                           key=lambda f: f['created'])
-            if clips:
-                print('(message "Most recent camera clip at: %s")' % clips[-1]['created'])
+        if self.temperature is not None:
+            print('(message "Temperature: %.1fC, fans %s")' % (self.temperature,
+                                                              "on" if self.temperature_sampler.fans else "off"))
+        if self.photos.kept or self.photos.similar:
+            print('(message "Photos kept: %d, dropped as unchanged: %d")' % (self.photos.kept, self.photos.similar))
+        if self.bursts.bursts:
+            print('(message "Intruder bursts: %d, frames saved: %d")' % (self.bursts.bursts, self.bursts.saved))
+        if self.clips and os.path.isdir(self.clips.directory):
+            print('(message "Camera clips: %d bytes in %d files")' % (self.clips.total_bytes, self.clips.count()))
+            if (newest := self.clips.newest()):
+                print('(message "Most recent camera clip at: %s")' % datetime.datetime.fromtimestamp(newest[0]).isoformat())
+            if (oldest := self.clips.oldest()):
+                print('(message "Oldest camera clip at: %s")' % datetime.datetime.fromtimestamp(oldest[0]).isoformat())
+            print('(message "Camera clips removed to keep within %d bytes and %d days: %d")' % (
+                self.retention.max_bytes, self.retention.max_days, self.retention.deleted))
         else:
             print('(message "Motion detection possibly not running")')    
+        if self.motion.clips:
+            print('(message "Motion clips recorded since starting: %d")' % self.motion.clips)
         return False
 
     def do_trim(self, arg):
-        """Trim the camera clips directory."""
-        managed_directory.trim_directory(motion_monitor.get_clips_directory(), int(arg) if arg else DIRECTORY_MAX_SIZE)
+        """Set the size to keep the camera clips directory within, and trim it to that."""
+        if self.retention:
+            self.retention.set_limits(max_bytes=arg or DIRECTORY_MAX_SIZE)
+        else:
+            managed_directory.trim_directory(motion_monitor.get_clips_directory(), int(arg) if arg else DIRECTORY_MAX_SIZE)
 
     def do_keep(self, arg):
         """Keep only a given number of days of camera clips."""
-        managed_directory.keep_days_in_directory(motion_monitor.get_clips_directory(), int(arg) if arg else DIRECTORY_MAX_SIZE)
+        if self.retention:
+            self.retention.set_limits(max_days=int(arg) if arg else config('motion', 'days'))
+        else:
+            managed_directory.keep_days_in_directory(motion_monitor.get_clips_directory(), int(arg) if arg else config('motion', 'days'))
 
     def do_queue(self, arg):
         """Show the scheduler queue."""
@@ -244,7 +449,7 @@ class NoticeBoardHardware(cmd.Cmd):
         for event in self.scheduler.queue:
             print('(message "event %s: %s")' % (
                 datetime.datetime.fromtimestamp(event.time).isoformat(),
-                event.argument[1]))
+                event.argument[1] if len(event.argument) > 1 else event.action.__name__))
         print('(message "End of scheduler queue")')
 
     def do_at_home(self, arg):
@@ -266,23 +471,52 @@ class NoticeBoardHardware(cmd.Cmd):
 
     def do_quit(self, arg):
         """Tell the event loop to finish."""
-        self.logstream.close()
-        self.logstream = None
         return True
 
+    def do_loglevel(self, arg):
+        """Set how much to log: debug, info, warning or error."""
+        if arg:
+            self.logger.level = LEVELS[arg]
+        print('(message "Logging at level %s")' % LEVEL_NAMES[self.logger.level])
+        return False
+
+    def do_metrics(self, arg):
+        """Show the counters and timings: with an argument, only those whose names contain it."""
+        for line in metrics.report():
+            if arg in line.split(":")[0]:
+                print('(message "%s")' % line)
+        return False
+
+    def do_trace(self, arg):
+        """Start recording a trace into a file, for replay.py, or stop with "off"."""
+        if arg == 'off':
+            self.trace.stop()
+        elif arg:
+            self.start_trace(arg)
+        print('(message "%s")' % ("Recording trace in %s" % self.trace.filename
+                                  if self.trace.recording()
+                                  else "Not recording a trace"))
+        return False
+
+    def do_subscribe(self, arg):
+        """Subscribe to state-change events.  This is handled by the command port connection."""
+        print('(message "subscribe is only available on the command port")')
+        return False
+
     def do_date(self, arg):
         """Print the date and time as seen by the noticeboard system."""
         print(datetime.datetime.now().isoformat(timespec='seconds'))
 
     def do_config(self, arg):
-        """Add a change to the config, for the event loop to update the config from."""
+        """Change a config setting, giving the levels of its key and then the value."""
         argparts = shlex.split(arg)
-        target = self.config_updates
+        if len(argparts) < 2:
+            print('(message "config needs a key and a value")')
+            return False
+        updates = {}
+        target = updates
         for level in argparts[:-2]:
-            if level not in target:
-                new_level = dict()
-                target[level] = new_level
-                target = new_level
+            target = target.setdefault(level, {})
         name = argparts[-2]
         value = argparts[-1]
         try:
@@ -298,98 +532,140 @@ class NoticeBoardHardware(cmd.Cmd):
                         target[name] = False
                     case other:
                         target[name] = value
+        update_config(updates)
+        return False
 
     def do_say(self, text):
         """Pass the text to a TTS system.
         That goes via this module so we can control the speaker power switch."""
-        if self.speech_process:
-            self.speech_process.wait() # wait for the old one to finish
         self.sound(True)
-        self.speech_process=subprocess.Popen([self.speech_engine, text])
+        self.player.add(ProcessPlayback([self.speech_engine, text], log=self.log),
+                        SPEECH, text)
         return False
 
-    def do_play(self, music_filename, begin=None, end=None):
+    def do_play(self, music_filename, begin=None, end=None, priority=MUSIC):
         """Pass a music file to a player.
-        That goes via this module so we can control the speaker power switch."""
-        if self.music_process:
-            self.log("waiting for old music process %s to finish" % self.music_process)
-            self.music_process.wait() # wait for the old one to finish
-            self.music_process = None
+        That goes via this module so we can control the speaker power switch.
+        The file is queued behind anything already playing at the same or a
+        higher priority."""
         if music_filename.endswith(".ogg"):
-            self.log("playing ogg file %s", music_filename)
+            self.log("queueing ogg file %s", music_filename)
             self.sound(True)
-            self.music_process=oggplay(music_filename, begin, end)
+            self.player.add(((end is None and self.audio.playback(music_filename, begin or 0))
+                             or oggplay(music_filename, begin, end, log=self.log)),
+                            priority, music_filename)
         elif music_filename.endswith(".ly"):
-            self.log("playing lilypond file %s", music_filename)
+            self.log("queueing lilypond file %s", music_filename)
             midi_file = Path(music_filename).with_suffix(".midi")
-            if not midi_file.exists():
-                self.log("converting lilypond file %s to midi file %s", music_filename, midi_file)
-                subprocess.run(["lilypond", music_filename],
-                               stdout=subprocess.DEVNULL,
-                               stderr=subprocess.DEVNULL)
             self.sound(True)
-            self.music_process=subprocess.Popen(["timidity", midi_file],
-                                                stdout=subprocess.DEVNULL,
-                                                stderr=subprocess.DEVNULL)
+            self.player.add(ProcessPlayback(*(([] if midi_file.exists() else [["lilypond", music_filename]])
+                                              + [["timidity", midi_file]]),
+                                            log=self.log),
+                            priority, music_filename)
         elif music_filename.endswith(".midi"):
-            self.log("playing midi file %s", music_filename)
+            self.log("queueing midi file %s", music_filename)
             self.sound(True)
-            self.music_process=subprocess.Popen(["timidity", music_filename],
-                                                stdout=subprocess.DEVNULL,
-                                                stderr=subprocess.DEVNULL)
+            self.player.add(ProcessPlayback(["timidity", music_filename], log=self.log),
+                            priority, music_filename)
         else:
-            music_files = filenames_for_music(music_filename)
+            music_files = self.music.find(music_filename)
+            self.log("music files matching %s are %s", music_filename, music_files)
             if music_files:
                 self.sound(True)
-                print("Playing music files", music_files)
+                print("Queueing music files", music_files)
                 for music_file in music_files:
-                    if self.music_process:
-                        # TODO: non-blocking queuing system
-                        self.log("waiting for old music process to finish")
-                        print("waiting for old music process", self.music_process, "to finish")
-                        self.music_process.wait() # wait for the old one to finish
-                        self.music_process = None
-                    self.music_process=oggplay(music_file)
+                    self.player.add(oggplay(music_file, log=self.log), priority, music_file)
+        return False
+
+    def do_chime(self, arg):
+        """Play a sound file at chime priority, pre-empting any music."""
+        return self.do_play(arg, priority=CHIME)
+
+    def do_playing(self, arg):
+        """Show what is playing, paused, and waiting to play."""
+        print('(message "Sound queue:")')
+        for playing in self.player.describe():
+            print('(message "%s")' % playing)
+        print('(message "End of sound queue")')
+        return False
+
+    def do_skip(self, arg):
+        """Stop the sound that is playing now, and go on to the next one."""
+        self.player.skip()
+        return False
+
+    def do_hush(self, arg):
+        """Stop the sound that is playing now, and drop everything waiting to play.
+        An optional argument (chime, speech or music) drops only sounds of that kind."""
+        priorities = {name: priority for priority, name in PRIORITY_NAMES.items()}
+        self.player.clear(priorities.get(arg) if arg else None)
+        if not arg:
+            self.player.skip()
         return False
 
     def do_list_tracks(self, arg):
         """List music tracks."""
-        get_music_files()
-        for track in sorted([track for track in music_files.keys()]):
+        for track in sorted(self.music.tracks.keys()):
             if arg in track:
                 print(track)
 
-    def do_photo(self, arg):
-        """Capture a photo and store it with a timestamp in the filename."""
-        image_filename = os.path.join(config('noticeboard', 'camera', 'directory'),
-                                      datetime.datetime.now().isoformat()+".jpg")
-        self.log('(message "taking photo into %s")', image_filename)
-        self.camera.capture_file(image_filename)
+    def do_rescan(self, arg):
+        """Bring the music index up to date now, rather than waiting for the next periodic refresh."""
+        self.music.refresh_in_background()
         return False
-        # todo: compare with previous photo in series, and drop any that are very nearly the same
+
+    def refresh_music(self):
+        """Refresh the music index in the background, and arrange to do so again later."""
+        self.music.refresh_in_background()
+        self.scheduler.enter(config('noticeboard', 'music', 'refresh'), 2, self.refresh_music, ())
+
+    def do_photo(self, arg):
+        """Capture a photo and store it with a timestamp in the filename.
+        This is done in the background, and the photo is only kept if it
+        differs enough from the last one kept."""
+        if not self.photos.take():
+            print('(message "Still busy with earlier photos, not taking another")')
         return False
 
     def power(self, on):
         """Switch the 12V PSU on or off."""
-        if self.verbose:
-            self.log("setting 12V power %s", on)
-        GPIO.output(pins.PIN_PSU, GPIO.LOW if on else GPIO.HIGH)
+        self.log("setting 12V power %s", on, level=DEBUG)
+        gpio_output(pins.PIN_PSU, GPIO.LOW if on else GPIO.HIGH)
+        if on != self.v12_is_on:
+            self.events.publish('power', on=on)
         self.v12_is_on = on
 
     def sound(self, is_on):
         """Switch the active speaker power on or off."""
-        if self.verbose:
-            self.log("setting sound %s", on)
-        GPIO.output(pins.PIN_SPEAKER, GPIO.LOW if is_on else GPIO.HIGH)
+        self.log("setting sound %s", is_on, level=DEBUG)
+        gpio_output(pins.PIN_SPEAKER, GPIO.LOW if is_on else GPIO.HIGH)
+        if is_on != self.speaker_is_on:
+            self.events.publish('speaker', on=is_on)
+        self.speaker_is_on = is_on
 
-    def lamps(self, brightness):
+    def lamps(self, brightness, duration=None, curve=None):
         """Set the brightness of both lamps.
-        The actual brightness will be adjusted in several steps."""
+        The lamps fade to the new brightness over DURATION seconds,
+        driven by step_lamps."""
         self.brightness = float(brightness)
         if self.brightness > 0:
             self.power(True)
+        if duration is None:
+            duration = compiled_config().noticeboard.delays.fade
         for lamp in self._lamps:
-            lamp.set(self.brightness)
+            lamp.set(self.brightness, duration, curve)
+        self.lamps_fading = True
+        self.events.publish('lamp.fading', brightness=self.brightness, duration=duration)
+
+    def step_lamps(self):
+        """Update the lamps for any fades in progress.
+        Returns whether any of them are still fading."""
+        now = time.monotonic()
+        fading = any([lamp.step(now) for lamp in self._lamps])
+        if self.lamps_fading and not fading:
+            self.events.publish('lamp.reached', brightness=self.brightness)
+        self.lamps_fading = fading
+        return fading
 
     def extended(self):
         """Return whether the keyboard tray is extended, according to the limit switch."""
@@ -399,79 +675,127 @@ class NoticeBoardHardware(cmd.Cmd):
         """Return whether the keyboard tray is retracted, according to the limit switch."""
         return GPIO.input(pins.PIN_RETRACTED)
 
-    def check_temperature(self):
-        # TODO: read the temperature from pins.PIN_TEMPERATURE into self.temperature
-        pass
+    def temperature_sampled(self, celsius):
+        """Take a reading from the temperature sampler thread."""
+        self.temperature = celsius
+        self.events.publish('temperature', celsius=celsius)
+
+    def fans(self, on):
+        """Switch the enclosure fans on or off."""
+        self.log("switching fans %s at %sC", "on" if on else "off", self.temperature, level=DEBUG)
+        gpio_output(pins.PIN_FANS, GPIO.HIGH if on else GPIO.LOW)
+        self.events.publish('fans', on=on)
+
+    def do_temperature(self, arg):
+        """Show the temperature in the enclosure, and its range over the recent readings."""
+        if self.temperature is None:
+            print('(message "No temperature reading yet")')
+            return False
+        low, high = self.temperature_sampler.range()
+        print('(message "Temperature: %.1fC (%.1fC to %.1fC recently), fans %s")'
+              % (self.temperature, low, high, "on" if self.temperature_sampler.fans else "off"))
+        return False
 
     def check_pir(self):
-        """Check for state changes of the PIR detector."""
-        if GPIO.input(pins.PIN_PIR):
-            if self.pir_already_on:
-                self.pir_on_for += 1
-                if self.pir_on_for in self.pir_on_actions:
-                    for command in self.pir_on_actions[self.pir_on_for]:
-                        self.onecmd(command)
-            else:
-                self.pir_off_for = 0
-            self.pir_already_on = True
-        else:
-            if self.pir_already_on:
-                self.pir_on_for = 0
-            else:
-                self.pir_off_for += 1
-                if self.pir_off_for in self.pir_off_actions:
-                    for command in self.pir_off_actions[self.pir_off_for]:
-                        self.onecmd(command)
-            self.pir_already_on = False
+        """Check for state changes of the PIR detector.
+        This is only used if edge detection isn't available for the PIR pin."""
+        pir_on = GPIO.input(pins.PIN_PIR)
+        if pir_on != self.pir_already_on:
+            self.trace.edge(pins.PIN_PIR, pir_on)
+            self.pir_changed(pir_on)
+
+    def pir_changed(self, pir_on):
+        """Schedule the actions for the PIR detector going on or off.
+        The actions for the opposite transition are cancelled, so an
+        action only happens if the PIR stays in the new state for the
+        action's delay."""
+        self.pir_already_on = bool(pir_on)
+        if pir_on:
+            self.occupancy.observe()
+        for event in self.pir_scheduled_actions:
+            try:
+                self.scheduler.cancel(event)
+            except ValueError:
+                pass            # it has already run
+        self.pir_scheduled_actions = [
+            self.scheduler.enter(delay, 1, self.run_pir_action, ("on" if pir_on else "off", command))
+            for delay, commands in (self.pir_on_actions if pir_on else self.pir_off_actions).items()
+            for command in commands]
+        # after the actions are scheduled, so a subscriber can't stop them:
+        self.events.publish('pir', on=self.pir_already_on)
+
+    def run_pir_action(self, transition, command):
+        """Run a command that was scheduled by the PIR detector changing state."""
+        self.log("running %s after PIR went %s", command, transition, level=DEBUG)
+        self.onecmd(command)
 
     def add_pir_on_action(self, delay, action):
-        """Arrange a command to be run some number of steps after the PIR detector goes on."""
+        """Arrange a command to be run some number of seconds after the PIR detector goes on."""
         self.pir_on_actions[delay].append(action)
 
     def add_pir_off_action(self, delay, action):
-        """Arrange a command to be run some number of steps after the PIR detector goes off."""
+        """Arrange a command to be run some number of seconds after the PIR detector goes off."""
         self.pir_off_actions[delay].append(action)
 
-    def keyboard_step(self, stepmax):
-        """Operate the keyboard tray motor controller according to the required and actual positions."""
-        if self.keyboard_status == 'retracting':
-            if self.retracted() or self.moving_steps > stepmax:
-                print('(message "stopping retracting %d %d")' % (self.moving_steps, stepmax))
-                self.keyboard_status = 'retracted'
-                GPIO.output(pins.PIN_EXTEND, GPIO.LOW)
-                GPIO.output(pins.PIN_RETRACT, GPIO.LOW)
-                self.moving_steps = 0
-            else:
-                self.moving_steps += 1
-        elif self.keyboard_status == 'extending':
-            if self.extended() or self.moving_steps > stepmax:
-                print('(message "stopping extending %d %d")' % (self.moving_steps, stepmax))
-                self.keyboard_status = 'extended'
-                GPIO.output(pins.PIN_EXTEND, GPIO.LOW)
-                GPIO.output(pins.PIN_RETRACT, GPIO.LOW)
-                self.moving_steps = 0
-            else:
-                self.moving_steps += 1
+    def tray_changed(self):
+        """Report any change in where the keyboard tray is.
+        The motor itself is stopped by the tray's own edge hook, which
+        can't report the change as it runs on the GPIO callback thread."""
+        status = self.tray.status
+        if status == self.tray_reported:
+            return
+        self.tray_reported = status
+        if status == 'stalled':
+            self.log("keyboard tray didn't reach its limit switch in %.1f seconds, stopped it",
+                     self.tray.travel_time * self.tray.stall_margin)
+            print('(message "keyboard tray stalled")')
+        elif status in ARRIVED.values():
+            print('(message "keyboard tray %s in %.1f seconds")' % (status, self.tray.travelled or 0))
+        self.events.publish('tray', status=status)
+
+    def handle_edges(self):
+        """Act on the input edges reported since the last call.
+        The main loop calls this when the edge pipe becomes readable."""
+        for pin, level, when in self.edges.drain():
+            self.trace.edge(pin, level, when)
+            if pin == pins.PIN_PIR:
+                pir_on = GPIO.input(pins.PIN_PIR)
+                if pir_on != self.pir_already_on:
+                    self.pir_changed(pir_on)
+            elif pin in (pins.PIN_RETRACTED, pins.PIN_EXTENDED):
+                self.tray_changed()
+
+    def run_due_events(self, longest):
+        """Run any scheduled events that are due.
+        Returns how long the main loop can wait before the next one is due,
+        but no more than LONGEST."""
+        return max(0, min(longest, self.scheduler.run(blocking=False) or longest))
+
+    def sound_started(self, entry):
+        """Called by the playback queue when it starts a sound."""
+        self.log("started playing %s", entry)
+        self.events.publish('audio.start', kind=PRIORITY_NAMES[entry.priority], sound=entry.description)
+        self.sound(True)
+
+    def sound_finished(self, entry, completed):
+        """Called by the playback queue when a sound finishes or is dropped."""
+        self.log("%s %s", "finished playing" if completed else "dropped", entry)
+        self.events.publish('audio.stop', kind=PRIORITY_NAMES[entry.priority], sound=entry.description,
+                            completed=completed)
+        self.speaker_off_countdown = COUNTDOWN_START
 
     def check_for_sounds_finishing(self):
-        """Check for any sound processes having finished.
-        If they have all finished, switch the active speaker power off."""
-        if self.speech_process and self.speech_process.poll() is not None: # non-None if it has exited
-            self.log("speech process exited at %s" % datetime.datetime.now().isoformat())
-            self.speaker_off_countdown = COUNTDOWN_START
-            self.speech_process = None
-
-        if self.music_process and self.music_process.poll() is not None: # non-None if it has exited
-            self.log("music process exited at %s" % datetime.datetime.now().isoformat())
-            self.speaker_off_countdown = COUNTDOWN_START
-            self.music_process = None
-
-        if self.music_process is None and self.speech_process is None:
+        """Move the playback queue on.
+        If nothing is left playing, switch the active speaker power off
+        after a few more steps."""
+        self.player.update()
+
+        if not self.player.busy():
             if self.speaker_off_countdown > 0:
                 self.speaker_off_countdown -= 1
-                self.log("countdown to switching speaker off: %d, at %s" % (self.speaker_off_countdown, datetime.datetime.now().isoformat()))
+                self.log("countdown to switching speaker off: %d", self.speaker_off_countdown, level=DEBUG)
                 if self.speaker_off_countdown == 0:
-                    self.log("switching speaker off at %s" % datetime.datetime.now().isoformat())
+                    self.log("switching speaker off")
                     self.sound(False)
 
     def start_chores(self):
@@ -483,14 +807,20 @@ class NoticeBoardHardware(cmd.Cmd):
             # time to do so (in case we want to modify something that
             # is being modified by the user):
             signal_emacs(signal.SIGUSR1)
-            time.sleep(60)
+        except Exception as e:
+            self.log("Problem %s in signalling emacs", e, level=ERROR)
+        self.scheduler.enter(60, 1, self.launch_chores, ())
+
+    def launch_chores(self):
+        """Launch the chores process, once emacs has had time to save its buffers."""
+        try:
             self.log("Starting chores process")
-            self.chores_process = subprocess.Popen([os.path.join(os.path.dirname(__file__), "chores.py"),
-                                                    ],
-                                                   stdout=subprocess.DEVNULL,
-                                                   stderr=subprocess.DEVNULL)
+            self.chores_process = metrics.popen([os.path.join(os.path.dirname(__file__), "chores.py"),
+                                                 ],
+                                                stdout=subprocess.DEVNULL,
+                                                stderr=subprocess.DEVNULL)
         except Exception as e:
-            self.log("Problem %s in starting chores process" % e)
+            self.log("Problem %s in starting chores process", e, level=ERROR)
 
     def check_for_chores_finishing(self):
         """Check for the chores finishing, and do any resulting actions."""
@@ -498,29 +828,32 @@ class NoticeBoardHardware(cmd.Cmd):
             self.log("Chores process finished")
             self.chores_process = None
             self.chores_done_date = datetime.date.today()
-            signal_emacs(signal.SIGUSR2)
+            try:
+                signal_emacs(signal.SIGUSR2)
+            except Exception as e:
+                self.log("Problem %s in signalling emacs", e, level=ERROR)
 
     def step(self, active):
         """Perform one step of any active operations.
         Returns whether there's anything going on that needs
         the event loop to run fast."""
-        for lamp in self._lamps:
-            lamp.step()
-
-        self.keyboard_step(config('noticeboard', 'delays', 'step_max'))
+        moving = self.tray.step()
+        self.tray_changed()
 
         # something keeps switching the speaker off on the hour while
         # the chimes are playing, so keep switching it back on:
-        if self.music_process or self.speech_process:
+        if self.player.busy():
             self.sound(True)
 
         if not active:
             self.check_for_sounds_finishing()
-            self.check_temperature()
-            self.check_pir()
+            if not self.edges.watching(pins.PIN_PIR):
+                self.check_pir()
             self.check_for_chores_finishing()
 
-        return (self.keyboard_status in ('retracting', 'extending')
-                # or self.music_process
-                # or self.speech_process
-                or any(lamp.changing() for lamp in self._lamps))
+        return (self.tray.ramping()
+                # without edges, the limit switches must be polled quickly:
+                or (moving and not (self.edges.watching(pins.PIN_EXTENDED)
+                                    and self.edges.watching(pins.PIN_RETRACTED)))
+                # or self.player.busy()
+                )
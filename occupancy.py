@@ -0,0 +1,182 @@
+import datetime
+import os
+import pickle
+import re
+
+# When people are expected to be in the house.
+
+# The weekly timetable is compiled into a map of the week with one
+# entry per minute, so looking up whether someone is expected is just
+# indexing it.  Intervals may run past midnight ("22:00--01:30"), and
+# dated exceptions (holidays, days away) replace the weekly timetable
+# for their days.  Optionally, PIR activity is recorded for each
+# minute of the week, and minutes that have had activity in enough of
+# the recent weeks are added to the expected times.
+
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+ACTIVITY_VERSION = 1
+
+def convert_interval(interval_string):
+    """Convert a string giving start and end times into a tuple of minutes after midnight.
+    For the input "07:30--09:15" the output would be (450, 555)."""
+    matched = re.match("([0-2][0-9]):([0-5][0-9])--([0-2][0-9]):([0-5][0-9])", interval_string)
+    return (((int(matched.group(1))*60 + int(matched.group(2))),
+             (int(matched.group(3))*60 + int(matched.group(4))))
+            if matched
+            else None)
+
+def convert_intervals(intervals):
+    """Convert a dictionary of intervals."""
+    return {k: convert_interval(v) for k, v in intervals.items()}
+
+def mark_intervals(minutes, start_of_day, interval_strings):
+    """Mark the minutes of some intervals in a map, starting from START_OF_DAY.
+    Intervals ending before they start run on past midnight; the end
+    minute is included, as in the original timetable lookup."""
+    for interval_string in interval_strings or []:
+        interval = convert_interval(interval_string)
+        if interval is None:
+            continue
+        start, end = interval
+        if end < start:
+            end += MINUTES_PER_DAY
+        for minute in range(start_of_day + start, start_of_day + end + 1):
+            minutes[minute % len(minutes)] = 1
+
+def exception_dates(when):
+    """Return the dates an exception key covers: a date, or a range "2026-12-24--2027-01-02"."""
+    if isinstance(when, datetime.date):
+        return [when]
+    first, _, last = str(when).partition("--")
+    first = datetime.date.fromisoformat(first.strip())
+    last = datetime.date.fromisoformat(last.strip()) if last else first
+    return [first + datetime.timedelta(days=n) for n in range((last - first).days + 1)]
+
+class Occupancy(object):
+
+    pass
+
+    def __init__(self, timetable, exceptions=None,
+                 learning=False, activity_file=None, weeks=4, threshold=3, spread=30):
+        self.learning = learning
+        self.activity_file = activity_file
+        self.weeks = weeks
+        self.threshold = threshold
+        self.spread = spread
+        self.activity = {}      # (ISO year, ISO week) -> bytearray of minutes with PIR activity
+        self.learned = bytearray(MINUTES_PER_WEEK)
+        self.compile(timetable, exceptions)
+
+    def reconfigure(self, timetable, exceptions=None, **learning):
+        """Change the timetable, exceptions, and learning settings given to the constructor."""
+        for name, value in learning.items():
+            setattr(self, name, value)
+        self.compile(timetable, exceptions)
+        self.learn()
+
+    def compile(self, timetable, exceptions=None):
+        """Make the map of the week, and the maps of the exceptional days.
+        TIMETABLE maps day names to lists of intervals; EXCEPTIONS maps
+        dates or date ranges to lists of intervals, or to the name of a
+        day whose timetable to use."""
+        week = bytearray(MINUTES_PER_WEEK)
+        for day, interval_strings in timetable.items():
+            if day in DAY_NAMES:
+                mark_intervals(week, DAY_NAMES.index(day) * MINUTES_PER_DAY, interval_strings)
+        # each day's intervals over two days, so that intervals past
+        # midnight land in the second, for making the exceptional days:
+        def two_days(interval_strings):
+            minutes = bytearray(2 * MINUTES_PER_DAY)
+            mark_intervals(minutes, 0, interval_strings)
+            return minutes
+        regular = [two_days(timetable.get(day)) for day in DAY_NAMES]
+        exceptional = {}
+        for when, interval_strings in (exceptions or {}).items():
+            if isinstance(interval_strings, str):
+                interval_strings = timetable.get(interval_strings, [])
+            for date in exception_dates(when):
+                exceptional[date] = two_days(interval_strings)
+        def day_and_spill(date):
+            return exceptional[date] if date in exceptional else regular[date.weekday()]
+        # an exceptional day, or the day after one, has its own
+        # intervals and what runs on from the evening before it:
+        days = {}
+        one_day = datetime.timedelta(days=1)
+        for date in set(exceptional) | {date + one_day for date in exceptional}:
+            today, yesterday = day_and_spill(date), day_and_spill(date - one_day)
+            days[date] = bytearray(a | b for a, b in zip(today[:MINUTES_PER_DAY],
+                                                          yesterday[MINUTES_PER_DAY:]))
+        self.week = week
+        self.days = days
+        self.combine()
+
+    def combine(self):
+        """Make the map that expected() looks in, from the timetable and what has been learned."""
+        self.expected_minutes = (bytearray(a | b for a, b in zip(self.week, self.learned))
+                                 if self.learning
+                                 else self.week)
+
+    def expected(self, when=None):
+        """Return whether anyone is expected to be in the house at a given time (by default, now)."""
+        when = when or datetime.datetime.now()
+        minute = when.hour * 60 + when.minute
+        day = self.days.get(when.date())
+        if day is not None:
+            return bool(day[minute])
+        return bool(self.expected_minutes[when.weekday() * MINUTES_PER_DAY + minute])
+
+    def next_change(self, when=None):
+        """Return when the expected occupancy next changes, within the next week, or None."""
+        when = (when or datetime.datetime.now()).replace(second=0, microsecond=0)
+        now = self.expected(when)
+        for minutes in range(1, MINUTES_PER_WEEK + 1):
+            later = when + datetime.timedelta(minutes=minutes)
+            if self.expected(later) != now:
+                return later
+        return None
+
+    def observe(self, when=None):
+        """Record PIR activity, as evidence that someone is at home around that time."""
+        if not self.learning:
+            return
+        when = when or datetime.datetime.now()
+        year, week, _ = when.isocalendar()
+        activity = self.activity.get((year, week))
+        if activity is None:
+            activity = self.activity[(year, week)] = bytearray(MINUTES_PER_WEEK)
+            for old in sorted(self.activity)[:-self.weeks]:
+                del self.activity[old]
+        minute = when.weekday() * MINUTES_PER_DAY + when.hour * 60 + when.minute
+        for spread in range(minute - self.spread, minute + self.spread + 1):
+            activity[spread % MINUTES_PER_WEEK] = 1
+
+    def learn(self):
+        """Add the minutes that have had activity in enough recent weeks to the expected times."""
+        if not self.learning:
+            return
+        counts = [sum(column) for column in zip(*self.activity.values())] or [0] * MINUTES_PER_WEEK
+        self.learned = bytearray(1 if count >= self.threshold else 0 for count in counts)
+        self.combine()
+
+    def load(self):
+        """Load the activity recorded by previous runs, if there is any."""
+        if self.learning and self.activity_file and os.path.exists(self.activity_file):
+            try:
+                with open(self.activity_file, 'rb') as instream:
+                    version, activity = pickle.load(instream)
+                if version == ACTIVITY_VERSION:
+                    self.activity = activity
+                    self.learn()
+            except (OSError, ValueError, EOFError, pickle.UnpicklingError):
+                pass            # start learning again
+
+    def save(self):
+        if self.learning and self.activity_file:
+            os.makedirs(os.path.dirname(self.activity_file), exist_ok=True)
+            temporary = self.activity_file + ".new"
+            with open(temporary, 'wb') as outstream:
+                pickle.dump((ACTIVITY_VERSION, self.activity), outstream)
+            os.replace(temporary, self.activity_file)
@@ -0,0 +1,87 @@
+import datetime
+import os
+import queue
+import threading
+
+# Taking photos without holding up the controller.
+
+# The commands only ask for a photo; a worker thread captures the
+# frame into memory, compares a downscaled greyscale version of it
+# with the last photo kept, and only encodes and writes it if enough
+# of the picture has changed, so a series of photos of an empty room
+# doesn't fill the disk with copies.
+
+def downscale(grey, size):
+    """Shrink a greyscale image to SIZE by averaging blocks of pixels."""
+    width, height = size
+    rows, columns = grey.shape[0] // height, grey.shape[1] // width
+    return (grey[:rows * height, :columns * width]
+            .reshape(height, rows, width, columns)
+            .mean(axis=(1, 3)))
+
+def changed_fraction(before, after, pixel_threshold):
+    """Return the fraction of the pixels that differ by more than PIXEL_THRESHOLD."""
+    return float((abs(after - before) > pixel_threshold).mean())
+
+def save_jpeg(frame, filename, quality):
+    from PIL import Image       # only needed once there's a photo to save
+    Image.fromarray(frame).save(filename, quality=quality)
+
+class PhotoPipeline(object):
+
+    pass
+
+    def __init__(self, camera, directory,
+                 compare_size=(80, 60), pixel_threshold=25, changed_fraction=0.01,
+                 quality=90, queue_length=8, log=None):
+        self.camera = camera
+        self.directory = directory
+        self.compare_size = tuple(compare_size)
+        self.pixel_threshold = pixel_threshold
+        self.changed_fraction = changed_fraction
+        self.quality = quality
+        self.log = log or (lambda message, *message_data: None)
+        self.requests = queue.Queue(queue_length)
+        self.previous = None    # the downscaled preview of the last photo kept
+        self.kept = 0
+        self.similar = 0
+        self.dropped = 0
+        self.worker = None
+
+    def take(self, name=None):
+        """Ask for a photo, returning straight away.
+        Returns False if the worker is too far behind to take it."""
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run, daemon=True)
+            self.worker.start()
+        try:
+            self.requests.put_nowait((datetime.datetime.now(), name))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def run(self):
+        while True:
+            when, name = self.requests.get()
+            try:
+                self.process(when, name)
+            except Exception as e:
+                self.log("could not take photo: %s", e)
+
+    def process(self, when, name=None):
+        """Capture a frame, and keep it if it differs enough from the last one kept.
+        Returns the filename it was written to, or None if it was dropped."""
+        frame, preview = self.camera.capture()
+        small = downscale(preview, self.compare_size)
+        if (self.previous is not None
+            and changed_fraction(self.previous, small, self.pixel_threshold) < self.changed_fraction):
+            self.similar += 1
+            return None
+        self.previous = small
+        filename = os.path.join(self.directory, (name or when.isoformat()) + ".jpg")
+        os.makedirs(self.directory, exist_ok=True)
+        save_jpeg(frame, filename, self.quality)
+        self.kept += 1
+        self.log("photo saved as %s", filename)
+        return filename
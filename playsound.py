@@ -4,7 +4,7 @@ import argparse
 from pathlib import Path
 import subprocess
 
-import RPi.GPIO as GPIO
+from hardware_backend import GPIO
 
 import pins
 
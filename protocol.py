@@ -0,0 +1,49 @@
+import json
+
+# Framing for the command port.
+
+# Each request is one line.  A line holding a JSON object, such as
+#   {"id": 7, "command": "shine 3"}
+# gets a one-line JSON reply carrying the same id:
+#   {"id": 7, "ok": true, "output": "..."}
+# so a client can send many requests on one connection without
+# waiting, and match up the replies.  Any other line is taken as a
+# plain command, and its output is sent back as it is, as before.
+
+# After a "subscribe" command (optionally naming topics, as described
+# in events.py), the connection is also sent a JSON line for each
+# state-change event, such as
+#   {"event": "pir", "time": 1760000000.0, "on": true}
+# which can be told apart from replies by having no id.
+
+class RequestError(Exception):
+    pass
+
+def parse_request(line):
+    """Return the request id, the command, and whether the reply should be JSON."""
+    try:
+        text = line.decode('utf-8').strip()
+    except UnicodeDecodeError as e:
+        raise RequestError("could not decode request: %s" % e)
+    if not text.startswith('{'):
+        return None, text, False
+    try:
+        request = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise RequestError("could not parse request: %s" % e)
+    if not isinstance(request, dict) or not isinstance(request.get('command'), str):
+        raise RequestError("request must be an object with a command string")
+    return request.get('id'), request['command'], True
+
+def format_reply(request_id, output, error=None, structured=True):
+    """Make the bytes of the reply to a request."""
+    if not structured:
+        return bytes(output + ("%s\n" % error if error else ""), encoding='utf-8')
+    reply = {'id': request_id, 'ok': error is None, 'output': output}
+    if error:
+        reply['error'] = error
+    return bytes(json.dumps(reply) + "\n", encoding='utf-8')
+
+def format_event(event):
+    """Make the bytes of an event notification."""
+    return bytes(json.dumps(event) + "\n", encoding='utf-8')
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# Replaying a trace recorded by the controller (see sensor_trace.py)
+# through the controller running on the simulated hardware, to
+# reproduce problems that depend on the timing of real-world events,
+# and to compare versions on the same activity.
+
+# The PIR edges and the commands in the trace are fed in at their
+# recorded times, sped up by --speed, and with long quiet spells cut
+# short by --longest-gap.  The limit switch edges aren't replayed, as
+# the simulated tray makes its own.  The controller's own delays
+# (the PIR actions, fades and tray travel) are sped up along with the
+# replay, so the sequence of events stays as it was; its polling
+# isn't, so at high speeds it is a stress test.
+
+# The results are the PIR-to-lamp reaction (beyond the shine delay),
+# command round trips, how late the replay fed the inputs in, and the
+# controller's own step and loop timings, and can be saved and
+# compared with a baseline as for benchmark.py.  With --record, the
+# replay's own trace is recorded, and its scheduled events counted
+# against the original's.
+
+import os
+
+# this must be set before anything imports hardware_backend:
+os.environ.setdefault("NOTICEBOARD_HARDWARE", "sim")
+
+import argparse
+import collections
+import shutil
+import sys
+import tempfile
+import time
+
+import lifehacking_config
+import metrics
+import pins
+import sim_gpio
+
+from benchmark import benchmark_settings, controller_timings, from_start, report, start_controller
+from lifehacking_config import config, update_config
+from sensor_trace import read_trace
+
+RESULTS = {
+    'pir_reaction_p50': ("PIR to lamp reaction, median (s)", False),
+    'pir_reaction_max': ("PIR to lamp reaction, worst (s)", False),
+    'round_trip_p50': ("command round trip, median (s)", False),
+    'round_trip_p99': ("command round trip, 99th percentile (s)", False),
+    'lateness_p99': ("input replay lateness, 99th percentile (s)", False),
+    'step_p99': ("controller step, 99th percentile (s)", False),
+    'loop_lateness_p99': ("loop wakeup lateness, 99th percentile (s)", False),
+}
+
+# the delays that go with the trace's timing, rather than being polling intervals:
+SCALED_DELAYS = ['fade', 'shine', 'quench', 'photo', 'extend', 'retract']
+SCALED_TRAY = ['travel_time', 'ramp']
+
+# pins whose edges come from the simulation rather than the trace:
+SIMULATED_PINS = {pins.PIN_EXTENDED, pins.PIN_RETRACTED}
+
+# commands that would upset the replay itself:
+SKIPPED_COMMANDS = {'quit', 'trace', 'subscribe', 'unsubscribe'}
+
+def replay_settings(speed):
+    """Return the config changes that speed up the controller's own timings along with the replay."""
+    delays = config('noticeboard', 'delays')
+    tray = config('noticeboard', 'tray')
+    return {'noticeboard': {'delays': {name: delays[name] / speed for name in SCALED_DELAYS},
+                            'tray': {name: tray[name] / speed for name in SCALED_TRAY}}}
+
+class ReactionTimer(object):
+
+    """Time how long the lamps take to start lighting after the PIR goes on,
+    beyond the delay they are meant to wait."""
+
+    pass
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.since = None
+        self.lit = False
+        self.reactions = metrics.Histogram("pir reaction", "pir reaction")
+        sim_gpio.add_listener(self.output_changed)
+
+    def pir(self, level, now):
+        self.since = now if level and not self.lit else None
+
+    def output_changed(self, channel, kind, value):
+        if channel != pins.PIN_LAMP_LEFT:
+            return
+        lit = bool(value)
+        if lit and not self.lit and self.since is not None:
+            self.reactions.record(max(0.0, time.monotonic() - self.since - self.delay))
+            self.since = None
+        self.lit = lit
+
+def replayable(entry):
+    """Return whether an entry of a trace is an input to feed back in."""
+    if entry['kind'] == 'edge':
+        return entry['pin'] not in SIMULATED_PINS
+    if entry['kind'] == 'command':
+        words = entry['command'].split()
+        return bool(words) and words[0] not in SKIPPED_COMMANDS
+    return False
+
+def replay(entries, client, timer, speed, longest_gap):
+    """Feed the inputs of a trace into the controller.
+    Returns the lateness and round trip histograms, and how many inputs were fed in."""
+    lateness = metrics.Histogram("lateness", "lateness")
+    round_trips = metrics.Histogram("round trip", "round trip")
+    inputs = [entry for entry in entries if replayable(entry)]
+    due = time.monotonic()
+    previous = inputs[0]['time'] if inputs else 0
+    for entry in inputs:
+        gap = (entry['time'] - previous) / speed
+        due += min(gap, longest_gap) if longest_gap is not None else gap
+        previous = entry['time']
+        if (wait := due - time.monotonic()) > 0:
+            time.sleep(wait)
+        lateness.record(max(0.0, time.monotonic() - due))
+        if entry['kind'] == 'edge':
+            if entry['pin'] == pins.PIN_PIR:
+                timer.pir(entry['level'], time.monotonic())
+            sim_gpio.set_input(entry['pin'], entry['level'])
+        else:
+            started = time.perf_counter()
+            client.request(entry['command'])
+            round_trips.record(time.perf_counter() - started)
+    return lateness, round_trips, len(inputs)
+
+def scheduled_counts(entries):
+    """Count the scheduled events in a trace, by the action's name."""
+    return collections.Counter(entry['action'].split()[0]
+                               for entry in entries
+                               if entry['kind'] == 'scheduled')
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("trace",
+                        help="""The trace file to replay.""")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="""How many times faster than real time to replay it.""")
+    parser.add_argument("--longest-gap", type=float,
+                        help="""The longest wait between inputs, in seconds after speeding up.""")
+    parser.add_argument("--port", type=int, default=10198,
+                        help="""The command port for the controller being replayed into.""")
+    parser.add_argument("--record",
+                        help="""A file to record the replay's own trace into.""")
+    parser.add_argument("--save",
+                        help="""A file to write the results into, as JSON.""")
+    parser.add_argument("--baseline",
+                        help="""A file of earlier results, from --save, to compare with.""")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="""How much worse than the baseline a result may be, as a fraction.""")
+    parser.add_argument("--slack", type=float, default=0.01,
+                        help="""How many seconds a time may be over the baseline, besides the tolerance.""")
+    args = parser.parse_args()
+
+    entries = read_trace(from_start(args.trace))
+    record = from_start(args.record)
+    lifehacking_config.load_config()
+    directory = tempfile.mkdtemp(prefix="noticeboard-replay-")
+    # the delays from the real config, before the benchmark settings take them out:
+    scaled = replay_settings(args.speed)
+    update_config(benchmark_settings(directory, args.port))
+    update_config(scaled)
+    if record:
+        if os.path.exists(record):
+            os.remove(record)   # rather than adding to an earlier replay's
+        update_config({'noticeboard': {'trace': {'file': record}}})
+    # the keyboard tray, moving between its limit switches:
+    sim_gpio.LinearActuator(pins.PIN_EXTEND, pins.PIN_RETRACT, pins.PIN_EXTENDED, pins.PIN_RETRACTED,
+                            config('noticeboard', 'tray', 'travel_time'))
+
+    controller, controller_stdin, client = start_controller(args.port)
+    timer = ReactionTimer(config('noticeboard', 'delays', 'shine'))
+    started = time.monotonic()
+    lateness, round_trips, count = replay(entries, client, timer, args.speed, args.longest_gap)
+    took = time.monotonic() - started
+    client.close()
+    os.write(controller_stdin, b"quit\n")
+    controller.join(30)
+    shutil.rmtree(directory, ignore_errors=True)
+
+    if entries:
+        print("replayed %d inputs from %.0f seconds of trace in %.1f seconds"
+              % (count, entries[-1]['time'] - entries[0]['time'], took))
+    if record:
+        original, replayed = scheduled_counts(entries), scheduled_counts(read_trace(record))
+        for action in sorted(set(original) | set(replayed)):
+            print("%-30s %6d recorded %6d replayed" % (action, original[action], replayed[action]))
+    results = {'pir_reaction_p50': timer.reactions.percentile(0.5),
+               'pir_reaction_max': timer.reactions.largest,
+               'round_trip_p50': round_trips.percentile(0.5),
+               'round_trip_p99': round_trips.percentile(0.99),
+               'lateness_p99': lateness.percentile(0.99)}
+    results.update(controller_timings())
+    if not report(results, RESULTS, from_start(args.save), from_start(args.baseline),
+                  args.tolerance, args.slack):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@
 import argparse
 import subprocess
 
-import RPi.GPIO as GPIO
+from hardware_backend import GPIO
 
 import pins
 
@@ -0,0 +1,112 @@
+import functools
+import json
+import queue
+import sched
+import threading
+import time
+
+# Traces of what happened to the controller, for replaying through
+# it later (see replay.py) to reproduce problems that depend on the
+# timing of real-world events, and to compare versions on the same
+# activity.
+
+# A trace is a file of JSON lines, each with the wall-clock time and
+# the kind of entry:
+#   {"time": ..., "kind": "edge", "pin": 17, "level": 1}
+#   {"time": ..., "kind": "command", "command": "shine"}
+#   {"time": ..., "kind": "scheduled", "action": "run_pir_action on shine"}
+# Edges and commands are the inputs that a replay feeds back in;
+# scheduled events are what the controller did about them, recorded
+# so that a replay's trace can be compared with the original.  The
+# lines are written by a thread of their own, as for the log.
+
+class TraceRecorder(object):
+
+    pass
+
+    def __init__(self, queue_length=4096):
+        self.filename = None
+        self.entries = queue.Queue(queue_length)
+        self.dropped = 0
+        self.writer = None
+
+    def recording(self):
+        return self.writer is not None
+
+    def start(self, filename):
+        """Start recording into FILENAME, adding to it if it already exists."""
+        self.stop()
+        stream = open(filename, 'a')
+        self.filename = filename
+        self.writer = threading.Thread(target=self.run, args=(stream,), daemon=True)
+        self.writer.start()
+
+    def stop(self):
+        """Write any queued entries, and stop recording."""
+        if self.writer:
+            self.entries.put(None)
+            self.writer.join()
+            self.writer = None
+            self.filename = None
+
+    def record(self, kind, when=None, **details):
+        if self.writer is None:
+            return
+        details['time'] = when or time.time()
+        details['kind'] = kind
+        try:
+            self.entries.put_nowait(details)
+        except queue.Full:
+            self.dropped += 1
+
+    def edge(self, pin, level, when=None):
+        self.record('edge', when, pin=pin, level=int(level))
+
+    def command(self, command):
+        self.record('command', command=command)
+
+    def scheduled(self, action):
+        self.record('scheduled', action=action)
+
+    def run(self, stream):
+        with stream:
+            while True:
+                batch = [self.entries.get()]
+                while batch[-1] is not None:
+                    try:
+                        batch.append(self.entries.get_nowait())
+                    except queue.Empty:
+                        break
+                finished = batch[-1] is None
+                if finished:
+                    batch.pop()
+                stream.write("".join(json.dumps(entry) + "\n" for entry in batch))
+                stream.flush()
+                if finished:
+                    return
+
+class TracedScheduler(sched.scheduler):
+
+    """A scheduler that records each event in the trace as it runs."""
+
+    pass
+
+    def __init__(self, timefunc=time.time, delayfunc=time.sleep):
+        super().__init__(timefunc, delayfunc)
+        self.recorder = None
+
+    def enterabs(self, when, priority, action, argument=(), kwargs=None):
+        # keeping the action's name, for listing the queue:
+        @functools.wraps(action)
+        def traced(*action_arguments, **action_kwargs):
+            if self.recorder:
+                self.recorder.scheduled(" ".join([getattr(action, '__name__', str(action))]
+                                                 + [str(argument) for argument in action_arguments]))
+            return action(*action_arguments, **action_kwargs)
+        return super().enterabs(when, priority, traced, argument, kwargs or {})
+
+def read_trace(filename):
+    """Return the entries of a trace, in the order of their times."""
+    with open(filename) as instream:
+        entries = [json.loads(line) for line in instream if line.strip()]
+    return sorted(entries, key=lambda entry: entry['time'])
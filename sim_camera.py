@@ -0,0 +1,138 @@
+import threading
+import time
+
+import numpy
+
+# A simulation of the parts of picamera2 that camera.py uses, for
+# running the controller without a Pi camera.
+
+# Frames come at the configured frame rate, with capture_array waiting
+# for the next one as the real camera does, in the configured sizes and
+# formats (BGR888 main, YUV420 lores).  The picture is a still grey
+# scene with a little sensor noise; setting scene.moving puts a bright
+# block moving across it, for the motion detection and photo
+# de-duplication to see.  The "H.264" written while recording is one
+# access unit delimiter per frame time, so clip files are of a length
+# that goes with their duration, without the cost of encoding anything.
+
+ACCESS_UNIT_DELIMITER = b'\x00\x00\x00\x01\x09\x10'
+
+class Scene(object):
+
+    pass
+
+    def __init__(self):
+        self.moving = False
+        self.noise = 3          # the spread of the sensor noise, out of 255
+        self.started = time.monotonic()
+
+    def luminance(self, size, now):
+        """Return the greyscale picture at time NOW, in the given size."""
+        width, height = size
+        picture = numpy.full((height, width), 100, dtype=numpy.int16)
+        if self.noise:
+            picture += numpy.random.randint(-self.noise, self.noise + 1, (height, width), dtype=numpy.int16)
+        if self.moving:
+            block = max(1, width // 8)
+            left = int((now - self.started) * width / 4) % max(1, width - block)
+            top = height // 3
+            picture[top:top + block, left:left + block] = 240
+        return picture.clip(0, 255).astype(numpy.uint8)
+
+scene = Scene()
+
+class H264Encoder(object):
+
+    pass
+
+    def __init__(self, bitrate=None):
+        self.bitrate = bitrate
+
+class FileOutput(object):
+
+    pass
+
+    def __init__(self, filename):
+        self.filename = filename
+
+class Picamera2(object):
+
+    pass
+
+    def __init__(self, frame_rate=30):
+        self.frame_interval = 1 / frame_rate
+        self.configuration = None
+        self.started = False
+        self.next_frame = 0
+        self.lock = threading.Lock()
+        self.recording = None   # the open output file while encoding
+        self.recording_started = 0
+
+    def create_video_configuration(self, main=None, lores=None):
+        return {'main': dict(main or {'size': (1280, 720), 'format': "XBGR8888"}),
+                'lores': dict(lores) if lores else None}
+
+    def configure(self, configuration):
+        if self.started:
+            raise RuntimeError("Camera must be stopped before configuring")
+        self.configuration = configuration
+
+    def start(self):
+        if self.configuration is None:
+            raise RuntimeError("Camera has not been configured")
+        self.started = True
+        self.next_frame = time.monotonic()
+
+    def stop(self):
+        self.stop_encoder()
+        self.started = False
+
+    def close(self):
+        self.stop()
+
+    def wait_for_frame(self):
+        """Wait for the next frame time, and return it."""
+        if not self.started:
+            raise RuntimeError("Camera is not running")
+        with self.lock:
+            now = time.monotonic()
+            if self.next_frame > now:
+                time.sleep(self.next_frame - now)
+            else:
+                self.next_frame = now           # frames were missed; catch up
+            when = self.next_frame
+            self.next_frame += self.frame_interval
+        return when
+
+    def make_array(self, name, when):
+        stream = self.configuration[name]
+        if stream is None:
+            raise RuntimeError("%s stream is not configured" % name)
+        width, height = stream['size']
+        grey = scene.luminance(stream['size'], when)
+        if stream['format'] == "YUV420":
+            return numpy.concatenate([grey,
+                                      numpy.full((height // 2, width), 128, dtype=numpy.uint8)])
+        channels = 4 if stream['format'].startswith("X") else 3
+        return numpy.repeat(grey[:, :, numpy.newaxis], channels, axis=2)
+
+    def capture_array(self, name="main"):
+        return self.make_array(name, self.wait_for_frame())
+
+    def capture_arrays(self, names=["main"]):
+        when = self.wait_for_frame()
+        return [self.make_array(name, when) for name in names], {'SensorTimestamp': int(when * 1e9)}
+
+    def start_encoder(self, encoder, output):
+        self.stop_encoder()
+        with self.lock:
+            self.recording = open(output.filename, 'wb')
+            self.recording_started = time.monotonic()
+
+    def stop_encoder(self):
+        with self.lock:
+            if self.recording:
+                frames = int((time.monotonic() - self.recording_started) / self.frame_interval)
+                self.recording.write(ACCESS_UNIT_DELIMITER * frames)
+                self.recording.close()
+                self.recording = None
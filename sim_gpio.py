@@ -0,0 +1,338 @@
+import queue
+import threading
+import time
+import traceback
+
+# A simulation of the RPi.GPIO module, for running and measuring the
+# controller on a machine without the Pi's pins.
+
+# It keeps to RPi.GPIO's interface and its rules: the numbering mode
+# must be set, and channels set up, before they are used, and the
+# same errors are raised as RPi.GPIO raises when they aren't.  Edge
+# callbacks are called on a thread of their own, as RPi.GPIO does,
+# with the bounce time applied.  PWM objects keep their duty cycle,
+# rather than toggling a pin.
+
+# The simulation side drives the inputs with set_input, and sees the
+# outputs through output_level, pwm_duty, and listeners added with
+# add_listener, which are called on every change.  LinearActuator
+# models a motor with limit switches at each end of its travel, such
+# as the keyboard tray's.
+
+BOARD = 10
+BCM = 11
+IN = 1
+OUT = 0
+LOW = 0
+HIGH = 1
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+VERSION = "simulated"
+RPI_INFO = {'P1_REVISION': 3, 'REVISION': "simulated", 'TYPE': "simulated",
+            'MANUFACTURER': "none", 'PROCESSOR': "none", 'RAM': "none"}
+
+class Channel(object):
+
+    pass
+
+    def __init__(self, direction, level, pull):
+        self.direction = direction
+        self.level = level
+        self.pull = pull
+        self.edge = None        # the edge type being detected, if any
+        self.callbacks = []
+        self.bouncetime = None
+        self.last_edge = None
+        self.detected = False
+        self.pwm = None
+
+lock = threading.RLock()
+mode = None
+warnings = True
+channels = {}                   # channel number -> Channel
+driven = {}                     # channel number -> level from set_input
+listeners = []                  # functions called with (channel, kind, value) on output changes
+edges = queue.Queue()           # (callbacks, channel) for the callback thread
+dispatcher = None
+
+def check_mode():
+    if mode is None:
+        raise RuntimeError("Please set pin numbering mode using GPIO.setmode(GPIO.BOARD) or GPIO.setmode(GPIO.BCM)")
+
+def set_up(channel):
+    """Return the Channel for CHANNEL, which must have been set up."""
+    check_mode()
+    if channel not in channels:
+        raise RuntimeError("You must setup() the GPIO channel first")
+    return channels[channel]
+
+def each(channel_or_channels):
+    return (channel_or_channels
+            if isinstance(channel_or_channels, (list, tuple))
+            else [channel_or_channels])
+
+def setwarnings(flag):
+    global warnings
+    warnings = flag
+
+def setmode(new_mode):
+    global mode
+    if new_mode not in (BOARD, BCM):
+        raise ValueError("An invalid mode was passed to setmode()")
+    if mode is not None and new_mode != mode:
+        raise ValueError("A different mode has already been set!")
+    mode = new_mode
+
+def getmode():
+    return mode
+
+def setup(channel, direction, pull_up_down=PUD_OFF, initial=None):
+    check_mode()
+    if direction not in (IN, OUT):
+        raise ValueError("An invalid direction was passed to setup()")
+    if direction == OUT and pull_up_down != PUD_OFF:
+        raise ValueError("pull_up_down parameter is not valid for outputs")
+    with lock:
+        for number in each(channel):
+            existing = channels.get(number)
+            if direction == IN:
+                level = driven.get(number, int(pull_up_down == PUD_UP))
+            else:
+                level = LOW if initial is None else int(bool(initial))
+            new = Channel(direction, level, pull_up_down)
+            if existing:
+                new.pwm = existing.pwm
+            channels[number] = new
+            if direction == OUT:
+                notify(number, 'level', level)
+
+def input(channel):
+    with lock:
+        return set_up(channel).level
+
+def output(channel, value):
+    with lock:
+        numbers = each(channel)
+        values = each(value) if isinstance(value, (list, tuple)) else [value] * len(numbers)
+        if len(values) != len(numbers):
+            raise RuntimeError("Number of channels != number of values")
+        for number, level in zip(numbers, values):
+            if set_up(number).direction != OUT:
+                raise RuntimeError("The GPIO channel has not been set up as an OUTPUT")
+            channels[number].level = int(bool(level))
+            notify(number, 'level', channels[number].level)
+
+def gpio_function(channel):
+    with lock:
+        return channels[channel].direction if channel in channels else IN
+
+def cleanup(channel=None):
+    global mode
+    with lock:
+        for number in (each(channel) if channel is not None else list(channels)):
+            state = channels.pop(number, None)
+            driven.pop(number, None)
+            if state and state.pwm:
+                state.pwm.stop()
+        if channel is None:
+            mode = None
+
+def add_event_detect(channel, edge, callback=None, bouncetime=None):
+    global dispatcher
+    if edge not in (RISING, FALLING, BOTH):
+        raise ValueError("The edge must be set to RISING, FALLING or BOTH")
+    with lock:
+        state = set_up(channel)
+        if state.direction != IN:
+            raise RuntimeError("You must setup() the GPIO channel as an input first")
+        if state.edge is not None:
+            raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+        state.edge = edge
+        state.bouncetime = bouncetime
+        state.callbacks = [callback] if callback else []
+        if dispatcher is None:
+            dispatcher = threading.Thread(target=dispatch, daemon=True)
+            dispatcher.start()
+
+def add_event_callback(channel, callback):
+    with lock:
+        state = set_up(channel)
+        if state.edge is None:
+            raise RuntimeError("Add event detection using add_event_detect first before adding a callback")
+        state.callbacks.append(callback)
+
+def remove_event_detect(channel):
+    with lock:
+        state = set_up(channel)
+        state.edge = None
+        state.callbacks = []
+
+def event_detected(channel):
+    with lock:
+        state = set_up(channel)
+        detected, state.detected = state.detected, False
+        return detected
+
+def dispatch():
+    while True:
+        callbacks, channel = edges.get()
+        try:
+            for callback in callbacks:
+                callback(channel)
+        except Exception:
+            traceback.print_exc()       # as RPi.GPIO does, keeping the thread going
+        finally:
+            edges.task_done()
+
+class PWM(object):
+
+    pass
+
+    def __init__(self, channel, frequency):
+        with lock:
+            state = set_up(channel)
+            if state.direction != OUT:
+                raise RuntimeError("You must setup() the GPIO channel as an output first")
+            if state.pwm is not None:
+                raise RuntimeError("A PWM object already exists for this GPIO channel")
+            if frequency <= 0.0:
+                raise ValueError("frequency must be greater than 0.0")
+            self.channel = channel
+            self.frequency = frequency
+            self.duty = None    # not running
+            state.pwm = self
+
+    def start(self, duty):
+        check_duty(duty)
+        self.duty = float(duty)
+        notify(self.channel, 'duty', self.duty)
+
+    def ChangeDutyCycle(self, duty):
+        check_duty(duty)
+        if self.duty is not None:
+            self.duty = float(duty)
+            notify(self.channel, 'duty', self.duty)
+
+    def ChangeFrequency(self, frequency):
+        if frequency <= 0.0:
+            raise ValueError("frequency must be greater than 0.0")
+        self.frequency = frequency
+
+    def stop(self):
+        if self.duty is not None:
+            self.duty = None
+            notify(self.channel, 'duty', 0.0)
+
+def check_duty(duty):
+    if not 0.0 <= duty <= 100.0:
+        raise ValueError("dutycycle must have a value from 0.0 to 100.0")
+
+# The simulation side:
+
+def notify(channel, kind, value):
+    for listener in listeners:
+        listener(channel, kind, value)
+
+def add_listener(listener):
+    """Call LISTENER with (channel, kind, value) whenever an output changes.
+    KIND is 'level' for plain outputs and 'duty' for PWM, whose duty
+    cycle is 0 when stopped.  It is called on the thread making the change."""
+    listeners.append(listener)
+
+def remove_listener(listener):
+    listeners.remove(listener)
+
+def set_input(channel, level):
+    """Drive an input, as the outside world would, raising its edge callbacks."""
+    level = int(bool(level))
+    with lock:
+        driven[channel] = level
+        state = channels.get(channel)
+        if state is None or state.direction != IN or state.level == level:
+            return
+        state.level = level
+        if state.edge is None or state.edge == (FALLING if level else RISING):
+            return
+        now = time.monotonic()
+        if (state.bouncetime
+            and state.last_edge is not None
+            and (now - state.last_edge) * 1000 < state.bouncetime):
+            return
+        state.last_edge = now
+        state.detected = True
+        if state.callbacks:
+            edges.put((list(state.callbacks), channel))
+
+def output_level(channel):
+    with lock:
+        state = channels.get(channel)
+        return state.level if state else None
+
+def pwm_duty(channel):
+    """Return the duty cycle of the PWM on CHANNEL, or None if it isn't running."""
+    with lock:
+        state = channels.get(channel)
+        return state.pwm.duty if state and state.pwm else None
+
+def settle():
+    """Wait until the edge callbacks raised so far have all been called."""
+    edges.join()
+
+class LinearActuator(object):
+
+    """A motor driving something between two limit switches.
+    The motor runs forwards while the FORWARD channel is driven (as a
+    level or a PWM duty cycle) and backwards while BACKWARD is, at a
+    speed in proportion to the drive, taking TRAVEL_TIME seconds from
+    end to end at full power.  The limit switch inputs go high at the
+    ends of the travel.  Setting stalled stops it moving, to simulate
+    a jam."""
+
+    pass
+
+    def __init__(self, forward, backward, forward_limit, backward_limit,
+                 travel_time=8.0, position=0.0, tick=0.01):
+        self.channels = {forward: 1, backward: -1}
+        self.limits = (backward_limit, forward_limit)
+        self.travel_time = travel_time
+        self.position = position        # 0 at the backward end, 1 at the forward end
+        self.tick = tick
+        self.drive = {forward: 0.0, backward: 0.0}
+        self.stalled = False
+        self.changed = threading.Event()
+        add_listener(self.output_changed)
+        self.update_limits()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def output_changed(self, channel, kind, value):
+        if channel in self.drive:
+            self.drive[channel] = value / 100 if kind == 'duty' else float(value)
+            self.changed.set()
+
+    def speed(self):
+        return sum(self.channels[channel] * drive
+                   for channel, drive in self.drive.items()) / self.travel_time
+
+    def update_limits(self):
+        set_input(self.limits[0], self.position <= 0.0)
+        set_input(self.limits[1], self.position >= 1.0)
+
+    def run(self):
+        last = time.monotonic()
+        while True:
+            if not self.speed():
+                self.changed.wait()
+                self.changed.clear()
+                last = time.monotonic()
+                continue
+            time.sleep(self.tick)
+            now = time.monotonic()
+            if not self.stalled:
+                self.position = max(0.0, min(1.0, self.position + self.speed() * (now - last)))
+                self.update_limits()
+            last = now
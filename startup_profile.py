@@ -0,0 +1,41 @@
+import os
+import sys
+import time
+
+# Timings of the stages of starting the controller, so that we can
+# see where the time goes between starting the program and being
+# ready for the first command.  Recording a stage is cheap, so it is
+# always done; the report is only printed when asked for.
+
+STARTED = time.perf_counter()
+STAGES = []                     # (name, time taken)
+
+last = STARTED
+
+def stage(name):
+    """Record that a stage of startup has finished."""
+    global last
+    now = time.perf_counter()
+    STAGES.append((name, now - last))
+    last = now
+
+def process_age():
+    """Return how long the process had been running when this module was imported, if we can tell."""
+    try:
+        with open("/proc/self/stat") as stat_stream:
+            start_ticks = int(stat_stream.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as uptime_stream:
+            uptime = float(uptime_stream.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+    return uptime - start_ticks / os.sysconf('SC_CLK_TCK') - (time.perf_counter() - STARTED)
+
+def report(stream=sys.stderr):
+    total = last - STARTED
+    before = process_age()
+    print("Startup profile:", file=stream)
+    if before is not None:
+        print("  %8.3fs  %s" % (before, "interpreter and first imports"), file=stream)
+    for name, taken in STAGES:
+        print("  %8.3fs  %s" % (taken, name), file=stream)
+    print("  %8.3fs  %s" % (total, "total to first command"), file=stream)
@@ -0,0 +1,87 @@
+import glob
+import os
+import threading
+import time
+
+from collections import deque
+
+# Reading the DS18B20 temperature sensor, and switching the fans.
+
+# A reading through the 1-wire sysfs interface takes about 750ms while
+# the sensor converts, so it is done on a thread of its own, and the
+# rest of the controller just uses the latest reading.  The fans go on
+# above one temperature and off below a lower one, so they don't keep
+# switching when the temperature hovers around a single threshold.
+
+W1_DEVICES = "/sys/bus/w1/devices"
+
+def find_sensors():
+    """Return the sysfs files to read the DS18B20 sensors through."""
+    return sorted(glob.glob(os.path.join(W1_DEVICES, "28-*", "w1_slave")))
+
+def read_celsius(device_file):
+    """Read a DS18B20, returning the temperature, or None if the reading failed its CRC check."""
+    with open(device_file) as device:
+        lines = device.read().splitlines()
+    if len(lines) < 2 or not lines[0].strip().endswith("YES"):
+        return None
+    _, found, millidegrees = lines[1].partition("t=")
+    return int(millidegrees) / 1000.0 if found else None
+
+class TemperatureSampler(object):
+
+    pass
+
+    def __init__(self, interval=60, fans_on=35.0, fans_off=30.0, history=1440,
+                 switch_fans=None, on_sample=None, log=None):
+        self.interval = interval
+        self.fans_on = fans_on
+        self.fans_off = fans_off
+        self.switch_fans = switch_fans or (lambda on: None)
+        self.on_sample = on_sample or (lambda celsius: None)
+        self.log = log or (lambda message, *message_data: None)
+        self.celsius = None
+        self.fans = False
+        self.samples = deque(maxlen=history)    # (time, celsius)
+        self.failures = 0
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        reported_missing = False
+        while True:
+            sensors = find_sensors()
+            if sensors:
+                self.sample(sensors[0])
+            elif not reported_missing:
+                self.log("no DS18B20 temperature sensor found in %s", W1_DEVICES)
+                reported_missing = True
+            time.sleep(self.interval)
+
+    def sample(self, device_file):
+        """Take a reading, and switch the fans if it has crossed a threshold."""
+        try:
+            celsius = read_celsius(device_file)
+        except (OSError, ValueError) as e:
+            self.log("could not read temperature from %s: %s", device_file, e)
+            celsius = None
+        if celsius is None:
+            self.failures += 1
+            return
+        self.celsius = celsius
+        self.samples.append((time.time(), celsius))
+        self.on_sample(celsius)
+        if not self.fans and celsius >= self.fans_on:
+            self.set_fans(True)
+        elif self.fans and celsius <= self.fans_off:
+            self.set_fans(False)
+
+    def set_fans(self, on):
+        self.fans = on
+        self.switch_fans(on)
+
+    def range(self):
+        """Return the lowest and highest temperatures in the recent samples."""
+        readings = [celsius for _when, celsius in self.samples]
+        return (min(readings), max(readings)) if readings else (None, None)
@@ -3,7 +3,7 @@
 import argparse
 import cmd
 import time
-import RPi.GPIO as GPIO
+from hardware_backend import GPIO
 import pins
 
 class GPIOtestShell(cmd.Cmd):
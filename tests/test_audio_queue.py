@@ -0,0 +1,88 @@
+import threading
+
+from audio_queue import CHIME, MUSIC, SPEECH, PlaybackQueue, ProcessPlayback
+
+class FakePlayback(object):
+
+    """A playback that finishes when the test says so."""
+
+    pass
+
+    def __init__(self):
+        self.state = 'new'
+        self.done = False
+
+    def start(self, on_exit):
+        self.state = 'playing'
+        self.on_exit = on_exit
+
+    def finished(self):
+        return self.done
+
+    def pause(self):
+        self.state = 'paused'
+
+    def resume(self):
+        self.state = 'playing'
+
+    def stop(self):
+        self.state = 'stopped'
+        self.done = True
+
+    def finish(self, queue):
+        self.done = True
+        self.state = 'finished'
+        self.on_exit()
+        queue.update()
+
+def test_plays_in_order_of_priority():
+    queue = PlaybackQueue()
+    music, speech, chime = FakePlayback(), FakePlayback(), FakePlayback()
+    queue.add(music, MUSIC, "music")
+    queue.add(speech, SPEECH, "speech")
+    assert music.state == 'paused'
+    assert speech.state == 'playing'
+    # speech isn't pre-empted, so the chime waits, but goes before the music:
+    queue.add(chime, CHIME, "chime")
+    assert chime.state == 'new'
+    speech.finish(queue)
+    assert chime.state == 'playing'
+    assert music.state == 'paused'
+    chime.finish(queue)
+    assert music.state == 'playing'
+    music.finish(queue)
+    assert not queue.busy()
+
+def test_same_priority_in_order_added():
+    queue = PlaybackQueue()
+    first, second = FakePlayback(), FakePlayback()
+    queue.add(first, SPEECH, "first")
+    queue.add(second, SPEECH, "second")
+    assert queue.describe() == ["playing speech: first", "waiting speech: second"]
+    first.finish(queue)
+    assert second.state == 'playing'
+
+def test_skip_and_clear():
+    finished = []
+    queue = PlaybackQueue(on_finish=lambda entry, completed: finished.append((entry.description, completed)))
+    music, chime, more_music = FakePlayback(), FakePlayback(), FakePlayback()
+    queue.add(music, MUSIC, "music")
+    queue.add(chime, CHIME, "chime")
+    queue.add(more_music, MUSIC, "more music")
+    queue.clear(MUSIC)
+    assert music.state == 'stopped'
+    assert more_music.state == 'stopped'
+    queue.skip()
+    assert chime.state == 'stopped'
+    assert not queue.busy()
+    assert sorted(finished) == [("chime", False), ("more music", False), ("music", False)]
+
+def test_process_playback_that_cannot_start():
+    exited = threading.Event()
+    logged = []
+    playback = ProcessPlayback(["/nonexistent/player"],
+                               log=lambda message, *message_data: logged.append(message % message_data))
+    playback.start(exited.set)
+    assert exited.wait(5)
+    assert playback.finished()
+    assert logged
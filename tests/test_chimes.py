@@ -0,0 +1,131 @@
+import datetime
+import sched
+
+import chimes
+from chimes import ChimeScheduler
+
+HOUR_TEMPLATE = "hour-%d.ogg"
+QUARTERS = ["first.ogg", "second.ogg", "third.ogg"]
+DURATIONS = {"first.ogg": 5, "second.ogg": 10, "third.ogg": 15}
+
+def make_chimer(chiming_times=None, played=None, tail=0.0):
+    scheduler = sched.scheduler()
+    return ChimeScheduler(scheduler,
+                          lambda filename, offset: played.append((filename, offset)),
+                          lambda filename: DURATIONS.get(filename, 20 if filename.startswith("hour") else None),
+                          chiming_times or {'Default': (8 * 60, 22 * 60)},
+                          HOUR_TEMPLATE,
+                          QUARTERS,
+                          tail=tail)
+
+def planned(chimer):
+    """Return when the planned chime starts, and its quarter and file."""
+    event = chimer.event
+    when, filename, _lead = event.argument
+    return datetime.datetime.fromtimestamp(event.time), (when, filename)
+
+def test_sound_for():
+    chimer = make_chimer()
+    assert chimer.sound_for(datetime.datetime(2026, 10, 19, 13, 0)) == "hour-1.ogg"
+    assert chimer.sound_for(datetime.datetime(2026, 10, 19, 0, 0)) == "hour-12.ogg"
+    assert chimer.sound_for(datetime.datetime(2026, 10, 19, 9, 45)) == "third.ogg"
+
+def test_started_early_by_its_length():
+    chimer = make_chimer(tail=2)
+    chimer.plan(datetime.datetime(2026, 10, 19, 9, 50))
+    start, (quarter, filename) = planned(chimer)
+    assert quarter == datetime.datetime(2026, 10, 19, 10, 0)
+    assert filename == "hour-10.ogg"
+    assert start == quarter - datetime.timedelta(seconds=18)
+
+def test_fallback_lead():
+    chimer = make_chimer()
+    chimer.duration_of = lambda filename: None
+    chimer.plan(datetime.datetime(2026, 10, 19, 9, 20))
+    start, (quarter, _filename) = planned(chimer)
+    assert quarter - start == datetime.timedelta(seconds=15)   # the half hour's lead
+
+def test_skips_a_quarter_whose_chime_should_already_have_started():
+    chimer = make_chimer()
+    # the half hour's chime would have started at 09:29:50:
+    chimer.plan(datetime.datetime(2026, 10, 19, 9, 29, 55))
+    _start, (quarter, _filename) = planned(chimer)
+    assert quarter == datetime.datetime(2026, 10, 19, 9, 45)
+
+def test_only_within_chiming_times():
+    chimer = make_chimer({'Monday': (9 * 60, 17 * 60), 'Default': None})
+    chimer.plan(datetime.datetime(2026, 10, 19, 17, 5))         # a Monday
+    _start, (quarter, _filename) = planned(chimer)
+    assert quarter == datetime.datetime(2026, 10, 26, 9, 0)     # the next Monday
+
+def test_no_chiming_times():
+    chimer = make_chimer({'Default': None})
+    chimer.plan(datetime.datetime(2026, 10, 19, 12, 0))
+    assert chimer.event is None
+
+def test_late_strike_starts_part_way_in(monkeypatch):
+    played = []
+    chimer = make_chimer(played=played)
+    quarter = datetime.datetime(2026, 10, 19, 9, 45)
+    monkeypatch.setattr(chimes.time, 'time', lambda: quarter.timestamp() - 15 + 2)
+    chimer.strike(quarter, "third.ogg", 15)
+    ((filename, offset),) = played
+    assert filename == "third.ogg"
+    assert abs(offset - 2) < 0.001
+    # and the next one is planned:
+    _start, (next_quarter, _filename) = planned(chimer)
+    assert next_quarter == datetime.datetime(2026, 10, 19, 10, 0)
+
+def test_early_strike_is_put_back(monkeypatch):
+    played = []
+    chimer = make_chimer(played=played)
+    quarter = datetime.datetime(2026, 10, 19, 9, 45)
+    monkeypatch.setattr(chimes.time, 'time', lambda: quarter.timestamp() - 60)
+    chimer.strike(quarter, "third.ogg", 15)
+    assert played == []
+    start, (planned_quarter, _filename) = planned(chimer)
+    assert planned_quarter == quarter
+    assert start == quarter - datetime.timedelta(seconds=15)
+
+def test_longer_than_planned_plays_from_the_start(monkeypatch):
+    played = []
+    chimer = make_chimer(played=played)
+    durations = {}
+    chimer.duration_of = durations.get
+    quarter = datetime.datetime(2026, 10, 19, 10, 0)
+    chimer.plan(quarter - datetime.timedelta(minutes=5))
+    start, _ = planned(chimer)
+    assert quarter - start == datetime.timedelta(seconds=25)   # not known yet
+    # decoded since, and longer than the fallback lead:
+    durations["hour-10.ogg"] = 40
+    monkeypatch.setattr(chimes.time, 'time', lambda: start.timestamp())
+    chimer.strike(*chimer.event.argument)
+    assert played == [("hour-10.ogg", 0)]
+
+def test_shorter_than_planned_is_put_back(monkeypatch):
+    played = []
+    chimer = make_chimer(played=played)
+    durations = {}
+    chimer.duration_of = durations.get
+    quarter = datetime.datetime(2026, 10, 19, 10, 0)
+    chimer.plan(quarter - datetime.timedelta(minutes=5))
+    start, _ = planned(chimer)
+    durations["hour-10.ogg"] = 8
+    monkeypatch.setattr(chimes.time, 'time', lambda: start.timestamp())
+    chimer.strike(*chimer.event.argument)
+    assert played == []
+    start, (planned_quarter, _filename) = planned(chimer)
+    assert planned_quarter == quarter
+    assert start == quarter - datetime.timedelta(seconds=8)
+
+def test_replanned_once_lengths_are_known():
+    chimer = make_chimer()
+    durations = {}
+    chimer.duration_of = durations.get
+    quarter = datetime.datetime(2026, 10, 19, 10, 0)
+    chimer.plan(quarter - datetime.timedelta(minutes=5))
+    durations["hour-10.ogg"] = 40
+    chimer.plan(quarter - datetime.timedelta(minutes=5))
+    start, _ = planned(chimer)
+    assert quarter - start == datetime.timedelta(seconds=40)
+    assert len(chimer.scheduler.queue) == 1
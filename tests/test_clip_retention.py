@@ -0,0 +1,73 @@
+import os
+import time
+
+import pytest
+
+from clip_retention import RetentionEngine, parse_size
+from clip_tracker import ClipTracker
+
+def make_clip(directory, name, size, age_days):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as clip:
+        clip.write(bytes(size))
+    when = time.time() - age_days * 86400
+    os.utime(path, (when, when))
+    return path
+
+def tracked(directory, *clips):
+    """Make some clips, given as (name, size, age in days), and a tracker that has scanned them."""
+    paths = [make_clip(directory, *clip) for clip in clips]
+    tracker = ClipTracker(directory)
+    tracker.scan(directory)
+    return tracker, paths
+
+@pytest.mark.parametrize("size, size_bytes", [(500000, 500000),
+                                              ("8Gb", 8 * 1024 ** 3),
+                                              ("1.5k", 1536),
+                                              ("100", 100)])
+def test_parse_size(size, size_bytes):
+    assert parse_size(size) == size_bytes
+
+def test_parse_bad_size():
+    with pytest.raises(ValueError):
+        parse_size("lots")
+
+def test_oldest_skips_stale_entries(tmp_path):
+    tracker, (oldest, middle, newest) = tracked(tmp_path, ("a.h264", 10, 3), ("b.h264", 10, 2), ("c.h264", 10, 1))
+    assert tracker.oldest()[1] == oldest
+    tracker.remove(oldest)
+    assert tracker.oldest()[1] == middle
+    # rewriting a clip makes it newer, leaving its old heap entry stale:
+    os.utime(middle)
+    tracker.add(middle)
+    assert tracker.oldest()[1] == newest
+    assert tracker.newest()[1] == middle
+    assert tracker.total_bytes == 20
+
+def test_enforce_size(tmp_path):
+    tracker, (oldest, middle, newest) = tracked(tmp_path, ("a.h264", 100, 3), ("b.h264", 100, 2), ("c.h264", 100, 1))
+    retention = RetentionEngine(tracker, 250, 30)
+    assert retention.enforce() > 0
+    assert not os.path.exists(oldest)
+    assert os.path.exists(middle) and os.path.exists(newest)
+    assert tracker.total_bytes == 200
+    assert retention.deleted == 1
+
+def test_enforce_age(tmp_path):
+    tracker, (old, recent) = tracked(tmp_path, ("a.h264", 100, 10), ("b.h264", 100, 1))
+    retention = RetentionEngine(tracker, "1g", 7)
+    # until the remaining clip is 7 days old:
+    assert retention.enforce() == pytest.approx(6 * 86400, abs=60)
+    assert not os.path.exists(old)
+    assert os.path.exists(recent)
+
+def test_enforce_empty(tmp_path):
+    tracker, _paths = tracked(tmp_path)
+    assert RetentionEngine(tracker, 100, 7).enforce() is None
+
+def test_new_clip_over_the_limit(tmp_path):
+    tracker, _paths = tracked(tmp_path, ("a.h264", 100, 1))
+    retention = RetentionEngine(tracker, 150, 7)
+    assert not retention.wanted.is_set()
+    tracker.add(make_clip(tmp_path, "b.h264", 100, 0))
+    assert retention.wanted.is_set()
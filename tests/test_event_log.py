@@ -0,0 +1,52 @@
+import os
+
+from event_log import EventLog, describe_value
+
+def open_log(tmp_path, capacity=4):
+    log = EventLog(os.path.join(tmp_path, "events.dat"), capacity)
+    log.open()
+    return log
+
+def test_record_and_query(tmp_path):
+    log = open_log(tmp_path)
+    log.record('pir', 1, 100.0)
+    log.record('lamp', 50, 101.0)
+    assert log.query() == [(100.0, 'pir', 1.0), (101.0, 'lamp', 50.0)]
+    assert log.query(sensors=['lamp']) == [(101.0, 'lamp', 50.0)]
+    log.close()
+
+def test_wrap_around(tmp_path):
+    log = open_log(tmp_path, capacity=4)
+    for second in range(10):
+        log.record('pir', second % 2, 100.0 + second)
+    assert log.count() == 4
+    # only the newest, in order, even though they start part way through the ring:
+    assert [when for when, _sensor, _value in log.query()] == [106.0, 107.0, 108.0, 109.0]
+    assert [when for when, _sensor, _value in log.query(start=107.5)] == [108.0, 109.0]
+    assert [when for when, _sensor, _value in log.query(end=107.0)] == [106.0, 107.0]
+    log.close()
+
+def test_kept_between_runs(tmp_path):
+    log = open_log(tmp_path, capacity=4)
+    for second in range(6):
+        log.record('fans', 1, 100.0 + second)
+    log.close()
+    log = open_log(tmp_path, capacity=4)
+    assert [when for when, _sensor, _value in log.query()] == [102.0, 103.0, 104.0, 105.0]
+    log.close()
+
+def test_remade_for_a_different_capacity(tmp_path):
+    log = open_log(tmp_path, capacity=4)
+    log.record('fans', 1, 100.0)
+    log.close()
+    log = open_log(tmp_path, capacity=8)
+    assert log.query() == []
+    log.close()
+
+def test_record_event(tmp_path):
+    log = open_log(tmp_path)
+    log.record_event({'event': 'tray', 'time': 1.0, 'status': 'extended'})
+    log.record_event({'event': 'audio.start', 'time': 2.0, 'sound': "chime"})   # not kept
+    ((when, sensor, value),) = log.query()
+    assert (sensor, describe_value(sensor, value)) == ('tray', 'extended')
+    log.close()
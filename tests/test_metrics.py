@@ -0,0 +1,73 @@
+import random
+
+import pytest
+
+import metrics
+from metrics import SUB_BUCKETS, Counter, Histogram
+
+def near(value, exact):
+    """Return whether a percentile is right to within the sub-bucket width.
+    It is the top of a bucket, so it may be over, but not under."""
+    return exact * (1 - 1e-9) <= value <= exact * (1 + 1 / SUB_BUCKETS) * (1 + 1e-9)
+
+def test_empty():
+    histogram = Histogram("empty", "nothing recorded")
+    assert histogram.percentile(0.5) == 0.0
+    assert histogram.report() == "empty: none"
+
+def test_uniform_percentiles():
+    histogram = Histogram("uniform", "1ms to 100ms")
+    values = [0.001 * n for n in range(1, 101)]
+    random.Random(1).shuffle(values)
+    for value in values:
+        histogram.record(value)
+    assert histogram.count == 100
+    assert histogram.largest == pytest.approx(0.1)
+    for fraction in (0.5, 0.9, 0.99):
+        exact = 0.001 * round(100 * fraction)
+        assert near(histogram.percentile(fraction), exact)
+    assert histogram.percentile(1.0) == pytest.approx(0.1)
+
+def test_percentile_never_beyond_largest():
+    histogram = Histogram("single", "one value")
+    histogram.record(0.0123)
+    assert histogram.percentile(0.5) == histogram.largest == 0.0123
+
+def test_across_the_range():
+    histogram = Histogram("range", "microseconds to minutes")
+    for value in (2e-6, 3e-3, 0.5, 90.0):
+        histogram.record(value)
+    assert near(histogram.percentile(0.25), 2e-6)
+    assert near(histogram.percentile(0.5), 3e-3)
+    assert near(histogram.percentile(0.75), 0.5)
+    assert histogram.percentile(1.0) == 90.0
+
+def test_out_of_range():
+    histogram = Histogram("limits", "values beyond the buckets", lowest=1e-3, highest=1.0)
+    histogram.record(1e-6)
+    histogram.record(20.0)
+    histogram.record(50.0)
+    assert histogram.percentile(0.3) == 1e-3
+    # beyond the highest, only the largest is known:
+    assert histogram.percentile(0.6) == 50.0
+
+def test_counter_and_prometheus(monkeypatch):
+    monkeypatch.setattr(metrics, 'METRICS', {})
+    commands = metrics.counter("test_commands_total", "Commands run.")
+    assert metrics.counter("test_commands_total", "Commands run.") is commands
+    commands.inc()
+    commands.inc(2)
+    with metrics.histogram("test_step_seconds", "Step time.").time():
+        pass
+    text = metrics.prometheus()
+    assert "# TYPE test_commands_total counter\ntest_commands_total 3.0\n" in text
+    assert "# TYPE test_step_seconds summary\n" in text
+    assert "test_step_seconds_count 1\n" in text
+
+def test_write_textfile(monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics, 'METRICS', {})
+    metrics.counter("test_total", "A test.").inc()
+    filename = tmp_path / "metrics" / "noticeboard.prom"
+    metrics.write_textfile(str(filename))
+    assert filename.read_text() == metrics.prometheus()
+    assert Counter("other", "unregistered").report() == "other: 0"
@@ -0,0 +1,59 @@
+import os
+
+from music_library import MusicLibrary
+
+def make_tracks(root, *paths):
+    for path in paths:
+        full = os.path.join(root, path)
+        os.makedirs(os.path.dirname(full), exist_ok=True)
+        open(full, 'w').close()
+
+def test_find(tmp_path):
+    make_tracks(tmp_path, "bach/01_Brandenburg_Concerto.ogg", "bach/02-Air.ogg", "notes.txt")
+    library = MusicLibrary(str(tmp_path))
+    library.refresh()
+    assert library.find("brandenburg") == [str(tmp_path / "bach/01_Brandenburg_Concerto.ogg")]
+    assert library.find("air") == [str(tmp_path / "bach/02-Air.ogg")]
+    assert library.find("brandenberg concerto") == [str(tmp_path / "bach/01_Brandenburg_Concerto.ogg")]
+
+def test_unreadable_directory(tmp_path, monkeypatch):
+    make_tracks(tmp_path, "bach/air.ogg", "handel/water_music.ogg")
+    logged = []
+    library = MusicLibrary(str(tmp_path), log=lambda message, *message_data: logged.append(message % message_data))
+    library.refresh()
+    make_tracks(tmp_path, "bach/gigue.ogg", "handel/largo.ogg")
+    unreadable = str(tmp_path / "handel")
+    scandir = os.scandir
+    def failing_scandir(directory):
+        if directory == unreadable:
+            raise PermissionError("permission denied")
+        return scandir(directory)
+    monkeypatch.setattr(os, 'scandir', failing_scandir)
+    library.refresh()
+    # the rest is brought up to date, and what was known of the unreadable one is kept:
+    assert library.find("gigue")
+    assert library.find("water music")
+    assert not library.find("largo")
+    assert any(unreadable in message for message in logged)
+    monkeypatch.setattr(os, 'scandir', scandir)
+    library.refresh()
+    assert library.find("largo")
+
+def test_index_that_cannot_be_saved(tmp_path):
+    make_tracks(tmp_path, "air.ogg")
+    blocker = tmp_path / "blocker"
+    blocker.write_text("not a directory")
+    logged = []
+    library = MusicLibrary(str(tmp_path), str(blocker / "index.pickle"),
+                           log=lambda message, *message_data: logged.append(message % message_data))
+    library.refresh()
+    assert library.find("air")
+    assert logged
+
+def test_saved_and_loaded(tmp_path):
+    make_tracks(tmp_path / "music", "air.ogg")
+    index = str(tmp_path / "index" / "music.pickle")
+    MusicLibrary(str(tmp_path / "music"), index).refresh()
+    library = MusicLibrary(str(tmp_path / "music"), index)
+    library.load()
+    assert library.find("air")
@@ -0,0 +1,67 @@
+import datetime
+
+from occupancy import Occupancy, convert_interval
+
+# Monday 19th October 2026 onwards
+MONDAY = datetime.date(2026, 10, 19)
+TUESDAY = datetime.date(2026, 10, 20)
+WEDNESDAY = datetime.date(2026, 10, 21)
+
+TIMETABLE = {'Monday': ["22:00--01:30"],
+             'Tuesday': ["06:00--08:00"]}
+
+def at(date, hour, minute=0):
+    return datetime.datetime.combine(date, datetime.time(hour, minute))
+
+def test_convert_interval():
+    assert convert_interval("07:30--09:15") == (450, 555)
+    assert convert_interval("not a time") is None
+
+def test_weekly_timetable():
+    occupancy = Occupancy(TIMETABLE)
+    assert occupancy.expected(at(TUESDAY, 7))
+    assert occupancy.expected(at(TUESDAY, 8))       # the end minute is included
+    assert not occupancy.expected(at(TUESDAY, 8, 1))
+    assert not occupancy.expected(at(MONDAY, 12))
+
+def test_past_midnight():
+    occupancy = Occupancy(TIMETABLE)
+    assert occupancy.expected(at(MONDAY, 23))
+    assert occupancy.expected(at(TUESDAY, 1))
+    assert not occupancy.expected(at(TUESDAY, 2))
+
+def test_past_midnight_into_an_exception():
+    occupancy = Occupancy(TIMETABLE, {TUESDAY.isoformat(): ["12:00--13:00"]})
+    assert occupancy.expected(at(TUESDAY, 1))       # from the Monday evening
+    assert not occupancy.expected(at(TUESDAY, 7))   # replaced by the exception
+    assert occupancy.expected(at(TUESDAY, 12, 30))
+
+def test_exception_replaces_the_spill():
+    occupancy = Occupancy(TIMETABLE, {MONDAY.isoformat(): []})
+    assert not occupancy.expected(at(MONDAY, 23))
+    assert not occupancy.expected(at(TUESDAY, 1))
+    assert occupancy.expected(at(TUESDAY, 7))
+
+def test_exception_past_midnight():
+    occupancy = Occupancy(TIMETABLE, {MONDAY.isoformat(): ["23:00--02:00"]})
+    assert occupancy.expected(at(TUESDAY, 1, 45))
+    assert not occupancy.expected(at(TUESDAY, 2, 1))
+
+def test_exception_range_and_named_day():
+    occupancy = Occupancy(TIMETABLE, {"%s--%s" % (TUESDAY, WEDNESDAY): 'Monday'})
+    assert not occupancy.expected(at(TUESDAY, 7))
+    assert occupancy.expected(at(TUESDAY, 23))
+    assert occupancy.expected(at(WEDNESDAY, 1))     # Tuesday's exception running on
+    assert occupancy.expected(at(WEDNESDAY, 23))
+
+def test_next_change():
+    occupancy = Occupancy(TIMETABLE)
+    assert occupancy.next_change(at(TUESDAY, 5)) == at(TUESDAY, 6)
+
+def test_learning():
+    occupancy = Occupancy({}, learning=True, threshold=2, spread=0)
+    for weeks_ago in (1, 2):
+        occupancy.observe(at(MONDAY - datetime.timedelta(weeks=weeks_ago), 15))
+    occupancy.learn()
+    assert occupancy.expected(at(MONDAY, 15))
+    assert not occupancy.expected(at(MONDAY, 16))
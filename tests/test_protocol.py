@@ -0,0 +1,36 @@
+import json
+
+import pytest
+
+from protocol import RequestError, format_event, format_reply, parse_request
+
+def test_plain_command():
+    assert parse_request(b"shine 3\n") == (None, "shine 3", False)
+
+def test_json_request():
+    assert parse_request(b'{"id": 7, "command": "shine 3"}\n') == (7, "shine 3", True)
+
+def test_json_request_without_id():
+    assert parse_request(b'{"command": "date"}') == (None, "date", True)
+
+@pytest.mark.parametrize("line", [b'{"id": 7, "command": ',           # not valid JSON
+                                  b'{"id": 7}',                       # no command
+                                  b'{"id": 7, "command": ["shine"]}', # command not a string
+                                  b'\xff\xfe'])                       # not UTF-8
+def test_bad_requests(line):
+    with pytest.raises(RequestError):
+        parse_request(line)
+
+def test_json_reply():
+    assert json.loads(format_reply(7, "done")) == {'id': 7, 'ok': True, 'output': "done"}
+    assert json.loads(format_reply(8, "", "no such command")) == {'id': 8, 'ok': False, 'output': "",
+                                                                  'error': "no such command"}
+
+def test_plain_reply():
+    assert format_reply(None, "done\n", structured=False) == b"done\n"
+    assert format_reply(None, "", "failed", structured=False) == b"failed\n"
+
+def test_event():
+    line = format_event({'event': 'pir', 'time': 1.5, 'on': True})
+    assert line.endswith(b"\n")
+    assert json.loads(line) == {'event': 'pir', 'time': 1.5, 'on': True}
@@ -0,0 +1,109 @@
+import threading
+import time
+
+from hardware_backend import GPIO
+
+# Driving the keyboard tray motor.
+
+# The motor is started gently, ramping its PWM duty cycle up, and is
+# stopped as soon as a limit switch edge arrives, by a hook called
+# straight from the GPIO edge callback rather than when the main loop
+# next gets round to it.  If the limit switch hasn't been reached by
+# some margin past the usual travel time, the motor is taken to have
+# stalled (or the switch to have failed), and is stopped.  All the
+# timing is by the clock, so it doesn't depend on how fast the main
+# loop is running.
+
+MOVING = {'extend': 'extending', 'retract': 'retracting'}
+ARRIVED = {'extend': 'extended', 'retract': 'retracted'}
+
+class TrayMotor(object):
+
+    pass
+
+    def __init__(self, extend_pin, retract_pin, extended_pin, retracted_pin,
+                 travel_time=8.0, ramp=0.5, stall_margin=1.5, pwm_frequency=100):
+        self.drive_pins = {'extend': extend_pin, 'retract': retract_pin}
+        self.limit_pins = {'extend': extended_pin, 'retract': retracted_pin}
+        self.travel_time = travel_time
+        self.ramp = ramp
+        self.stall_margin = stall_margin
+        self.pwms = {direction: GPIO.PWM(pin, pwm_frequency)
+                     for direction, pin in self.drive_pins.items()}
+        self.lock = threading.Lock()
+        self.status = 'unknown'
+        self.direction = None
+        self.started = 0
+        self.duty = 0
+        self.travelled = None   # how long the last completed move took
+
+    def at_limit(self, direction):
+        return GPIO.input(self.limit_pins[direction])
+
+    def move(self, direction):
+        """Start moving the tray ('extend' or 'retract'), unless it is already there.
+        Returns whether the motor was started."""
+        with self.lock:
+            if self.direction == direction:
+                return False
+            self.halt()
+            if self.at_limit(direction):
+                self.status = ARRIVED[direction]
+                return False
+            self.direction = direction
+            self.status = MOVING[direction]
+            self.started = time.monotonic()
+            self.duty = 0
+            self.pwms[direction].start(0)
+            return True
+
+    def halt(self):
+        """Stop the motor; the caller must hold the lock."""
+        for pwm in self.pwms.values():
+            pwm.stop()
+        self.direction = None
+        self.duty = 0
+
+    def stop(self, status='unknown'):
+        with self.lock:
+            self.halt()
+            self.status = status
+
+    def limit_edge(self, pin):
+        """Stop the motor if the limit switch it is heading for has been reached.
+        This is called on the RPi.GPIO callback thread."""
+        with self.lock:
+            if (self.direction
+                and pin == self.limit_pins[self.direction]
+                and self.at_limit(self.direction)):
+                self.travelled = time.monotonic() - self.started
+                self.status = ARRIVED[self.direction]
+                self.halt()
+
+    def step(self, now=None):
+        """Ramp the motor up, and check for a stall.
+        Returns whether the tray is still moving."""
+        now = now or time.monotonic()
+        with self.lock:
+            if self.direction is None:
+                return False
+            if self.at_limit(self.direction):
+                # in case the edge was missed:
+                self.travelled = now - self.started
+                self.status = ARRIVED[self.direction]
+                self.halt()
+                return False
+            elapsed = now - self.started
+            if elapsed > self.travel_time * self.stall_margin:
+                self.status = 'stalled'
+                self.halt()
+                return False
+            duty = min(100, round(100 * elapsed / self.ramp)) if self.ramp else 100
+            if duty != self.duty:
+                self.duty = duty
+                self.pwms[self.direction].ChangeDutyCycle(duty)
+            return True
+
+    def ramping(self):
+        """Return whether the motor is still being brought up to full power."""
+        return self.direction is not None and self.duty < 100